@@ -1,11 +1,14 @@
 from ni.core.selection import Selection
 from ni.core.text import char_pos_to_tab_pos
-from ni.core.document import InsertDelta, DeleteDelta
+from ni.core.document import InsertDelta, DeleteDelta, BatchDelta
 
 
 class Action(object):
     """Base class for all view actions."""
 
+    # the action can't run while the document is still being loaded
+    needs_loaded_document = False
+
     def __init__(self, view):
         self.grouped = False
         self.editor = view.editor
@@ -49,6 +52,8 @@ class MoveCursorAction(Action):
 class EditAction(Action):
     """Base class for all undoable actions."""
 
+    needs_loaded_document = True
+
     def __init__(self, view):
         super(EditAction, self).__init__(view)
         self.before_cursor_pos = None
@@ -111,6 +116,18 @@ class EditAction(Action):
         # was before we deleted it
         view.cursor_pos = doc.offset_to_cursor_pos(selection.start)
 
+    def apply_edits(self, edits):
+        """
+        Apply a sorted list of (offset, length, text) replacements as one
+        BatchDelta. (see Document.apply_edits)
+        """
+
+        if not edits:
+            return
+        d = BatchDelta(self.view.document, edits)
+        d.do()
+        self.deltas.append(d)
+
     def do(self):
         """
         Subclasses should implement this.
@@ -118,6 +135,22 @@ class EditAction(Action):
 
         raise NotImplementedError
 
+    def merge(self, action):
+        """
+        Fold action, which got executed straight after this one, into this
+        action so that they get undone and redone together. Return True if
+        it worked.
+
+        Subclasses can implement this. (see InsertText and DeleteTextBackward)
+        """
+
+        return False
+
+    def _merge_after_positions(self, action):
+        self.after_cursor_pos = action.after_cursor_pos
+        self.after_last_x_pos = action.after_last_x_pos
+        self.after_scroll_pos = action.after_scroll_pos
+
     def undo(self):
         if not self.is_executed:
             raise RuntimeError("Not executed")
@@ -164,15 +197,15 @@ class ToggleComment(EditAction):
             from_line = view.cursor_pos[0]
             to_line = from_line
         
+        edits = []
         for y in xrange(from_line, to_line+1):
             line = doc.get_line(y)
             offset = doc.cursor_pos_to_offset((y, 0))
             if line[:len(self.comment_string)] == self.comment_string:
-                d = DeleteDelta(doc, offset, len(self.comment_string))
+                edits.append((offset, len(self.comment_string), u""))
             else:
-                d = InsertDelta(doc, offset, self.comment_string)
-            d.do()
-            self.deltas.append(d)
+                edits.append((offset, 0, self.comment_string))
+        self.apply_edits(edits)
         
         # move the cursor if necessary
         y, x = view.cursor_pos
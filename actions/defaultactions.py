@@ -96,6 +96,8 @@ class SaveDocument(Action):
     Save the open document
     """
 
+    needs_loaded_document = True
+
     def execute(self):
         doc = self.view.document
         if doc.location:
@@ -109,7 +111,11 @@ class SaveDocumentAs(Action):
     Save the open document as a new file
     """
 
+    needs_loaded_document = True
+
     def execute(self):
+        if self.view.document.is_loading:
+            return
         new_view = self.editor.copy_view()
         # the new view will already be the active one
         self.editor.save_dialog.show()
@@ -255,7 +261,7 @@ class SelectAll(Action):
     def execute(self):
         view = self.view
         doc = view.document
-        view.selection = Selection(doc, 0, len(doc.content))
+        view.selection = Selection(doc, 0, doc.num_chars)
         view.invalidate()
 
 class CancelSelection(Action):
@@ -540,6 +546,31 @@ class InsertText(EditAction):
         offset += tab_len(self.text, doc.tab_size)
         view.cursor_pos = doc.offset_to_cursor_pos(offset)        
 
+    def merge(self, action):
+        """
+        Merge a single typed character into this action if it continues
+        where this action's text ended.
+        """
+
+        if not isinstance(action, InsertText) or action.view != self.view:
+            return False
+        if len(self.deltas) != 1 or len(action.deltas) != 1:
+            return False
+
+        delta = self.deltas[0]
+        new_delta = action.deltas[0]
+        if not isinstance(delta, InsertDelta) or \
+           not isinstance(new_delta, InsertDelta):
+            return False
+        if len(new_delta.text) != 1 or \
+           new_delta.offset != delta.offset+len(delta.text):
+            return False
+
+        delta.text += new_delta.text
+        delta.after_state = new_delta.after_state
+        self._merge_after_positions(action)
+        return True
+
 class CopyToClipboard(Action):
     """
     Copies the selection to the clipboard
@@ -606,7 +637,7 @@ class DeleteTextForward(EditAction):
             offset = doc.cursor_pos_to_offset(view.cursor_pos)
             
             # if we're at the end of the file, do nothing
-            if offset >= len(doc.content)-1:
+            if offset >= doc.num_chars-1:
                 return
             
             # delete the character under the cursor            
@@ -640,6 +671,34 @@ class DeleteTextBackward(EditAction):
             
             view.cursor_pos = doc.offset_to_cursor_pos(offset-1)
 
+    def merge(self, action):
+        """
+        Merge the deletion of a single character into this action if it is
+        the character right before the ones this action deleted.
+        """
+
+        if not isinstance(action, DeleteTextBackward) or \
+           action.view != self.view:
+            return False
+        if len(self.deltas) != 1 or len(action.deltas) != 1:
+            return False
+
+        delta = self.deltas[0]
+        new_delta = action.deltas[0]
+        if not isinstance(delta, DeleteDelta) or \
+           not isinstance(new_delta, DeleteDelta):
+            return False
+        if new_delta.length != 1 or new_delta.offset != delta.offset-1:
+            return False
+
+        delta.offset -= 1
+        delta.length += 1
+        delta.deleted_content = new_delta.deleted_content + \
+                                delta.deleted_content
+        delta.after_state = new_delta.after_state
+        self._merge_after_positions(action)
+        return True
+
 class Indent(EditAction):
     """
     Indent the selection or current line.
@@ -667,12 +726,10 @@ class Indent(EditAction):
             end_pos = doc.offset_to_cursor_pos(selection.end)
             end_y, end_x = end_pos
             
-            # add the actual insert deltas
-            for i in xrange(start_y, end_y+1):
-                offset = doc.cursor_pos_to_offset((i, 0))
-                d = InsertDelta(doc, offset, u" "*settings.indent_width)
-                d.do()
-                self.deltas.append(d)
+            # insert the indentation on all the lines at once
+            indent = u" "*settings.indent_width
+            self.apply_edits([(doc.cursor_pos_to_offset((i, 0)), 0, indent)
+                              for i in xrange(start_y, end_y+1)])
             
             # Adjust the start and end positions of the selection.
             # The checks on start_x and end_x are there to keep the selection 
@@ -738,7 +795,8 @@ class Unindent(EditAction):
             end_pos = doc.offset_to_cursor_pos(selection.end)
             end_y, end_x = end_pos
             
-            # add the delete deltas
+            # delete the spaces from all the lines at once
+            edits = []
             spaces_per_line = []
             for y in xrange(start_y, end_y+1):
                 line = doc.get_line(y).replace('\t', u' '*settings.tab_size)
@@ -752,9 +810,8 @@ class Unindent(EditAction):
                 spaces_per_line.append(num_spaces)
                 if num_spaces:
                     offset = doc.cursor_pos_to_offset((y, 0))
-                    d = DeleteDelta(doc, offset, num_spaces)
-                    d.do()
-                    self.deltas.append(d)
+                    edits.append((offset, num_spaces, u""))
+            self.apply_edits(edits)
              
             if selection_direction == "down":
                 start_x -= spaces_per_line[0]
@@ -821,12 +878,8 @@ class BlockComment(EditAction):
             return
         
         selection = view.selection.get_normalised()
-        d = InsertDelta(doc, selection.start, u"/*")
-        d.do()
-        self.deltas.append(d)
-        d = InsertDelta(doc, selection.end+2, u"*/")
-        d.do()
-        self.deltas.append(d)
+        self.apply_edits([(selection.start, 0, u"/*"),
+                          (selection.end, 0, u"*/")])
         
         view.cursor_pos = doc.offset_to_cursor_pos(selection.end+4)
         view.selection = None
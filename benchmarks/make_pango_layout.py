@@ -1,10 +1,12 @@
 import gtk
+import pango
 from ni.core.benchmark import BenchmarkTimer, format_report
 from ni.core.document import Document, load_document
+from ni.core.lru import LRUCache
 from ni.editors.base.settings import BaseSettings
 from ni.editors.base.editor import Editor
 from ni.editors.base.view import View
-from ni.editors.gtk.utils import make_pango_layout, get_gtk_colours
+from ni.editors.gtk.utils import make_line_layouts, get_gtk_colours
 from ni.editors.gtk.settings import load_gtk_settings
 
 
@@ -43,6 +45,7 @@ class FakeView(View):
     def __init__(self, editor, document):
         super(FakeView, self).__init__(editor, document)
         self.colours = None # set this later
+        self.colours_key = None
 
     def _get_textbox_dimensions(self):
         return self.editor.dimensions
@@ -80,8 +83,8 @@ if __name__ == "__main__":
     colourscheme = colourschemes[0]
 
     # make a widget and show it so that we have a widget to use to allocate
-    # colours and pass it to make_pango_layout (which uses it to make a new
-    # layout)
+    # colours and pass it to make_line_layouts (which uses it to make new
+    # layouts)
     widget = gtk.Window()
     widget.show()
 
@@ -92,20 +95,31 @@ if __name__ == "__main__":
     offset = (0, 0)
     size = view.textbox_dimensions
     tab_size = 8
+    font = pango.FontDescription('monospace 9')
+
+    # a cache that doesn't keep anything, so every line gets laid out
+    no_cache = LRUCache(0)
+    cache = LRUCache(1000)
 
     b = BenchmarkTimer()
 
     for x in xrange(1000):
         b.start("Warmup (must relex)")
-        view.document.invalidate((0, 0))
+        view.document.invalidate(0)
         view.document.update_tokens(offset, size)
-        layout = make_pango_layout(view, widget)
+        layouts = make_line_layouts(view, font, no_cache, widget)
         b.end()
 
     for x in xrange(1000):
         b.start("Normal (no lexing)")
         view.document.update_tokens(offset, size)
-        layout = make_pango_layout(view, widget)
+        layouts = make_line_layouts(view, font, no_cache, widget)
+        b.end()
+
+    for x in xrange(1000):
+        b.start("Cached layouts")
+        view.document.update_tokens(offset, size)
+        layouts = make_line_layouts(view, font, cache, widget)
         b.end()
 
     print
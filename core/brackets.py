@@ -0,0 +1,276 @@
+import bisect
+from array import array
+from ni.core.offsets import OffsetArray
+
+
+# TODO: these should probably be pluggable per mode
+OPEN_BRACKETS = {
+    u'{': u'}',
+    u'(': u')',
+    u'[': u']',
+}
+CLOSE_BRACKETS = {
+    u'}': u'{',
+    u')': u'(',
+    u']': u'[',
+}
+
+class BracketIndex(object):
+    """The brackets in a Tokenizer's punctuation tokens.
+
+    Every kind of bracket nests on its own, so a ( only ever matches a ) and
+    the brackets of other kinds in between don't matter. Each bracket has a
+    depth: for an opening bracket that's the number of unclosed brackets of
+    its kind after it and for a closing bracket the number before it. A pair
+    has the same depth on both sides and there can't be another bracket of
+    that kind and depth in between, so the brackets get grouped by (opening
+    bracket, depth) and the match of a bracket is its neighbour in its group.
+    Finding it is a bisect.
+
+    The Tokenizer calls update() with the tokens that it lexed again, so
+    only those get scanned for brackets. The brackets after them just get
+    moved, lazily (see OffsetArray). If the range that got lexed again has
+    the same brackets as before (which is what typing anything but a
+    bracket does) the depths stay as they are. Otherwise the depths of all
+    the brackets after the first one that changed get worked out again the
+    next time something asks, which takes time linear in the number of
+    brackets after it: inserting a bracket changes the depth of every later
+    bracket of its kind.
+
+    Parameters:
+    tokenizer      -- The Tokenizer whose tokens get indexed.
+    punctuation    -- The type id of Token.Punctuation. (Brackets only count
+                      in tokens of exactly that type.)
+
+    Attributes:
+    offsets        -- Document offsets of the brackets in order, as an
+                      OffsetArray. (These are only up to date after one of
+                      the lookups.)
+    chars          -- The bracket characters.
+
+    Methods:
+    update         -- replace the brackets in a range that got lexed again
+    clear          -- forget everything and scan all the tokens when needed
+    find_match     -- return the offset of the bracket matching the one at
+                      an offset
+    find_enclosing -- return the innermost pair of brackets around an offset
+    depth          -- return the number of brackets around an offset
+
+    """
+
+    def __init__(self, tokenizer, punctuation):
+        self.tokenizer = tokenizer
+        self.punctuation = punctuation
+        self.clear()
+
+    def clear(self):
+        """
+        Forget all the brackets. All of the tokenizer's tokens get scanned
+        the next time something is looked up.
+        """
+
+        self.offsets = OffsetArray()
+        self.chars = []
+        self._stale = True
+
+        # the depth of each bracket, the indexes of the brackets by (opening
+        # bracket, depth) and by kind of bracket, worked out up to
+        # _num_depths
+        self._depths = array('i')
+        self._groups = {}
+        self._kinds = {}
+        self._num_depths = 0
+
+    def _forget_depths(self, index):
+        """Drop the depths from bracket number index onwards."""
+
+        self._num_depths = index
+        del self._depths[index:]
+        for indexes in self._groups.itervalues():
+            del indexes[bisect.bisect_left(indexes, index):]
+        for indexes in self._kinds.itervalues():
+            del indexes[bisect.bisect_left(indexes, index):]
+
+    def _scan(self, first_token, last_token):
+        """
+        Return the offsets and characters of the brackets in the tokens from
+        first_token up to (but not including) last_token.
+        """
+
+        tokenizer = self.tokenizer
+        offsets = array('i')
+        chars = []
+        if first_token >= last_token:
+            return offsets, chars
+
+        punctuation = self.punctuation
+        starts = tokenizer.starts
+        lengths = tokenizer.lengths
+        types = tokenizer.types
+        base = starts[first_token]
+        text = tokenizer.document.get_text(
+            base, starts[last_token-1]+lengths[last_token-1])
+        for i in xrange(first_token, last_token):
+            if types[i] != punctuation:
+                continue
+            start = starts[i]-base
+            for j in xrange(start, start+lengths[i]):
+                char = text[j]
+                if char in OPEN_BRACKETS or char in CLOSE_BRACKETS:
+                    offsets.append(base+j)
+                    chars.append(char)
+        return offsets, chars
+
+    def update(self, start, old_end, delta, first_token, last_token):
+        """
+        The tokens from start to old_end (in the old offsets) got replaced
+        by the tokens from first_token up to last_token and everything after
+        them moved by delta.
+        """
+
+        if self._stale:
+            return
+
+        offsets = self.offsets
+        i = offsets.bisect_left(start)
+        j = offsets.bisect_left(old_end)
+        new_offsets, new_chars = self._scan(first_token, last_token)
+        offsets.shift(j, delta)
+        offsets.replace(i, j, new_offsets)
+        if new_chars == self.chars[i:j]:
+            # the same brackets, so the same depths and indexes
+            return
+        self.chars[i:j] = new_chars
+        if i < self._num_depths:
+            self._forget_depths(i)
+
+    def _update(self):
+        """Bring the brackets and their depths up to date."""
+
+        if self._stale:
+            self._stale = False
+            offsets, self.chars = self._scan(0, len(self.tokenizer.starts))
+            self.offsets = OffsetArray(offsets)
+            self._forget_depths(0)
+
+        index = self._num_depths
+        if index == len(self.offsets):
+            return
+
+        # the depth of every kind of bracket before index
+        kinds = self._kinds
+        levels = {}
+        for opening, indexes in kinds.iteritems():
+            if indexes:
+                last = indexes[-1]
+                if self.chars[last] == opening:
+                    levels[opening] = self._depths[last]
+                else:
+                    levels[opening] = self._depths[last]-1
+
+        chars = self.chars
+        depths = self._depths
+        groups = self._groups
+        for i in xrange(index, len(chars)):
+            char = chars[i]
+            if char in OPEN_BRACKETS:
+                opening = char
+                depth = levels.get(opening, 0)+1
+                levels[opening] = depth
+            else:
+                opening = CLOSE_BRACKETS[char]
+                depth = levels.get(opening, 0)
+                levels[opening] = depth-1
+            depths.append(depth)
+            groups.setdefault((opening, depth), []).append(i)
+            kinds.setdefault(opening, []).append(i)
+        self._num_depths = len(chars)
+
+    def _find_index(self, offset):
+        i = self.offsets.bisect_left(offset)
+        if i < len(self.offsets) and self.offsets[i] == offset:
+            return i
+        return None
+
+    def _match_index(self, i):
+        char = self.chars[i]
+        if char in OPEN_BRACKETS:
+            group = self._groups[(char, self._depths[i])]
+            position = bisect.bisect_left(group, i)+1
+            if position < len(group) and \
+               self.chars[group[position]] in CLOSE_BRACKETS:
+                return group[position]
+        else:
+            group = self._groups[(CLOSE_BRACKETS[char], self._depths[i])]
+            position = bisect.bisect_left(group, i)-1
+            if position >= 0 and self.chars[group[position]] in OPEN_BRACKETS:
+                return group[position]
+        return None
+
+    def find_match(self, offset):
+        """
+        Return the offset of the bracket that matches the one at offset or
+        None if there isn't a bracket at offset or it doesn't have a match.
+        """
+
+        self._update()
+        i = self._find_index(offset)
+        if i is None:
+            return None
+        match = self._match_index(i)
+        if match is None:
+            return None
+        return self.offsets[match]
+
+    def _get_levels(self, offset):
+        """
+        Return a list of (opening bracket, depth, index of the last bracket
+        of that kind) for the brackets before offset.
+        """
+
+        end = self.offsets.bisect_left(offset)
+        levels = []
+        for opening, indexes in self._kinds.iteritems():
+            position = bisect.bisect_left(indexes, end)-1
+            if position < 0:
+                continue
+            last = indexes[position]
+            depth = self._depths[last]
+            if self.chars[last] != opening:
+                depth -= 1
+            levels.append((opening, depth, end))
+        return levels
+
+    def find_enclosing(self, offset):
+        """
+        Return (open offset, close offset) for the innermost pair of
+        brackets around offset or None if it isn't inside any. The close
+        offset is None if the bracket never gets closed.
+        """
+
+        self._update()
+        best = None
+        for opening, depth, end in self._get_levels(offset):
+            if depth <= 0:
+                continue
+            group = self._groups[(opening, depth)]
+            position = bisect.bisect_left(group, end)-1
+            if position < 0:
+                continue
+            i = group[position]
+            if self.chars[i] == opening and (best is None or i > best):
+                best = i
+        if best is None:
+            return None
+
+        match = self._match_index(best)
+        if match is None:
+            return self.offsets[best], None
+        return self.offsets[best], self.offsets[match]
+
+    def depth(self, offset):
+        """Return the number of unclosed brackets before offset."""
+
+        self._update()
+        return sum(max(depth, 0) for opening, depth, end in
+                   self._get_levels(offset))
@@ -1,15 +1,43 @@
 import os
-import bisect
-from hashlib import md5
-from ni.core.tokenizer import Tokenizer
-from ni.core.stack import Stack
-from ni.core.text import get_line_length, normalise_line_endings
-from ni.core.files import load_textfile
+import sys
+import time
+from collections import deque
+from ni.core.tokenizer import Tokenizer, get_lexer_for_location
+from ni.core.undo import UndoStack
+from ni.core.text import normalise_line_endings
+from ni.core.files import load_textfile, map_textfile, write_textfile, \
+    TextFileLoader, HUGE_FILE_SIZE
 from ni.core.selection import Selection
+from ni.core.rope import Rope
+from ni.core.mappedtext import MappedText
+from ni.core.tokencache import get_token_cache
 
 
+# number of changes that Document.map_offset() can map offsets across
+EDIT_LOG_SIZE = 100000
+
+# Document.lex_ahead() lexes this many characters at a time for at most
+# LEX_TIME_SLICE seconds per call
+LEX_AHEAD_SIZE = 32*1024
+LEX_TIME_SLICE = 0.02
+
+# documents with more than this many characters left to lex get lexed by a
+# pool of worker processes (see Tokenizer.start_parallel_lex)
+PARALLEL_LEX_SIZE = 1024*1024
+
 def load_document(location, settings):
-    textfile = load_textfile(location)
+    """
+    Load the file at location into a new Document.
+
+    Files bigger than HUGE_FILE_SIZE get opened in huge file mode: the file
+    gets memory mapped instead of read and it doesn't get lexed.
+    """
+
+    textfile = None
+    if os.path.getsize(location) > HUGE_FILE_SIZE:
+        textfile = map_textfile(location)
+    if not textfile:
+        textfile = load_textfile(location)
 
     kwargs = {
         'encoding': textfile['encoding'],
@@ -17,10 +45,140 @@ def load_document(location, settings):
         'tab_size': settings.tab_size, # TODO: try and detect first
         'location': location,
         'content': textfile['content'],
+        'token_cache': get_token_cache(settings.get_token_cache_dir()),
     }
 
     return Document(**kwargs)
 
+def _get_line_range(text, y):
+    """
+    Return the offsets of the first character of line y in text (a Rope or
+    MappedText) and of its line ending (or the end of the text).
+    """
+
+    start_offset = text.line_start(y)
+    try:
+        end_offset = text.line_start(y+1)-1
+    except IndexError:
+        # the last line (and the text knows its length by now)
+        end_offset = len(text)
+    return start_offset, end_offset
+
+def _same_text(a, b):
+    """
+    Return True if the texts a and b (Ropes or MappedTexts of the same
+    length) have the same content, comparing them a chunk at a time.
+    """
+
+    a_chunks = a.iter_chunks()
+    b_chunks = b.iter_chunks()
+    a_chunk = b_chunk = u''
+    while True:
+        while not a_chunk:
+            a_chunk = next(a_chunks, None)
+            if a_chunk is None:
+                return True
+        while not b_chunk:
+            b_chunk = next(b_chunks)
+        length = min(len(a_chunk), len(b_chunk))
+        if a_chunk[:length] != b_chunk[:length]:
+            return False
+        a_chunk = a_chunk[length:]
+        b_chunk = b_chunk[length:]
+
+class DocumentLoader(object):
+    """
+    Loads a document a chunk at a time.
+
+    The first chunk gets read straight away so that document can be shown
+    immediately. Every call to step() appends the next chunk to it until the
+    whole file is in. While that is happening document.loader is set and
+    views won't edit the document.
+
+    Parameters:
+    location   -- The file to load.
+    settings   -- Editor settings (for tab_size and the token cache).
+    chunk_size -- Number of bytes to read at a time.
+
+    Attributes:
+    document   -- The document being loaded.
+
+    Properties:
+    progress   -- Fraction of the file that got loaded so far.
+    is_done    -- The whole file is loaded (or loading got cancelled).
+
+    Methods:
+    step       -- Load the next chunk. Returns False once everything is in.
+    run        -- Load everything that is left.
+    cancel     -- Stop loading.
+    """
+
+    def __init__(self, location, settings, chunk_size=None):
+        if chunk_size:
+            self.textfile = TextFileLoader(location, chunk_size)
+        else:
+            self.textfile = TextFileLoader(location)
+
+        text = self.textfile.read_chunk()
+        self.document = Document(encoding=self.textfile.encoding,
+                                 linesep=self.textfile.linesep,
+                                 tab_size=settings.tab_size,
+                                 location=location,
+                                 content=text,
+                                 token_cache=get_token_cache(
+                                     settings.get_token_cache_dir()))
+        if self.textfile.is_done:
+            self.document.loader = None
+        else:
+            self.document.loader = self
+
+    def _get_progress(self):
+        return self.textfile.progress
+    progress = property(_get_progress)
+
+    def _get_is_done(self):
+        return self.textfile.is_done
+    is_done = property(_get_is_done)
+
+    def step(self):
+        textfile = self.textfile
+        doc = self.document
+
+        text = textfile.read_chunk()
+        if text is None:
+            return False
+
+        # the encoding might have been a bad guess
+        doc.encoding = textfile.encoding
+        if not doc.linesep:
+            doc.linesep = textfile.linesep
+
+        doc._append_loaded(text)
+
+        if textfile.is_done:
+            doc.loader = None
+            return False
+        return True
+
+    def run(self, callback=None):
+        """
+        Load the rest of the file, calling callback with this loader after
+        every chunk. Returns the document.
+        """
+
+        while self.step():
+            if callback:
+                callback(self)
+        return self.document
+
+    def cancel(self):
+        """
+        Stop loading. The document only has part of the file, so it stays
+        marked as loading and should be closed.
+        """
+
+        self.textfile.cancel()
+
 class Document(object):
     """
     Representation of a text file / buffer.
@@ -33,10 +191,20 @@ class Document(object):
                      from unicode strings.
     linesep       -- Line separator character(s).
     tab_size      -- Width of a tab in number of characters. (e.g. 2, 4, 8)
-    line_offsets  -- offset for the first character of each line
-    undo_stack    -- Stack that contains Action objects.
-    redo_stack    -- Stack that contains Action objects.
+    undo_stack    -- UndoStack that contains Action objects.
+    redo_stack    -- UndoStack that contains Action objects.
     tokenizer     -- A Tokenizer instance.
+    is_huge       -- The text is (at least partly) still in a memory mapped
+                     file. These documents don't get lexed.
+    loader        -- The DocumentLoader that is still loading the document or
+                     None.
+    state         -- Number that identifies the current content. Every edit
+                     moves the document to a new state and undoing an edit
+                     moves it back to the state it had before.
+    version       -- Number of changes made to the text so far. Unlike state
+                     it only ever goes up. (see snapshot and map_offset)
+    token_cache   -- TokenCache that tokens for the saved text get loaded from
+                     and stored in or None.
     
     PROPERTIES:
     
@@ -44,27 +212,56 @@ class Document(object):
                      modified.
     must_relex    -- The document had changes made since the last time it got
                      lexed.
+    is_lexed      -- All of the document has up to date tokens.
+    is_loading    -- The document is still being loaded by a DocumentLoader
+                     and shouldn't be edited.
     description   -- Returns either the filename if it is set, otherwise it
                      will return the title.
-    num_lines     -- return the number of lines.
+    num_lines     -- return the number of lines. (Huge documents have to
+                     index all of their file for this, see
+                     estimate_num_lines.)
+    is_indexed    -- Huge documents know where all of their lines are.
+    line_offsets  -- offset for the first character of each line. This builds
+                     a new list every time, so use cursor_pos_to_offset() for
+                     a specific line.
+    num_chars     -- return the number of characters.
+    content       -- The entire text as one unicode string. This gets built
+                     from the rope on demand, so prefer get_text() or
+                     get_line() when you only need part of it.
+    rope          -- A copy of the Rope that holds the text. Ropes share
+                     their unchanged parts, so this is cheap and can be
+                     passed in as the content of another document.
+                     (Content can also be a MappedText.)
 
     METHODS:
     
     offset_to_cursor_pos -- return (y, x) for the character
     cursor_pos_to_offset -- return closest offset
     get_line      -- Return a specific line
+    get_line_width -- Return the width of a line with tabs expanded
+    get_max_line_width -- Return the width of the widest line
+    get_text      -- Return the text between two offsets
+    snapshot      -- Return a DocumentSnapshot of the current text
+    map_offset    -- Map an offset from an older version to the current one
+    get_changed_range -- Return the range of text that changed since a version
     insert        -- Insert text at the specified position.
     delete        -- Delete text between the specified positions.
+    apply_edits   -- Replace several ranges of text at once.
     invalidate    -- Mark where a document must be retokenized/drawn
     save          -- Save the document to a file (specified by location)
     update_tokens -- Lex enough of the document to fill the view (or all of it
                      if to_end is set)
+    lex_ahead     -- Lex some more of the document in the background
+    count_lines   -- Return the number of lines, but no more than a limit
+    estimate_num_lines -- Return the number of lines or a guess at it
+    index_ahead   -- Index some more of a huge document's file in the
+                     background
 
     NOTES: 
     
-    insert and delete shouldn't be used directly, but via InsertDelta and 
-    DeleteDelta objects inside actions only. This ensures that all changes can 
-    be undone or redone. (see actions/defaultactions.py)
+    insert, delete and apply_edits shouldn't be used directly, but via 
+    InsertDelta, DeleteDelta and BatchDelta objects inside actions only. This
+    ensures that all changes can be undone or redone. (see actions/defaultactions.py)
     Action instances get added to undo_stack and these use Delta objects to 
     actually interact with the document.
 
@@ -73,7 +270,7 @@ class Document(object):
     """
 
     def __init__(self, encoding='utf8', linesep='\n', tab_size=8,
-                 location=None, title=None, content=None):
+                 location=None, title=None, content=None, token_cache=None):
         if not (location or title):
             raise Exception("location or title is required")
 
@@ -88,75 +285,129 @@ class Document(object):
         self.encoding = encoding
         self.linesep = linesep
         self.tab_size = tab_size
-        self.line_offsets = [0]
                 
         # content
-        content = content or u''
-        if content and not isinstance(content, unicode):
-            content = content.decode(encoding, 'ignore')        
-        self._content = normalise_line_endings(content)
+        self.is_huge = isinstance(content, MappedText)
+        if isinstance(content, (Rope, MappedText)):
+            self._text = content.copy()
+        else:
+            content = content or u''
+            if content and not isinstance(content, unicode):
+                content = content.decode(encoding, 'ignore')        
+            content = normalise_line_endings(content)
+            self._text = Rope(content)
 
-        self._adjust_line_offsets(0)
+        # the materialised content string (see _get_content)
+        self._content = None
 
-        # undo / redo action stacks (hardcoded sizes for now
-        self.undo_stack = Stack(10000)
-        self.redo_stack = Stack(10000)
+        # undo / redo action stacks (limited by memory use)
+        self.undo_stack = UndoStack()
+        self.redo_stack = UndoStack()
 
-        # Holds stuff like number of chars and md5 hash which we can check to 
-        # see if the file is modified. This should be updated every time we 
+        # the state the document is in and the last state handed out
+        self.state = 0
+        self._last_state = 0
+
+        # Holds stuff like the state and the saved text which we can check to
+        # see if the file is modified. This should be updated every time we
         # save the file.
         self._modified_info = None
 
         # things invalidated by actions since the last redraw
         self._relex_from = None
 
-        if self.location:
-            self.tokenizer = Tokenizer(self)
-        else:
-            self.tokenizer = Tokenizer(self)
+        self.loader = None
+
+        # (version, offset, removed, inserted) for the last EDIT_LOG_SIZE
+        # changes, where version is the one the change made
+        self.version = 0
+        self._edit_log = deque(maxlen=EDIT_LOG_SIZE)
+
+        # the tokens get made as they are needed (see update_tokens and
+        # lex_ahead)
+        self.tokenizer = Tokenizer(self)
+        self.token_cache = token_cache
 
         if location:
             self._update_modified_info()
-            # reset tokenizer
-            self.tokenizer = Tokenizer(self)
-            self.tokenizer.update()
 
     def _get_content(self):
         """
         Make sure you can't set content from the outside.
-        """        
+
+        The string only gets built when someone asks for it and it is cached
+        until the next edit.
+        """
+
+        if self._content is None:
+            self._content = self._text.get_text()
         return self._content
     content = property(_get_content)
 
+    def _get_rope(self):
+        self._make_writable()
+        return self._text.copy()
+    rope = property(_get_rope)
+
     def _get_is_modified(self):
         """
         Efficiently check to see if the document has been modified.
 
         Uses self._modified_info to check if a document has been 
-        modified since self._modified_info was last set.
+        modified since self._modified_info was last set. Undoing back to the
+        saved state is noticed by just comparing states. The checksum only
+        gets consulted when the document got to the same length some other
+        way (like retyping what was deleted) and the rope only has to
+        checksum the parts that changed since the last time. Different texts
+        can have the same checksum, so when they match the texts themselves
+        get compared (once per state).
         """
 
         if not self._modified_info:
             # this is a new file, so if there are any lines, then the
             # file was changed.
-            if self.content:
+            if self.num_chars:
                 return True
             else:
                 return False
         
+        # back at (or never left) the saved state
+        if self._modified_info['state'] == self.state:
+            return False
+
         # if the content is not of the same length, 
         # then it must be modified
-        if self._modified_info['num_chars'] != len(self.content):
+        saved_text = self._modified_info['text']
+        if len(saved_text) != self.num_chars:
             return True
-        
-        m = md5(self.content)
-        return self._modified_info['md5_hexdigest'] != m.hexdigest()
+
+        if saved_text.checksum() != self._text.checksum():
+            return True
+
+        compared = self._modified_info.get('compared')
+        if compared and compared[0] == self.state:
+            return compared[1]
+        modified = not _same_text(saved_text, self._text)
+        self._modified_info['compared'] = (self.state, modified)
+        return modified
     is_modified = property(_get_is_modified)
 
+    def _get_is_loading(self):
+        return self.loader is not None
+    is_loading = property(_get_is_loading)
+
     def _get_must_relex(self):
         return self._relex_from != None
     must_relex = property(_get_must_relex)
 
+    def _get_is_lexed(self):
+        if not self.tokenizer.lexer:
+            return True
+        if self.must_relex:
+            return False
+        return self.tokenizer.end >= self.num_chars
+    is_lexed = property(_get_is_lexed)
+
     def _get_description(self):
         """
         Return filename or something descriptive if location is not set.
@@ -175,9 +426,71 @@ class Document(object):
     description = property(_get_description)
 
     def _get_num_lines(self):
-        return len(self.line_offsets)
+        return self._text.num_lines
     num_lines = property(_get_num_lines)
 
+    def _get_is_indexed(self):
+        if isinstance(self._text, MappedText):
+            return self._text.is_indexed
+        return True
+    is_indexed = property(_get_is_indexed)
+
+    def count_lines(self, limit):
+        """
+        Return min(num_lines, limit). Huge documents only read as much of
+        their file as it takes to get to line limit.
+        """
+
+        if isinstance(self._text, MappedText):
+            return self._text.count_lines(limit)
+        return min(self._text.num_lines, limit)
+
+    def estimate_num_lines(self):
+        """
+        Return num_lines or, for huge documents whose file isn't indexed all
+        the way yet, a guess based on the part that is. Editors use this for
+        scrollbars and the like. (see index_ahead)
+        """
+
+        if isinstance(self._text, MappedText):
+            return self._text.estimate_num_lines()
+        return self._text.num_lines
+
+    def index_ahead(self, max_time=LEX_TIME_SLICE):
+        """
+        Index the next bit of a huge document's file for up to max_time
+        seconds. Return True if there is more left to do.
+
+        Editors call this when they are idle, like lex_ahead, so that
+        num_lines doesn't have to read the whole file in one go.
+        """
+
+        text = self._text
+        if not isinstance(text, MappedText):
+            return False
+
+        deadline = time.time()+max_time
+        while text.extend_index():
+            if time.time() >= deadline:
+                return True
+        return False
+
+    def _get_line_offsets(self):
+        line_offsets = [0]
+        offset = 0
+        for chunk in self._text.iter_chunks():
+            pos = chunk.find('\n')
+            while pos != -1:
+                line_offsets.append(offset+pos+1)
+                pos = chunk.find('\n', pos+1)
+            offset += len(chunk)
+        return line_offsets
+    line_offsets = property(_get_line_offsets)
+
+    def _get_num_chars(self):
+        return len(self._text)
+    num_chars = property(_get_num_chars)
+
     def _update_modified_info(self):
         """
         Set self._modified_info.
@@ -186,9 +499,10 @@ class Document(object):
 
         info = {}
 
-        info['num_chars'] = len(self.content)
-        m = md5(self.content)
-        info['md5_hexdigest'] = m.hexdigest()
+        info['state'] = self.state
+        # Copies are cheap and the length and checksum only get worked out if
+        # they are ever needed.
+        info['text'] = self._text.copy()
 
         self._modified_info = info
     
@@ -196,74 +510,279 @@ class Document(object):
         # check bounds
         if offset < 0:
             offset = 0
-        offset = min(offset, len(self.content))
-        
+
         # get the closest line (on or before the offset)
-        y = bisect.bisect_left(self.line_offsets, offset)
-        
-        if y >= self.num_lines:
-            # bisect_left might return an index outside of the list 
-            y = self.num_lines-1
-        elif self.line_offsets[y] > offset:
-            # if the offset of the line index bist_left returns is after the 
-            # offset we're looking for, use the previous line 
-            y -= 1
-        
-        return (y, offset-self.line_offsets[y])
+        y = self._text.count_newlines(offset)
+
+        # offsets past the end end up at the end of the last line
+        start_offset, end_offset = self._get_line_range(y)
+        return (y, min(offset, end_offset)-start_offset)
 
     def cursor_pos_to_offset(self, cursor_pos):
         y, x = cursor_pos
 
         # check bounds
         if y < 0:
-            return 0        
-        if y >= self.num_lines:
-            return len(self.content)
-        
+            return 0
+        try:
+            offset, max_offset = self._get_line_range(y)
+        except IndexError:
+            return self.num_chars
+
         # don't put the cursor after the end of the line
-        offset = self.line_offsets[y]
-        max_offset = get_line_length(self.content, offset)
-        return min(offset+x, max_offset)        
-
-    def _adjust_line_offsets(self, offset):
-        # TODO: this can be sped up a lot
-        soffset = 0
-        self.line_offsets = [0]
-        
-        while True:
-            loffset = self.content.find('\n', soffset)
-            if loffset == -1:
-                break
-            self.line_offsets.append(loffset+1)
-            soffset = loffset+1
+        return min(offset+x, max_offset)
+
+    def _get_line_range(self, y):
+        """
+        Return the offsets of the first character of line y and of its line
+        ending (or the end of the document for the last line).
+
+        This doesn't use num_lines or num_chars unless y is the last line,
+        because huge documents have to read the whole file to count those.
+        Raises IndexError if there is no line y.
+        """
+
+        return _get_line_range(self._text, y)
 
     def get_line(self, y):
-        start_offset = self.line_offsets[y]
-        if y+1 < self.num_lines:
-            end_offset = self.line_offsets[y+1]-1
-        else:
-            end_offset = len(self.content)
-        return self.content[start_offset:end_offset]
+        if y < 0:
+            # keep behaving like the list of line offsets used to
+            y += self.num_lines
+        start_offset, end_offset = self._get_line_range(y)
+        return self.get_text(start_offset, end_offset)
+
+    def get_line_width(self, y):
+        """
+        Return the length of line y where each tab takes tab_size characters.
+        """
+
+        start_offset, end_offset = self._get_line_range(y)
+        ntabs = self._text.count_tabs(start_offset, end_offset)
+        return end_offset - start_offset - ntabs + ntabs*self.tab_size
+
+    def get_max_line_width(self):
+        """
+        Return the width of the widest line where each tab takes tab_size
+        characters.
+
+        The rope caches the widths of its parts, so this only has to look at
+        the parts that changed since the last call. It does read all of the
+        text the first time, which huge documents want to avoid.
+        """
+
+        self._make_writable()
+        return self._text.max_line_width(self.tab_size)
+
+    def get_text(self, start=0, end=None):
+        """
+        Return the text from start up to (but not including) end.
+        """
+
+        if self._content is not None:
+            return self._content[start:end]
+        return self._text.get_text(start, end)
 
     def insert(self, offset, text):
         """
-        Insert text at offset; update line_offsets.
+        Insert text at offset.
         
         This should be used via InsertDelta so that we can undo it again.
         """
 
-        self._content = self._content[:offset]+text+self._content[offset:]        
-        self._adjust_line_offsets(offset)
+        if not text:
+            return
+
+        offset = max(0, min(offset, self.num_chars))
+        self._make_writable()
+        self._text.insert(offset, text)
+        self._content = None
+        self._new_state()
+        self._log_edit(offset, 0, len(text))
     
     def delete(self, offset, length):
         """
-        Delete length characters from offset; update line_offsets.
+        Delete length characters from offset.
         
         This should be used via DeleteDelta so that we can undo it again.
         """
 
-        self._content = self._content[:offset]+self._content[offset+length:]
-        self._adjust_line_offsets(offset)
+        offset = max(0, offset)
+        if length <= 0 or offset >= self.num_chars:
+            return
+
+        length = min(length, self.num_chars-offset)
+        self._make_writable()
+        self._text.delete(offset, length)
+        self._content = None
+        self._new_state()
+        self._log_edit(offset, length, 0)
+
+    def apply_edits(self, edits):
+        """
+        Replace several ranges of text in one go and return the edits that
+        will undo it again.
+
+        edits is a list of (offset, length, text) tuples sorted by offset
+        that replace length characters from offset with text. The ranges
+        mustn't overlap and all offsets refer to the text as it was before
+        any of them got applied. The returned undo edits have the same
+        format.
+
+        The edits get applied from the last one to the first one so that
+        the offsets stay valid. The document only gets a new state and only
+        invalidates once for the whole batch.
+
+        This should be used via BatchDelta so that we can undo it again.
+        """
+
+        undo_edits = []
+        shift = 0
+        for offset, length, text in edits:
+            old_text = self.get_text(offset, offset+length)
+            undo_edits.append((offset+shift, len(text), old_text))
+            shift += len(text)-len(old_text)
+
+        changed = False
+        self._make_writable()
+        for offset, length, text in reversed(edits):
+            offset = max(0, min(offset, self.num_chars))
+            length = max(0, min(length, self.num_chars-offset))
+            if length:
+                self._text.delete(offset, length)
+            if text:
+                self._text.insert(offset, text)
+            if length or text:
+                self._log_edit(offset, length, len(text))
+                changed = True
+
+        if changed:
+            self._content = None
+            self._new_state()
+            self.invalidate(edits[0][0])
+
+        return undo_edits
+
+    def _append_loaded(self, text):
+        """
+        Add text that DocumentLoader read to the end of the document.
+
+        This isn't an edit: it doesn't change the state and the document
+        doesn't count as modified because of it.
+        """
+
+        if not text:
+            return
+
+        offset = self.num_chars
+        self._text.insert(offset, text)
+        self._content = None
+        self._log_edit(offset, 0, len(text))
+        self.invalidate(offset)
+        if self._modified_info:
+            self._update_modified_info()
+
+    def _make_writable(self):
+        """
+        Swap a MappedText for a Rope that reads the parts that don't get
+        edited from the same file.
+        """
+
+        if isinstance(self._text, MappedText):
+            self._text = self._text.to_rope()
+
+    def _log_edit(self, offset, removed, inserted):
+        self._edit_log.append((self.version+1, offset, removed, inserted))
+        self.version += 1
+
+    def _get_edits_since(self, version):
+        """
+        Return the logged changes made after version or None if the log
+        doesn't go back that far.
+
+        Search threads map offsets from their snapshots while the document
+        keeps getting edited, so this works on a copy of the log and goes by
+        the versions in it rather than self.version.
+        """
+
+        edit_log = list(self._edit_log)
+        if not edit_log or edit_log[-1][0] <= version:
+            return []
+        first_version = edit_log[0][0]
+        if version+1 < first_version:
+            return None
+        return edit_log[version+1-first_version:]
+
+    def snapshot(self):
+        """
+        Return a DocumentSnapshot of the text as it is now.
+
+        This is cheap (the rope's nodes get shared, not copied) and the
+        snapshot never changes, so it can be handed to another thread.
+        """
+
+        return DocumentSnapshot(self)
+
+    def map_offset(self, offset, version):
+        """
+        Return where offset in the text as it was at version is now.
+
+        Offsets inside text that got deleted since then move to the start of
+        the deletion. Returns None if version is too old for the edit log to
+        remember.
+        """
+
+        if version > self.version:
+            raise ValueError("version is newer than the document")
+        edits = self._get_edits_since(version)
+        if edits is None:
+            return None
+
+        for edit_version, edit_offset, removed, inserted in edits:
+            if offset < edit_offset:
+                continue
+            if offset < edit_offset+removed:
+                offset = edit_offset
+            else:
+                offset += inserted-removed
+        return offset
+
+    def get_changed_range(self, version):
+        """
+        Return (start, end, delta) where start and end are the range of the
+        text that changed since version (in the offsets it has now) and
+        delta is the difference in length. Return None if nothing changed or
+        False if the edit log doesn't go back far enough to tell.
+        """
+
+        edits = self._get_edits_since(version)
+        if not edits:
+            if edits is None:
+                return False
+            return None
+
+        start = end = None
+        delta = 0
+        for edit_version, offset, removed, inserted in edits:
+            if start is None:
+                start, end = offset, offset+inserted
+            else:
+                # move the range we have so far through this edit
+                if start >= offset+removed:
+                    start += inserted-removed
+                elif start > offset:
+                    start = offset
+                if end >= offset+removed:
+                    end += inserted-removed
+                elif end > offset:
+                    end = offset
+                start = min(start, offset)
+                end = max(end, offset+inserted)
+            delta += inserted-removed
+        return start, end, delta
+
+    def _new_state(self):
+        self._last_state += 1
+        self.state = self._last_state
     
     def invalidate(self, offset):
         """
@@ -279,24 +798,28 @@ class Document(object):
     def update_tokens(self, scroll_pos, size, to_end=False):
         """
         (re)lex part of the document if we need to 
+
+        If the screen is more than LEX_AHEAD_SIZE characters past the part
+        that got lexed so far this doesn't do anything: the lines that
+        haven't been lexed get drawn as plain text until lex_ahead() gets
+        there.
         """
         
-        if self.tokenizer.tokens:
-            last_offset = self.tokenizer.offsets[-1]
-            last_token = self.tokenizer.tokens[-1]
-            last_offset += len(last_token[1].replace('\t', ' '*self.tab_size))
-        else:
-            last_offset = 0
+        last_offset = self.tokenizer.end
         
         if to_end:
             # force to end
-            last_needed_offset = len(self.content)
+            last_needed_offset = self.num_chars
         else:
             # last needed is the end of the screen
             y, x = scroll_pos
             width, height = size
             lx = x + width - 1
             ly = y + height - 1
+            first_needed_offset = self.cursor_pos_to_offset((y, 0))
+            if not self.must_relex and \
+               first_needed_offset-last_offset > LEX_AHEAD_SIZE:
+                return
             last_needed_offset = self.cursor_pos_to_offset((ly+1, 0))
             if last_needed_offset:
                 last_needed_offset -= 1
@@ -329,11 +852,90 @@ class Document(object):
         self.tokenizer.update(from_offset, 
                               last_needed_offset)
 
+    def lex_ahead(self, max_time=LEX_TIME_SLICE):
+        """
+        Lex the next bit of the document that isn't lexed yet (or that got
+        invalidated) for up to max_time seconds. Return True if there is
+        more left to do.
+
+        Editors call this when they are idle so that the tokens are (mostly)
+        there by the time the user scrolls to them. It lexes LEX_AHEAD_SIZE
+        characters at a time and stops once max_time is up.
+
+        If there is more than PARALLEL_LEX_SIZE left to lex from scratch, the
+        whole document gets lexed in worker processes instead and this just
+        waits up to max_time for them until they are done.
+
+        Unmodified documents first try to get their tokens from token_cache
+        and they get stored there once the document is lexed.
+        """
+
+        tokenizer = self.tokenizer
+        if self.token_cache and not tokenizer.checked_cache and \
+           not self.is_loading and not self.is_modified:
+            if tokenizer.load_from_cache(self.token_cache):
+                self._relex_from = None
+                return False
+
+        if tokenizer.is_lexing_in_parallel:
+            if not tokenizer.finish_parallel_lex(max_time):
+                return True
+            # the document might have changed while the workers were busy
+            damage = tokenizer._get_damage()
+            if damage is False:
+                self.invalidate(0)
+            elif damage:
+                self.invalidate(damage[0])
+
+        if self.is_lexed:
+            return False
+
+        if not self.must_relex and \
+           self.num_chars-tokenizer.end > PARALLEL_LEX_SIZE and \
+           tokenizer.start_parallel_lex():
+            return True
+
+        deadline = time.time()+max_time
+        while True:
+            if self._relex_from is not None:
+                from_offset = self._relex_from
+                self._relex_from = None
+            else:
+                from_offset = self.tokenizer.end
+            # lexers that can't be resumed start again a few tokens before
+            # from_offset (see Tokenizer._update_backtrack)
+            self.tokenizer.update(from_offset, from_offset+LEX_AHEAD_SIZE)
+
+            if self.is_lexed:
+                self._cache_tokens()
+                return False
+            if time.time() >= deadline:
+                return True
+
+    def _cache_tokens(self):
+        if self.token_cache and not self.is_modified:
+            self.tokenizer.save_to_cache(self.token_cache)
+
     def save(self, location=None):
         """
         Save the document to self.location, update self._modified_info
+
+        The text gets encoded a chunk at a time into a temporary file in the
+        same directory which is then synced to disk and renamed over the
+        original, so a crash or a full disk never leaves a half written file
+        behind. (It also means huge documents can save over the file that
+        they are still mapping parts of the text from.)
+
+        A document that is still loading gets loaded completely first,
+        otherwise only the part read so far would replace the file.
         """
 
+        if self.is_loading:
+            self.loader.run()
+            if self.is_loading:
+                # loading got cancelled, so the rest of the file is missing
+                raise Exception("Document did not finish loading.")
+
         old_location = self.location
 
         try:
@@ -343,51 +945,186 @@ class Document(object):
             
             if not self.location:
                 raise Exception("Location not set.")
-            
-            content = self.content
-            
-            # if the document's linesep setting is not \n, 
-            # then convert line endings
-            if self.linesep != '\n':
-                content = content.replace('\n', self.linesep)
-            
-            # TODO: I might have to write the file in binary mode or python
-            # will just replace line endings anyway.
-            f = open(self.location, "w")
-            f.write(content.encode(self.encoding))
-            f.close()
+
+            # write through symlinks rather than replacing them
+            target = os.path.realpath(self.location)
+            write_textfile(target, self._text.iter_chunks(), self.encoding,
+                           self.linesep)
 
             self._update_modified_info()
 
-            # reset tokenizer
+            # the tokens are still valid unless the new location changes the
+            # lexer
+            lexer = get_lexer_for_location(self.location)
+            if self.is_huge or type(lexer) is type(self.tokenizer.lexer):
+                if self.is_lexed:
+                    self._cache_tokens()
+                return
             self.tokenizer = Tokenizer(self)
-            self.tokenizer.update()
         
         except:
             self.location = old_location
             raise
 
-class InsertDelta(object):
-    def __init__(self, document, offset, text):
+class DocumentSnapshot(object):
+    """
+    The text of a document at one version.
+
+    Snapshots are immutable and share the document's rope, so they cost
+    next to nothing to make and background work (searching, lexing,
+    autosaving, indexing) can read them from another thread while the
+    document keeps getting edited. Offsets found in a snapshot can be
+    brought up to date with map_offset().
+
+    Don't make these directly. Use Document.snapshot().
+
+    ATTRIBUTES:
+
+    document      -- The Document this is a snapshot of.
+    version       -- The document's version when the snapshot was taken.
+    state         -- The document's state when the snapshot was taken.
+    location, title, encoding, linesep, tab_size -- Copied from the document.
+
+    PROPERTIES:
+
+    content       -- The entire text as one unicode string. (built on demand)
+    num_chars     -- return the number of characters.
+    num_lines     -- return the number of lines. (Huge documents have to
+                     index all of their file for this, see
+                     estimate_num_lines.)
+    is_indexed    -- Huge documents know where all of their lines are.
+
+    METHODS:
+
+    get_text      -- Return the text between two offsets
+    iter_chunks   -- Yield the text between two offsets a chunk at a time
+    get_line      -- Return a specific line
+    offset_to_cursor_pos -- return (y, x) for the character
+    map_offset    -- Return where an offset in the snapshot is in the
+                     document now
+
+    """
+
+    def __init__(self, document):
+        self.document = document
+        self.version = document.version
+        self.state = document.state
+        self.location = document.location
+        self.title = document.title
+        self.encoding = document.encoding
+        self.linesep = document.linesep
+        self.tab_size = document.tab_size
+        self._text = document._text.copy()
+        self._content = document._content
+
+    def _get_content(self):
+        if self._content is None:
+            self._content = self._text.get_text()
+        return self._content
+    content = property(_get_content)
+
+    def _get_num_chars(self):
+        return len(self._text)
+    num_chars = property(_get_num_chars)
+
+    def _get_num_lines(self):
+        return self._text.num_lines
+    num_lines = property(_get_num_lines)
+
+    def get_text(self, start=0, end=None):
+        if self._content is not None:
+            return self._content[start:end]
+        return self._text.get_text(start, end)
+
+    def iter_chunks(self, start=0, end=None):
+        return self._text.iter_chunks(start, end)
+
+    def get_line(self, y):
+        start_offset, end_offset = _get_line_range(self._text, y)
+        return self.get_text(start_offset, end_offset)
+
+    def offset_to_cursor_pos(self, offset):
+        offset = max(0, min(offset, self.num_chars))
+        y = self._text.count_newlines(offset)
+        return (y, offset-self._text.line_start(y))
+
+    def map_offset(self, offset):
+        """
+        Return where offset is in the document now or None if that can't be
+        worked out anymore. (see Document.map_offset)
+        """
+
+        return self.document.map_offset(offset, self.version)
+
+class Delta(object):
+    """
+    Base class for changes to a document that can be undone.
+
+    Deltas remember the document's state from before and after they got
+    applied so that undoing and redoing returns the document to exactly the
+    same states. (That's how the document knows it is back to the state it
+    was saved in.)
+    """
+
+    # rough size of a delta object with its attributes dict
+    SIZE = 400
+
+    def __init__(self, document):
         self.document = document
+        self.before_state = None
+        self.after_state = None
+
+    def _get_size(self):
+        """Rough number of bytes the delta takes up in the undo history."""
+
+        return self.SIZE
+    size = property(_get_size)
+
+    def do(self):
+        doc = self.document
+        self.before_state = doc.state
+        self.apply()
+        if self.after_state is None:
+            self.after_state = doc.state
+        else:
+            doc.state = self.after_state
+
+    def undo(self):
+        doc = self.document
+        self.revert()
+        doc.state = self.before_state
+
+    def apply(self):
+        raise NotImplementedError
+
+    def revert(self):
+        raise NotImplementedError
+
+class InsertDelta(Delta):
+    def __init__(self, document, offset, text):
+        super(InsertDelta, self).__init__(document)
         self.offset = offset
         if not isinstance(text, unicode):
             text = text.decode(self.document.encoding, 'ignore')
         self.text = normalise_line_endings(text)
 
-    def do(self):
+    def _get_size(self):
+        return self.SIZE+sys.getsizeof(self.text)
+    size = property(_get_size)
+
+    def apply(self):
         doc = self.document
         doc.insert(self.offset, self.text)
         doc.invalidate(self.offset)
 
-    def undo(self):
+    def revert(self):
         doc = self.document
         doc.delete(self.offset, len(self.text))
         doc.invalidate(self.offset)
 
-class DeleteDelta(object):
+class DeleteDelta(Delta):
     def __init__(self, document, offset, length):
-        self.document = document
+        super(DeleteDelta, self).__init__(document)
         self.offset = offset
         self.length = length
         
@@ -398,14 +1135,52 @@ class DeleteDelta(object):
         self.deleted_content = s.get_content()
         #print "deleted: "+str(offset)+" |"+self.deleted_content+'|'
 
-    def do(self):
+    def _get_size(self):
+        return self.SIZE+sys.getsizeof(self.deleted_content)
+    size = property(_get_size)
+
+    def apply(self):
         doc = self.document
         doc.delete(self.offset, self.length)
         doc.invalidate(self.offset)
 
-    def undo(self):
+    def revert(self):
         doc = self.document
         doc.insert(self.offset, self.deleted_content)
         doc.invalidate(self.offset)
 
 
+
+class BatchDelta(Delta):
+    """
+    Many edits to a document that get done and undone as one.
+
+    See Document.apply_edits() for the format of edits. Line-wise actions
+    like indenting a selection use this so that a 20k line selection is a
+    single change to the document instead of 20k of them.
+    """
+
+    def __init__(self, document, edits):
+        super(BatchDelta, self).__init__(document)
+        self.edits = []
+        for offset, length, text in edits:
+            if not isinstance(text, unicode):
+                text = text.decode(self.document.encoding, 'ignore')
+            self.edits.append((offset, length, normalise_line_endings(text)))
+        self.undo_edits = None
+
+    def _get_size(self):
+        size = self.SIZE
+        for edits in (self.edits, self.undo_edits or []):
+            for offset, length, text in edits:
+                size += sys.getsizeof(text)
+        return size
+    size = property(_get_size)
+
+    def apply(self):
+        if self.edits:
+            self.undo_edits = self.document.apply_edits(self.edits)
+
+    def revert(self):
+        if self.undo_edits:
+            self.document.apply_edits(self.undo_edits)
@@ -1,9 +1,13 @@
 import os
 import re
+import codecs
 import fnmatch
 import string
 import sys
+import tempfile
 import chardet
+from ni.core.text import normalise_line_endings
+from ni.core.mappedtext import MappedText
 
 
 def files_first(path):
@@ -49,6 +53,15 @@ TEXT_CHARACTERS = "".join(map(chr, range(32, 127)) + list("\n\r\t\b"))
 _NULL_TRANS = string.maketrans("", "")
 BLOCKSIZE = 512
 
+# files bigger than this get opened with map_textfile
+HUGE_FILE_SIZE = 32*1024*1024
+
+# how much of a huge file to look at when guessing its encoding
+SAMPLE_SIZE = 64*1024
+
+# how much TextFileLoader reads at a time
+LOAD_CHUNK_SIZE = 256*1024
+
 def is_textfile(filename, blocksize=BLOCKSIZE):
     """
     Read the first blocksize bytes from the file and analyse it with is_text.
@@ -139,6 +152,226 @@ def load_textfile(filename):
     finally:
         fle.close()
 
+class TextFileLoader(object):
+    """Reads a text file a chunk at a time.
+
+    Every call to read_chunk() reads the next chunk_size bytes and returns
+    them decoded and with normalised line endings, so the file can be loaded
+    bit by bit without blocking for the whole thing. The encoding gets
+    guessed from the first chunk. If a later chunk turns out not to be valid
+    in that encoding (like a utf8 guess for a latin-1 file that starts with
+    plain ascii), the rest of the file gets decoded with whatever chardet
+    makes of the offending chunk.
+
+    Parameters:
+    filename   -- The file to load.
+    chunk_size -- Number of bytes to read at a time.
+
+    Attributes:
+    encoding   -- Set once the first chunk got read.
+    linesep    -- '\r', '\r\n' or '\n' once the first line ending got read,
+                  None before that.
+    size       -- Size of the file in bytes.
+    bytes_read -- Number of bytes read so far.
+    is_done    -- The whole file got read (or loading got cancelled).
+
+    Properties:
+    progress   -- Fraction of the file that got read so far.
+
+    Methods:
+    read_chunk -- return the next chunk of text or None at the end
+    cancel     -- stop loading and close the file
+
+    Will raise:
+    BinaryFile() if the start of the file doesn't look like text
+    (see is_text())
+    """
+
+    def __init__(self, filename, chunk_size=LOAD_CHUNK_SIZE):
+        self.filename = filename
+        self.chunk_size = chunk_size
+        self.encoding = None
+        self.linesep = None
+        self.size = os.path.getsize(filename)
+        self.bytes_read = 0
+        self.is_done = False
+        self.cancelled = False
+
+        self._file = open(filename, 'rb')
+        self._decoder = None
+
+        # a \r at the end of a chunk might be half of a \r\n, so it waits
+        # for the next chunk
+        self._pending = u''
+
+    def _get_progress(self):
+        if not self.size:
+            return 1.0
+        return float(self.bytes_read)/self.size
+    progress = property(_get_progress)
+
+    def _detect_encoding(self, data):
+        if not is_text(data[:BLOCKSIZE]):
+            self.cancel()
+            raise BinaryFile()
+
+        # chardet can be quite slow, so just assume utf8 first
+        try:
+            data.decode('utf8')
+            return 'utf8'
+        except UnicodeDecodeError, e:
+            if e.start >= len(data)-3:
+                # just a character that got cut in half at the end
+                return 'utf8'
+        return chardet.detect(data)['encoding'] or 'latin-1'
+
+    def _decode(self, data, final):
+        if not self._decoder:
+            self.encoding = self._detect_encoding(data)
+            self._decoder = codecs.getincrementaldecoder(self.encoding)()
+
+        try:
+            return self._decoder.decode(data, final)
+        except UnicodeDecodeError:
+            pending = self._decoder.getstate()[0]
+            encoding = chardet.detect(pending+data)['encoding'] or 'latin-1'
+            self.encoding = encoding
+            self._decoder = codecs.getincrementaldecoder(encoding)('replace')
+            return self._decoder.decode(pending+data, final)
+
+    def read_chunk(self):
+        """
+        Return the next chunk of text or None when the whole file got read.
+
+        Chunks can be empty while the file isn't done yet.
+        """
+
+        if self.is_done:
+            return None
+
+        data = self._file.read(self.chunk_size)
+        self.bytes_read += len(data)
+        final = self.bytes_read >= self.size or not data
+
+        text = self._pending+self._decode(data, final)
+        self._pending = u''
+        if not final and text.endswith('\r'):
+            self._pending = u'\r'
+            text = text[:-1]
+
+        if not self.linesep:
+            match = re.search('\r\n|\r|\n', text)
+            if match:
+                self.linesep = str(match.group())
+
+        if final:
+            self.is_done = True
+            self._file.close()
+
+        return normalise_line_endings(text)
+
+    def cancel(self):
+        self.cancelled = True
+        self.is_done = True
+        self._file.close()
+
+def map_textfile(filename):
+    """
+    Return the same dict as load_textfile, but with a MappedText as 'content'
+    so that the file doesn't get read into memory.
+
+    The encoding and line separator are guessed from the start of the file.
+    Returns None if the file can't be mapped: when the encoding isn't one
+    that MappedText can handle or when the file uses \r line endings.
+
+    Will raise:
+    BinaryFile() if the file doesn't look like text (see is_text())
+    """
+
+    fle = open(filename, 'rb')
+    try:
+        sample = fle.read(SAMPLE_SIZE)
+    finally:
+        fle.close()
+
+    if not is_text(sample[:BLOCKSIZE]):
+        raise BinaryFile()
+
+    # don't let a character that got cut in half at the end spoil things
+    newline = sample.rfind('\n')
+    if newline != -1:
+        sample = sample[:newline+1]
+
+    try:
+        encoding = 'utf8'
+        sample.decode(encoding)
+    except UnicodeDecodeError:
+        encoding = chardet.detect(sample)['encoding']
+
+    try:
+        if u'\n\r'.encode(encoding) != '\n\r' or \
+           'utf-16' in encoding.lower() or 'utf-32' in encoding.lower():
+            return None
+    except (LookupError, TypeError):
+        return None
+
+    if '\r\n' in sample:
+        linesep = '\r\n'
+    elif '\n' in sample or not '\r' in sample:
+        linesep = '\n'
+    else:
+        return None
+
+    return {
+        'content': MappedText(filename, encoding),
+        'encoding': encoding,
+        'linesep': linesep,
+    }
+
+def write_textfile(filename, chunks, encoding, linesep='\n'):
+    """
+    Atomically replace the file at filename with the text in chunks.
+
+    chunks is an iterable of unicode strings with \n line endings. They get
+    converted to linesep and encoded one at a time into a temporary file in
+    the same directory. The temporary file is synced to disk and then renamed
+    over filename, so filename either has the old content or all of the new
+    content and never anything in between. The old file's permissions are
+    kept.
+    """
+
+    dirname = os.path.dirname(os.path.abspath(filename))
+    fd, path = tempfile.mkstemp(dir=dirname, prefix='.ni-')
+    try:
+        f = os.fdopen(fd, 'wb')
+        try:
+            # encodings like utf-16 only write a BOM at the very start
+            encoder = codecs.getincrementalencoder(encoding)()
+            for chunk in chunks:
+                if linesep != '\n':
+                    chunk = chunk.replace('\n', linesep)
+                f.write(encoder.encode(chunk))
+            f.write(encoder.encode(u'', True))
+            f.flush()
+            os.fsync(f.fileno())
+        finally:
+            f.close()
+
+        if os.path.exists(filename):
+            mode = os.stat(filename).st_mode & 07777
+        else:
+            # mkstemp() creates files that only the owner can read
+            umask = os.umask(0)
+            os.umask(umask)
+            mode = 0666 & ~umask
+        os.chmod(path, mode)
+
+        os.rename(path, filename)
+    except:
+        if os.path.exists(path):
+            os.unlink(path)
+        raise
+
 def filtered_files(rootpath, dirpath, exclude_globs, exclude_regulars,
                    exclude_hidden=False, match_func=None):
     """
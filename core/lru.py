@@ -0,0 +1,54 @@
+from collections import OrderedDict
+
+
+class LRUCache(object):
+    """A dictionary that only keeps the entries that were used most recently.
+
+    Getting or setting an entry makes it the most recently used one. Once
+    there are more entries than the budget the least recently used ones get
+    dropped.
+
+    Parameters:
+    budget -- Maximum number of entries to keep.
+
+    Methods:
+    get    -- return the value for a key or a default
+    clear  -- drop all the entries
+
+    """
+
+    def __init__(self, budget):
+        self.budget = budget
+        self._entries = OrderedDict()
+
+    def __len__(self):
+        return len(self._entries)
+
+    def __contains__(self, key):
+        return key in self._entries
+
+    def get(self, key, default=None):
+        """
+        Return the value for key (and make it the most recently used entry)
+        or default if it isn't in the cache.
+        """
+
+        entries = self._entries
+        try:
+            value = entries.pop(key)
+        except KeyError:
+            return default
+        entries[key] = value
+        return value
+
+    def __setitem__(self, key, value):
+        entries = self._entries
+        entries.pop(key, None)
+        entries[key] = value
+        while len(entries) > self.budget:
+            entries.popitem(last=False)
+
+    def clear(self):
+        """Drop all the entries."""
+
+        self._entries.clear()
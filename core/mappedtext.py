@@ -0,0 +1,361 @@
+import os
+import bisect
+import mmap
+import zlib
+import threading
+from ni.core.rope import Rope
+
+
+# files get indexed and decoded this many bytes (rounded up to the end of the
+# line) at a time
+BLOCK_SIZE = 64*1024
+
+# number of decoded blocks to keep around
+CACHED_BLOCKS = 16
+
+
+def normalise_block(text):
+    """
+    Convert a decoded block's line endings to \\n.
+
+    Blocks always end straight after a \\n, so a \\r\\n pair never gets split
+    between two blocks.
+    """
+
+    if '\r' in text:
+        text = text.replace('\r\n', '\n').replace('\r', '\n')
+    return text
+
+class MappedChunk(object):
+    """
+    One block of a MappedText that can be used as a chunk inside a Rope.
+
+    The text only gets decoded when something needs to look inside it. The
+    length and the number of newlines and tabs come from the MappedText's
+    index.
+    """
+
+    def __init__(self, mapped, block):
+        self.mapped = mapped
+        self.block = block
+
+    def __len__(self):
+        i = self.block
+        return self.mapped._char_starts[i+1]-self.mapped._char_starts[i]
+
+    def __unicode__(self):
+        return self.mapped._get_block(self.block)
+
+    def __getitem__(self, key):
+        return unicode(self)[key]
+
+    def __getslice__(self, i, j):
+        return unicode(self)[i:j]
+
+    def count(self, sub, start=None, end=None):
+        if start is None and end is None:
+            i = self.block
+            if sub == '\n':
+                return self.mapped._line_starts[i+1] - \
+                       self.mapped._line_starts[i]
+            if sub == '\t':
+                return self.mapped._tab_counts[i]
+        if start is None:
+            start = 0
+        if end is None:
+            end = len(self)
+        return unicode(self).count(sub, start, end)
+
+    def index(self, sub, start=0):
+        return unicode(self).index(sub, start)
+
+    def encode(self, encoding):
+        return unicode(self).encode(encoding)
+
+class MappedText(object):
+    """Read-only text that stays in a memory mapped file.
+
+    Only an index of where each block of the file starts (in bytes, in
+    characters and in lines) is kept in memory. The index is extended as far
+    as the queries so far needed, so reading the first lines only reads the
+    start of the file. Anything that needs the length or the number of lines
+    (like len(), num_lines, to_rope() or reading the last line) has to index
+    the whole file, so editors guess the number of lines with
+    estimate_num_lines() and index the rest a bit at a time with
+    extend_index() when they have nothing else to do. Blocks get decoded
+    when they are needed and only a few decoded blocks are kept around.
+
+    MappedText answers the same queries as Rope. Editing isn't possible, but
+    to_rope() returns a Rope that reads its chunks from this MappedText until
+    they get edited.
+
+    The index and the block cache are guarded by a lock, so one MappedText
+    can be shared by a document and snapshots of it that get read from
+    other threads.
+
+    The encoding has to store \\n as a single byte that doesn't appear inside
+    any other character. (So utf8, latin-1 and friends are fine, but utf-16
+    isn't.)
+
+    Parameters:
+    filename   -- The file to map.
+    encoding   -- The encoding to decode it with.
+    block_size -- Roughly how many bytes to index and decode at a time.
+
+    Attributes:
+    is_indexed     -- All of the file is in the index.
+
+    Methods:
+    get_text       -- return the text between two offsets
+    iter_chunks    -- yield the text between two offsets a block at a time
+    count_newlines -- return the number of newlines before an offset
+    count_tabs     -- return the number of tabs between two offsets
+    line_start     -- return the offset of the first character of a line
+    count_lines    -- return the number of lines, but no more than a limit
+    estimate_num_lines -- guess the number of lines from the part indexed
+                      so far
+    extend_index   -- add the next block to the index
+    checksum       -- return the adler32 checksum of the utf8 encoded text
+    copy           -- return self, since it never changes
+    to_rope        -- return a writable Rope of the same text
+
+    """
+
+    def __init__(self, filename, encoding='utf8', block_size=BLOCK_SIZE):
+        self.filename = filename
+        self.encoding = encoding
+        self.block_size = block_size
+
+        fle = open(filename, 'rb')
+        try:
+            if os.fstat(fle.fileno()).st_size:
+                self._map = mmap.mmap(fle.fileno(), 0,
+                                      access=mmap.ACCESS_READ)
+            else:
+                # empty files can't be mapped
+                self._map = ''
+        finally:
+            fle.close()
+        self._size = len(self._map)
+
+        # Block i goes from _byte_starts[i] to _byte_starts[i+1]. The other
+        # lists store the number of characters and newlines before block i
+        # and the number of tabs in block i.
+        self._byte_starts = [0]
+        self._char_starts = [0]
+        self._line_starts = [0]
+        self._tab_counts = []
+        self._complete = self._size == 0
+
+        self._cache = {}
+        self._cache_order = []
+        self._checksum = None
+        self._lock = threading.RLock()
+
+    def _get_num_blocks(self):
+        return len(self._byte_starts)-1
+    num_blocks = property(_get_num_blocks)
+
+    def _extend(self):
+        """Add the next block to the index."""
+
+        self._lock.acquire()
+        try:
+            if not self._complete:
+                self._extend_locked()
+        finally:
+            self._lock.release()
+
+    def _extend_locked(self):
+        start = self._byte_starts[-1]
+        end = start+self.block_size
+        if end >= self._size:
+            end = self._size
+        else:
+            # blocks always end straight after a newline
+            newline = self._map.find('\n', end-1)
+            if newline == -1:
+                end = self._size
+            else:
+                end = newline+1
+
+        text = normalise_block(self._map[start:end].decode(self.encoding,
+                                                           'replace'))
+        index = self.num_blocks
+        self._cache_block(index, text)
+        # num_blocks comes from _byte_starts, so that gets extended last
+        self._char_starts.append(self._char_starts[-1]+len(text))
+        self._line_starts.append(self._line_starts[-1]+text.count('\n'))
+        self._tab_counts.append(text.count('\t'))
+        self._byte_starts.append(end)
+
+        if end == self._size:
+            self._complete = True
+
+    def _extend_all(self):
+        while not self._complete:
+            self._extend()
+
+    def _get_is_indexed(self):
+        return self._complete
+    is_indexed = property(_get_is_indexed)
+
+    def extend_index(self):
+        """
+        Add the next block of the file to the index. Return True if there is
+        more of the file left to index.
+        """
+
+        self._extend()
+        return not self._complete
+
+    def _cache_block(self, index, text):
+        self._lock.acquire()
+        try:
+            if index in self._cache:
+                self._cache_order.remove(index)
+            self._cache[index] = text
+            self._cache_order.append(index)
+            if len(self._cache_order) > CACHED_BLOCKS:
+                del self._cache[self._cache_order.pop(0)]
+        finally:
+            self._lock.release()
+
+    def _get_block(self, index):
+        text = self._cache.get(index)
+        if text is None:
+            start = self._byte_starts[index]
+            end = self._byte_starts[index+1]
+            text = normalise_block(self._map[start:end].decode(self.encoding,
+                                                               'replace'))
+        self._cache_block(index, text)
+        return text
+
+    def _find_block(self, offset):
+        """Return the index of the block that contains offset."""
+
+        while not self._complete and self._char_starts[-1] <= offset:
+            self._extend()
+        index = bisect.bisect_right(self._char_starts, offset)-1
+        return min(index, self.num_blocks-1)
+
+    def __len__(self):
+        self._extend_all()
+        return self._char_starts[-1]
+
+    def __unicode__(self):
+        return self.get_text()
+
+    def _get_num_lines(self):
+        self._extend_all()
+        return self._line_starts[-1]+1
+    num_lines = property(_get_num_lines)
+
+    def count_lines(self, limit):
+        """
+        Return min(num_lines, limit) without indexing more of the file than
+        it takes to get to line limit.
+        """
+
+        while not self._complete and self._line_starts[-1] < limit:
+            self._extend()
+        return min(self._line_starts[-1]+1, limit)
+
+    def estimate_num_lines(self):
+        """
+        Return num_lines if all of the file is indexed or a guess based on
+        the lines per byte in the part that is.
+        """
+
+        if not self._complete and self.num_blocks == 0:
+            self._extend()
+        if self._complete:
+            return self._line_starts[-1]+1
+        indexed_bytes = self._byte_starts[-1]
+        estimate = self._line_starts[-1]*self._size//indexed_bytes
+        return max(estimate, self._line_starts[-1])+1
+
+    def copy(self):
+        return self
+
+    def iter_chunks(self, start=0, end=None):
+        start = max(start, 0)
+        if end is None:
+            end = len(self)
+        if start >= end or not self._size:
+            return
+
+        index = self._find_block(start)
+        while index < self.num_blocks or not self._complete:
+            if index == self.num_blocks:
+                self._extend()
+            block_start = self._char_starts[index]
+            if block_start >= end:
+                break
+            text = self._get_block(index)
+            yield text[max(start-block_start, 0):end-block_start]
+            index += 1
+
+    def get_text(self, start=0, end=None):
+        """Return the text from start up to (but not including) end."""
+
+        return u''.join(self.iter_chunks(start, end))
+
+    def count_newlines(self, offset):
+        """
+        Return the number of newlines before offset, which is also the number
+        of the line that offset is on.
+        """
+
+        if offset <= 0 or not self._size:
+            return 0
+        index = self._find_block(offset)
+        text = self._get_block(index)
+        block_offset = offset-self._char_starts[index]
+        return self._line_starts[index]+text.count('\n', 0, block_offset)
+
+    def count_tabs(self, start=0, end=None):
+        return sum(chunk.count('\t') for chunk in self.iter_chunks(start, end))
+
+    def line_start(self, y):
+        """Return the offset of the first character of line y."""
+
+        if y < 0:
+            raise IndexError("line out of range")
+        if y == 0:
+            return 0
+
+        # line y starts right after newline number y
+        while not self._complete and self._line_starts[-1] < y:
+            self._extend()
+        if self._line_starts[-1] < y:
+            raise IndexError("line out of range")
+
+        index = bisect.bisect_left(self._line_starts, y)-1
+        text = self._get_block(index)
+        pos = -1
+        for i in xrange(y-self._line_starts[index]):
+            pos = text.index('\n', pos+1)
+        return self._char_starts[index]+pos+1
+
+    def checksum(self):
+        """Return the adler32 checksum of the utf8 encoded text."""
+
+        if self._checksum is None:
+            checksum = zlib.adler32('')
+            for chunk in self.iter_chunks():
+                checksum = zlib.adler32(chunk.encode('utf8'), checksum)
+            self._checksum = checksum & 0xffffffff
+        return self._checksum
+
+    def to_rope(self):
+        """
+        Return a Rope with the same text.
+
+        This has to index the whole file, but the rope's chunks only get
+        decoded once something reads or edits them.
+        """
+
+        self._extend_all()
+        return Rope.from_chunks([MappedChunk(self, i)
+                                 for i in xrange(self.num_blocks)])
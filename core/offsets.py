@@ -0,0 +1,195 @@
+import bisect
+from array import array
+
+
+class OffsetArray(object):
+    """A sorted array of ints where everything after an index can be moved.
+
+    After an edit all the offsets past it move by the same amount. Instead
+    of adding that to every one of them the array keeps a gap index and a
+    delta: the values from the gap onwards are stored without the delta and
+    get it added when they are read. Moving the values after some other
+    index only has to fix up the ones between the old gap and the new one
+    (or the ones after the gap if there are fewer of those), so edits close
+    to each other stay cheap no matter how long the array is.
+
+    Reading a value or bisecting doesn't move the gap. Iterating, tolist()
+    and tostring() settle it at the end first, which takes linear time.
+
+    Parameters:
+    values      -- The values to start with. (They have to be in order for
+                   bisect_left and bisect_right.)
+    typecode    -- The typecode of the array that stores them.
+
+    Methods:
+    append       -- add a value at the end
+    extend       -- add values at the end
+    truncate     -- drop the values from an index onwards
+    replace      -- replace the values from one index up to another
+    shift        -- add a delta to all the values from an index onwards
+    bisect_left  -- bisect.bisect_left() for the values
+    bisect_right -- bisect.bisect_right() for the values
+    tolist       -- return the values as a list
+    tostring     -- return the values as array.tostring() does
+
+    """
+
+    def __init__(self, values=(), typecode='i'):
+        self._values = array(typecode, values)
+        # values from _gap onwards are off by _delta (which is 0 if there
+        # aren't any)
+        self._gap = len(self._values)
+        self._delta = 0
+
+    def _move_gap(self, index):
+        values = self._values
+        gap = self._gap
+        delta = self._delta
+        if delta and index < gap and len(values)-gap < gap-index:
+            # settling the values after the gap is less work
+            values[gap:] = array(values.typecode,
+                                 [value+delta for value in values[gap:]])
+            gap = len(values)
+        if gap == len(values):
+            delta = self._delta = 0
+        if not delta:
+            self._gap = index
+            return
+
+        if index < gap:
+            values[index:gap] = array(values.typecode,
+                                      [value-delta for value in
+                                       values[index:gap]])
+        elif index > gap:
+            values[gap:index] = array(values.typecode,
+                                      [value+delta for value in
+                                       values[gap:index]])
+        self._gap = index
+        if index == len(values):
+            self._delta = 0
+
+    def __len__(self):
+        return len(self._values)
+
+    def __getitem__(self, index):
+        values = self._values
+        if isinstance(index, slice):
+            start, stop, step = index.indices(len(values))
+            if step != 1:
+                return array(values.typecode,
+                             [self[i] for i in xrange(start, stop, step)])
+            part = values[start:stop]
+            if self._delta and stop > self._gap:
+                first = max(self._gap-start, 0)
+                part[first:] = array(values.typecode,
+                                     [value+self._delta for value in
+                                      part[first:]])
+            return part
+
+        if index < 0:
+            index += len(values)
+        value = values[index]
+        if index >= self._gap:
+            value += self._delta
+        return value
+
+    def __iter__(self):
+        self._move_gap(len(self._values))
+        return iter(self._values)
+
+    def __eq__(self, other):
+        if isinstance(other, OffsetArray):
+            other = other.tolist()
+        return self.tolist() == list(other)
+
+    def __ne__(self, other):
+        return not self == other
+
+    def __repr__(self):
+        return 'OffsetArray(%r)' % (self.tolist(),)
+
+    def append(self, value):
+        """Add value at the end."""
+
+        if self._gap == len(self._values):
+            self._gap += 1
+        else:
+            value -= self._delta
+        self._values.append(value)
+
+    def extend(self, values):
+        """Add the values in the iterable values at the end."""
+
+        if self._gap == len(self._values):
+            self._values.extend(values)
+            self._gap = len(self._values)
+        else:
+            delta = self._delta
+            self._values.extend([value-delta for value in values])
+
+    def truncate(self, index):
+        """Drop the values from index onwards."""
+
+        del self._values[index:]
+        if index <= self._gap:
+            self._gap = len(self._values)
+            self._delta = 0
+
+    def replace(self, i, j, values):
+        """
+        Replace the values from i up to (not including) j with the ones in
+        the sequence values.
+        """
+
+        delta = self._delta
+        if delta and i >= self._gap:
+            self._values[i:j] = array(self._values.typecode,
+                                      [value-delta for value in values])
+            return
+
+        if j > self._gap:
+            self._move_gap(j)
+        self._values[i:j] = array(self._values.typecode, values)
+        self._gap += len(values)-(j-i)
+
+    def shift(self, index, delta):
+        """Add delta to all the values from index onwards."""
+
+        if not delta or index >= len(self._values):
+            return
+        self._move_gap(index)
+        self._delta += delta
+
+    def bisect_left(self, x):
+        """
+        Return the index where x would go before any values equal to it.
+        """
+
+        values = self._values
+        gap = self._gap
+        if gap == len(values) or values[gap]+self._delta >= x:
+            return bisect.bisect_left(values, x, 0, gap)
+        return bisect.bisect_left(values, x-self._delta, gap+1)
+
+    def bisect_right(self, x):
+        """
+        Return the index where x would go after any values equal to it.
+        """
+
+        values = self._values
+        gap = self._gap
+        if gap == len(values) or values[gap]+self._delta > x:
+            return bisect.bisect_right(values, x, 0, gap)
+        return bisect.bisect_right(values, x-self._delta, gap+1)
+
+    def tolist(self):
+        """Return the values as a list."""
+
+        self._move_gap(len(self._values))
+        return self._values.tolist()
+
+    def tostring(self):
+        """Return the values as machine values. (see array.tostring)"""
+
+        self._move_gap(len(self._values))
+        return self._values.tostring()
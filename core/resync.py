@@ -0,0 +1,119 @@
+import re
+from pygments.token import Token
+
+
+# blank line followed by an unindented line
+SPLIT_POINT = re.compile(r'\n[^\S\n]*\n(?=\S)')
+
+# what block comments and strings (which lots of lexers let run over
+# newlines) start with and the token types they get
+MULTILINE_STARTS = [
+    (re.compile(r'/\*|<!--'), Token.Comment),
+    (re.compile(r'["\'`]'), Token.Literal),
+]
+
+class ResyncRule(object):
+    """Where lexing can safely start again in the middle of a text.
+
+    A Tokenizer uses these to decide where to start lexing after an edit
+    and where to cut a document into chunks that get lexed in parallel (see
+    find_split_points). Lexers that can't be resumed from a saved state
+    start again at a restart token a few tokens before the edit (see
+    Tokenizer._update_backtrack). Resumable lexers resume from the last
+    line before the edit that starts with a restart token (after the
+    indentation) in the root state (see is_resume_point), so for those a
+    restart token also mustn't be something a match that spans lines (like
+    a docstring or a block comment) could start with.
+
+    A window or a chunk of text that ends in the middle of such a match
+    gets it lexed as something else (a /* as two operators, say) and the
+    lines after that as code. Resumable lexers don't trust anything after
+    a token that starts like one of multiline_starts but isn't of its token
+    type in text that got cut short. (see Tokenizer._iter_lexed)
+
+    Parameters:
+    is_restart       -- Function that takes (tokentype, value, line_start) for
+                        a token and returns True if lexing can start again at
+                        that token. line_start says if the token is the first
+                        thing on its line (after the indentation for
+                        resumable lexers).
+    min_backtrack    -- Number of tokens to go back from the edit before
+                        looking for a restart token.
+    split_point      -- Regex that matches just before the places where
+                        chunks can start. The chunks start where the matches
+                        end.
+    multiline_starts -- List of (regex, token type) for the matches that
+                        can span lines: the regex matches at the start of
+                        one and its token is of that type. (Empty if the
+                        lexer's states keep track of all of those.)
+
+    """
+
+    def __init__(self, is_restart, min_backtrack=2, split_point=SPLIT_POINT,
+                 multiline_starts=MULTILINE_STARTS):
+        self.is_restart = is_restart
+        self.min_backtrack = min_backtrack
+        self.split_point = split_point
+        self.multiline_starts = multiline_starts
+
+# lexer name -> ResyncRule
+_rules = {}
+
+def register_resync_rule(lexer_names, rule):
+    """
+    Use rule for the lexers with the given names. (The name attribute of the
+    lexer, like 'Python' or 'HTML+Django/Jinja'.)
+    """
+
+    for name in lexer_names:
+        _rules[name] = rule
+
+def get_resync_rule(lexer):
+    """Return the ResyncRule for lexer."""
+
+    return _rules.get(getattr(lexer, 'name', None), DEFAULT_RULE)
+
+def is_restart_default(tokentype, value, line_start):
+    # anything at the start of a line that isn't indentation (indented lines
+    # are usually inside a block that the lexer has a state for), isn't in
+    # the middle of a string, a number or a comment, doesn't close a block
+    # and can't start a match that spans lines
+    if not line_start or not value or value[:1].isspace() or \
+       tokentype in Token.Literal or tokentype in Token.Comment or \
+       tokentype in Token.Error or value[:1] in u')]}':
+        return False
+    for regex, starts_type in MULTILINE_STARTS:
+        if regex.match(value):
+            return False
+    return True
+
+DEFAULT_RULE = ResyncRule(is_restart_default)
+
+# a top level def, class or decorator
+PYTHON_SPLIT_POINT = re.compile(r'\n(?=(?:def|class)\s|@)')
+
+# Python is resumable and the only matches that span lines are docstrings,
+# which start with the string (after the indentation), so the default works
+register_resync_rule(['Python'], ResyncRule(is_restart_default,
+                                            split_point=PYTHON_SPLIT_POINT))
+
+def is_restart_html(tokentype, value, line_start):
+    # the start of a tag
+    if tokentype in Token.Punctuation:
+        return value == '<'
+    # older lexers make the whole tag one token
+    if tokentype in Token.Name.Tag:
+        return value[:1] == '<'
+    return False
+
+register_resync_rule(['HTML', 'HTML+Django/Jinja'],
+                     ResyncRule(is_restart_html))
+
+def is_restart_css(tokentype, value, line_start):
+    return tokentype in Token.Punctuation and value == '}'
+
+# the line after one that ends a block
+CSS_SPLIT_POINT = re.compile(r'\}[^\S\n]*\n(?=\S)')
+
+register_resync_rule(['CSS'], ResyncRule(is_restart_css,
+                                         split_point=CSS_SPLIT_POINT))
@@ -0,0 +1,565 @@
+import random
+import zlib
+
+
+# size of the chunks that text gets cut into when a tree is built
+CHUNK_SIZE = 2048
+
+# chunks are edited in place until they grow past this size
+MAX_CHUNK_SIZE = 4096
+
+# largest prime below 2**16, as used by adler32
+ADLER_BASE = 65521
+
+
+class _Node(object):
+    """
+    A treap node holding a chunk of text.
+
+    Every node caches the length, number of newlines and number of tabs of its
+    own chunk and of its whole subtree, so offsets and line numbers can be
+    found by walking down from the root without looking at the text.
+
+    Nodes never change once they are built. Edits build new nodes along the
+    path they touch and share the rest of the tree, so copying a rope only
+    means copying a reference to its root.
+    """
+
+    __slots__ = ('left', 'right', 'priority', 'chunk', 'chunk_newlines',
+                 'chunk_tabs', 'length', 'newlines', 'tabs', 'chunk_checksum',
+                 'checksum', 'chunk_widths', 'widths')
+
+    def __init__(self, chunk, left=None, right=None, priority=None,
+                 chunk_newlines=None, chunk_tabs=None, chunk_checksum=None,
+                 chunk_widths=None):
+        if priority is None:
+            priority = random.random()
+        if chunk_newlines is None:
+            chunk_newlines = chunk.count('\n')
+        if chunk_tabs is None:
+            chunk_tabs = chunk.count('\t')
+
+        self.chunk = chunk
+        self.chunk_newlines = chunk_newlines
+        self.chunk_tabs = chunk_tabs
+        self.left = left
+        self.right = right
+        self.priority = priority
+
+        length = len(chunk)
+        newlines = chunk_newlines
+        tabs = chunk_tabs
+        if left:
+            length += left.length
+            newlines += left.newlines
+            tabs += left.tabs
+        if right:
+            length += right.length
+            newlines += right.newlines
+            tabs += right.tabs
+        self.length = length
+        self.newlines = newlines
+        self.tabs = tabs
+
+        # (adler32, number of bytes) tuples, only worked out when asked for
+        self.chunk_checksum = chunk_checksum
+        self.checksum = None
+
+        # (tab size, line widths) tuples (see _widths), also only worked out
+        # when asked for
+        self.chunk_widths = chunk_widths
+        self.widths = None
+
+def _with_children(node, left, right):
+    return _Node(node.chunk, left, right, node.priority, node.chunk_newlines,
+                 node.chunk_tabs, node.chunk_checksum, node.chunk_widths)
+
+def _adler32_combine(a, b, b_length):
+    """
+    Return the adler32 checksum of two strings joined together given the
+    checksum of each one and the length of the second one in bytes.
+
+    This is the same calculation as zlib's adler32_combine().
+    """
+
+    rem = b_length % ADLER_BASE
+    sum1 = a & 0xffff
+    sum2 = (rem*sum1) % ADLER_BASE
+    sum1 += (b & 0xffff) + ADLER_BASE - 1
+    sum2 += ((a >> 16) & 0xffff) + ((b >> 16) & 0xffff) + ADLER_BASE - rem
+    if sum1 >= ADLER_BASE:
+        sum1 -= ADLER_BASE
+    if sum1 >= ADLER_BASE:
+        sum1 -= ADLER_BASE
+    if sum2 >= ADLER_BASE << 1:
+        sum2 -= ADLER_BASE << 1
+    if sum2 >= ADLER_BASE:
+        sum2 -= ADLER_BASE
+    return sum1 | (sum2 << 16)
+
+def _checksum(node):
+    """
+    Return (adler32, number of bytes) for the utf8 encoded text of node's
+    subtree.
+
+    Results are stored on the nodes and nodes never change, so after an edit
+    only the nodes along the edited path have to be worked out again.
+    """
+
+    if not node:
+        return 1, 0
+
+    if node.checksum is None:
+        if node.chunk_checksum is None:
+            data = node.chunk.encode('utf8')
+            node.chunk_checksum = (zlib.adler32(data) & 0xffffffff, len(data))
+
+        checksum, length = _checksum(node.left)
+        for c, l in (node.chunk_checksum, _checksum(node.right)):
+            checksum = _adler32_combine(checksum, c, l)
+            length += l
+        node.checksum = (checksum, length)
+
+    return node.checksum
+
+def _chunk_widths(chunk, tab_size):
+    """Return the line widths (see _widths) of a single chunk."""
+
+    text = unicode(chunk)
+    lines = text.split('\n')
+    if '\t' in text:
+        extra = tab_size-1
+        widths = [len(line)+line.count('\t')*extra for line in lines]
+    else:
+        widths = map(len, lines)
+    if len(widths) == 1:
+        return (False, widths[0], 0, widths[0])
+    return (True, widths[0], max(widths[1:-1] or [0]), widths[-1])
+
+def _join_widths(a, b):
+    """Return the line widths of two pieces of text joined together."""
+
+    if a is None:
+        return b
+    if b is None:
+        return a
+    a_newline, a_first, a_widest, a_last = a
+    b_newline, b_first, b_widest, b_last = b
+    if not a_newline and not b_newline:
+        width = a_first+b_first
+        return (False, width, 0, width)
+    if not a_newline:
+        return (True, a_first+b_first, b_widest, b_last)
+    if not b_newline:
+        return (True, a_first, a_widest, a_last+b_first)
+    return (True, a_first, max(a_widest, a_last+b_first, b_widest), b_last)
+
+def _widths(node, tab_size):
+    """
+    Return (has newline, first, widest, last) for the text of node's subtree
+    where first and last are the widths of the text before the first and
+    after the last newline and widest is the width of the widest line in
+    between. Tabs take tab_size characters.
+
+    Like the checksums these get cached in the nodes, so after an edit only
+    the new nodes have to be worked out again.
+    """
+
+    if not node:
+        return None
+
+    if node.widths is None or node.widths[0] != tab_size:
+        if node.chunk_widths is None or node.chunk_widths[0] != tab_size:
+            node.chunk_widths = (tab_size,
+                                 _chunk_widths(node.chunk, tab_size))
+        widths = _join_widths(_widths(node.left, tab_size),
+                              node.chunk_widths[1])
+        widths = _join_widths(widths, _widths(node.right, tab_size))
+        node.widths = (tab_size, widths)
+
+    return node.widths[1]
+
+def _merge(a, b):
+    if not a:
+        return b
+    if not b:
+        return a
+    if a.priority > b.priority:
+        return _with_children(a, a.left, _merge(a.right, b))
+    else:
+        return _with_children(b, _merge(a, b.left), b.right)
+
+def _split(node, k):
+    """Split node into the first k characters and the rest."""
+
+    if not node:
+        return None, None
+
+    if node.left:
+        left_length = node.left.length
+    else:
+        left_length = 0
+
+    if k <= left_length:
+        left, right = _split(node.left, k)
+        return left, _with_children(node, right, node.right)
+
+    chunk = node.chunk
+    if k >= left_length+len(chunk):
+        left, right = _split(node.right, k-left_length-len(chunk))
+        return _with_children(node, node.left, left), right
+
+    # the split falls inside this node's chunk
+    i = k-left_length
+    left = _merge(node.left, _Node(chunk[:i]))
+    right = _merge(_Node(chunk[i:]), node.right)
+    return left, right
+
+def _pop_first(node):
+    """Return (first chunk, node without the first chunk)."""
+
+    if not node.left:
+        return node.chunk, node.right
+    chunk, left = _pop_first(node.left)
+    return chunk, _with_children(node, left, node.right)
+
+def _pop_last(node):
+    """Return (node without the last chunk, last chunk)."""
+
+    if not node.right:
+        return node.left, node.chunk
+    right, chunk = _pop_last(node.right)
+    return _with_children(node, node.left, right), chunk
+
+def _edit_chunk(node, start, end, text):
+    """
+    Replace the characters between start and end with text if that range
+    lies inside a single chunk and the chunk doesn't grow too big.
+
+    Returns the new node or None if the edit doesn't fit.
+    """
+
+    left = node.left
+    if left:
+        left_length = left.length
+    else:
+        left_length = 0
+
+    if left and end <= left_length:
+        new_left = _edit_chunk(left, start, end, text)
+        if new_left is None:
+            return None
+        return _with_children(node, new_left, node.right)
+
+    chunk = node.chunk
+    chunk_end = left_length+len(chunk)
+    if start >= left_length and end <= chunk_end:
+        i = start-left_length
+        j = end-left_length
+        new_length = len(chunk)-(j-i)+len(text)
+        if not new_length or new_length > MAX_CHUNK_SIZE:
+            return None
+        new_chunk = chunk[:i]+text+chunk[j:]
+        return _Node(new_chunk, left, node.right, node.priority)
+
+    if node.right and start >= chunk_end:
+        new_right = _edit_chunk(node.right, start-chunk_end, end-chunk_end,
+                                text)
+        if new_right is None:
+            return None
+        return _with_children(node, left, new_right)
+
+    return None
+
+def _build(text):
+    """Build a balanced tree from a string."""
+
+    chunks = []
+    for i in xrange(0, len(text), CHUNK_SIZE):
+        chunks.append(text[i:i+CHUNK_SIZE])
+    return _build_chunks(chunks)
+
+def _build_chunks(chunks):
+    """
+    Build a balanced tree from a list of chunks.
+
+    Random priorities are handed out in descending order from the top of the
+    tree down, which keeps the heap property while still looking like a
+    normal random treap to later edits.
+    """
+
+    if not chunks:
+        return None
+
+    def build(lo, hi):
+        if lo >= hi:
+            return None
+        mid = (lo+hi)//2
+        return _Node(chunks[mid], build(lo, mid), build(mid+1, hi))
+
+    root = build(0, len(chunks))
+
+    priorities = [random.random() for c in chunks]
+    priorities.sort(reverse=True)
+    level = [root]
+    i = 0
+    while level:
+        next_level = []
+        for node in level:
+            node.priority = priorities[i]
+            i += 1
+            if node.left:
+                next_level.append(node.left)
+            if node.right:
+                next_level.append(node.right)
+        level = next_level
+
+    return root
+
+def _iter_range(node, start, end):
+    """Yield the parts of the chunks between start and end in order."""
+
+    if not node or start >= end:
+        return
+
+    if node.left:
+        left_length = node.left.length
+    else:
+        left_length = 0
+
+    if start < left_length:
+        for chunk in _iter_range(node.left, start, end):
+            yield chunk
+
+    chunk = node.chunk
+    chunk_end = left_length+len(chunk)
+    if start < chunk_end and end > left_length:
+        i = max(start-left_length, 0)
+        j = min(end-left_length, len(chunk))
+        yield chunk[i:j]
+
+    if end > chunk_end:
+        for chunk in _iter_range(node.right, start-chunk_end,
+                                 end-chunk_end):
+            yield chunk
+
+
+class Rope(object):
+    """Text stored as a balanced tree of chunks.
+
+    Reading a range of text, finding a line by number or the line an offset
+    is on and editing the text all take O(log n) time and only touch the
+    chunks involved. Ropes are persistent: an edit builds a new root and
+    shares everything it didn't touch with the old one, so copy() is O(1).
+
+    Chunks don't have to be unicode strings. Anything that supports len(),
+    slicing, count(), index(), encode() and unicode() will do (see
+    ni.core.mappedtext), which makes it possible to build a rope over text
+    that hasn't been read yet. Slicing such a chunk must return unicode.
+
+    Parameters:
+    text -- The initial text.
+
+    Methods:
+    get_text       -- return the text between two offsets
+    iter_chunks    -- yield the text between two offsets a chunk at a time
+    insert         -- insert text at an offset
+    delete         -- delete a number of characters starting at an offset
+    count_newlines -- return the number of newlines before an offset
+    count_tabs     -- return the number of tabs between two offsets
+    line_start     -- return the offset of the first character of a line
+    checksum       -- return the adler32 checksum of the utf8 encoded text
+    max_line_width -- return the width of the widest line
+    copy           -- return a rope that shares this rope's text
+
+    """
+
+    def __init__(self, text=u''):
+        if not isinstance(text, unicode):
+            text = unicode(text)
+        self.root = _build(text)
+
+    @classmethod
+    def from_chunks(cls, chunks):
+        """Return a rope made up of chunks without copying them."""
+
+        rope = cls()
+        rope.root = _build_chunks([c for c in chunks if len(c)])
+        return rope
+
+    def __len__(self):
+        if self.root:
+            return self.root.length
+        return 0
+
+    def __unicode__(self):
+        return self.get_text()
+
+    def _get_num_lines(self):
+        if self.root:
+            return self.root.newlines+1
+        return 1
+    num_lines = property(_get_num_lines)
+
+    def copy(self):
+        rope = Rope()
+        rope.root = self.root
+        return rope
+
+    def get_text(self, start=0, end=None):
+        """Return the text from start up to (but not including) end."""
+
+        return u''.join(self.iter_chunks(start, end))
+
+    def iter_chunks(self, start=0, end=None):
+        length = len(self)
+        if end is None or end > length:
+            end = length
+        if start < 0:
+            start = 0
+        return _iter_range(self.root, start, end)
+
+    def _count(self, offset):
+        """Return (newlines, tabs) for the text before offset."""
+
+        newlines = 0
+        tabs = 0
+        node = self.root
+        while node:
+            left = node.left
+            if left:
+                if offset < left.length:
+                    node = left
+                    continue
+                offset -= left.length
+                newlines += left.newlines
+                tabs += left.tabs
+
+            chunk = node.chunk
+            if offset < len(chunk):
+                newlines += chunk.count('\n', 0, offset)
+                tabs += chunk.count('\t', 0, offset)
+                break
+
+            offset -= len(chunk)
+            newlines += node.chunk_newlines
+            tabs += node.chunk_tabs
+            node = node.right
+
+        return newlines, tabs
+
+    def count_newlines(self, offset):
+        """
+        Return the number of newlines before offset, which is also the number
+        of the line that offset is on.
+        """
+
+        return self._count(offset)[0]
+
+    def count_tabs(self, start=0, end=None):
+        if end is None:
+            end = len(self)
+        if start >= end:
+            return 0
+        return self._count(end)[1]-self._count(start)[1]
+
+    def line_start(self, y):
+        """Return the offset of the first character of line y."""
+
+        if y < 0 or y >= self.num_lines:
+            raise IndexError("line out of range")
+
+        # line y starts right after newline number y
+        offset = 0
+        node = self.root
+        while y:
+            left = node.left
+            if left:
+                if y <= left.newlines:
+                    node = left
+                    continue
+                y -= left.newlines
+                offset += left.length
+
+            chunk = node.chunk
+            if y <= node.chunk_newlines:
+                pos = -1
+                while y:
+                    pos = chunk.index('\n', pos+1)
+                    y -= 1
+                return offset+pos+1
+
+            y -= node.chunk_newlines
+            offset += len(chunk)
+            node = node.right
+
+        return offset
+
+    def checksum(self):
+        """
+        Return the adler32 checksum of the utf8 encoded text.
+
+        Checksums get cached in the tree, so this is cheap to call again after
+        an edit.
+        """
+
+        return _checksum(self.root)[0]
+
+    def max_line_width(self, tab_size):
+        """
+        Return the width of the widest line where each tab takes tab_size
+        characters.
+
+        Like checksums the widths get cached in the tree.
+        """
+
+        widths = _widths(self.root, tab_size)
+        if widths is None:
+            return 0
+        has_newline, first, widest, last = widths
+        return max(first, widest, last)
+
+    def _replace(self, start, end, text):
+        # try and edit a single chunk in place first
+        if self.root:
+            root = _edit_chunk(self.root, start, end, text)
+            if root:
+                self.root = root
+                return
+
+        left, rest = _split(self.root, start)
+        middle, right = _split(rest, end-start)
+
+        # Fold the neighbouring chunks in with the new text so that repeated
+        # edits don't leave behind lots of tiny chunks.
+        parts = []
+        if left:
+            left, before = _pop_last(left)
+            parts.append(unicode(before))
+        parts.append(text)
+        if right:
+            after, right = _pop_first(right)
+            parts.append(unicode(after))
+
+        self.root = _merge(_merge(left, _build(u''.join(parts))), right)
+
+    def insert(self, offset, text):
+        """Insert text at offset."""
+
+        if not text:
+            return
+        if not isinstance(text, unicode):
+            text = unicode(text)
+
+        offset = max(0, min(offset, len(self)))
+        self._replace(offset, offset, text)
+
+    def delete(self, offset, length):
+        """Delete length characters starting at offset."""
+
+        offset = max(0, offset)
+        end = min(offset+length, len(self))
+        if offset >= end:
+            return
+
+        self._replace(offset, end, u'')
@@ -14,7 +14,7 @@ class Selection(object):
     
     def get_content(self):
         selection = self.get_normalised()
-        return self.document.content[selection.start:selection.end+1]
+        return self.document.get_text(selection.start, selection.end+1)
     
     def line_in_selection(self, y, normalised=False):
         if normalised:
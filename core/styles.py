@@ -0,0 +1,46 @@
+from ni.core.tokenizer import token_type_id, token_type
+
+
+class StyleTable(object):
+    """Maps token types to the names of the styles they get drawn in.
+
+    The rules are a list of (tokentype, style) pairs and a token type gets
+    the style of the first rule that it is (a subtype of). That takes a few
+    subtype checks, so it only gets worked out once per token type: the
+    table is a list indexed by the ids that the Tokenizer stores its token
+    types as (see token_type_id), so looking up a token's style is one list
+    index. The list gets extended when token types show up that got their
+    id after the table was made.
+
+    Parameters:
+    rules     -- List of (tokentype, style) in the order they get checked.
+    default   -- The style of token types that no rule matches.
+
+    Methods:
+    get_style -- return the style for a token type
+
+    """
+
+    def __init__(self, rules, default='plain'):
+        self.rules = rules
+        self.default = default
+        self._styles = []
+
+    def _find_style(self, tokentype):
+        for rule_type, style in self.rules:
+            if tokentype in rule_type:
+                return style
+        return self.default
+
+    def __getitem__(self, type_id):
+        """Return the style for the token type with id type_id."""
+
+        styles = self._styles
+        while type_id >= len(styles):
+            styles.append(self._find_style(token_type(len(styles))))
+        return styles[type_id]
+
+    def get_style(self, tokentype):
+        """Return the style for tokentype."""
+
+        return self[token_type_id(tokentype)]
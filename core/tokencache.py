@@ -0,0 +1,166 @@
+import os
+import marshal
+import hashlib
+import tempfile
+import pygments
+
+
+# default number of bytes that a TokenCache keeps on disk
+TOKEN_CACHE_SIZE = 64*1024*1024
+
+# bump this whenever what Tokenizer stores in the cache changes
+CACHE_FORMAT = 1
+
+_caches = {}
+
+def get_token_cache(directory):
+    """
+    Return the TokenCache that lives in directory (or None if directory is
+    None). Documents that use the same directory share one TokenCache.
+    """
+
+    if not directory:
+        return None
+    cache = _caches.get(directory)
+    if cache is None:
+        cache = _caches[directory] = TokenCache(directory)
+    return cache
+
+def content_digest(chunks):
+    """Return the sha1 hex digest of the utf8 encoded text in chunks."""
+
+    digest = hashlib.sha1()
+    for chunk in chunks:
+        digest.update(chunk.encode('utf8'))
+    return digest.hexdigest()
+
+class TokenCache(object):
+    """Tokens that got lexed before, stored in files in a directory.
+
+    Every entry is one file named after a key that says which text got lexed
+    with which lexer (see make_key), so an entry never has to be checked
+    against the text: if the text or the lexer changes, the key changes too.
+    What gets stored is up to the Tokenizer. (see Tokenizer.save_to_cache)
+
+    Reading an entry touches its file, so the files' modification times say
+    when they were last used. Once the files add up to more than the budget
+    the ones that were used longest ago get deleted.
+
+    Parameters:
+    directory -- Where to keep the files. It gets made when the first entry
+                 is stored.
+    budget    -- Maximum number of bytes to keep.
+
+    Methods:
+    make_key  -- return the key for a text digest and a lexer
+    load      -- return the data stored under a key or None
+    store     -- store data under a key
+    evict     -- delete the least recently used files until the rest fit
+
+    """
+
+    def __init__(self, directory, budget=TOKEN_CACHE_SIZE):
+        self.directory = directory
+        self.budget = budget
+
+    def make_key(self, digest, lexer):
+        """
+        Return the key for a text with the given content_digest() lexed with
+        lexer.
+        """
+
+        lexer_class = type(lexer)
+        options = sorted(lexer.options.items())
+        description = "%s %s.%s %r %s %d" % (digest, lexer_class.__module__,
+            lexer_class.__name__, options, pygments.__version__, CACHE_FORMAT)
+        return hashlib.sha1(description).hexdigest()
+
+    def _get_path(self, key):
+        return os.path.join(self.directory, key+'.tokens')
+
+    def load(self, key):
+        """Return the data stored under key or None if there isn't any."""
+
+        path = self._get_path(key)
+        try:
+            fle = open(path, 'rb')
+            try:
+                data = marshal.load(fle)
+            finally:
+                fle.close()
+            os.utime(path, None)
+        except (IOError, OSError, EOFError, ValueError, TypeError):
+            return None
+        return data
+
+    def store(self, key, data):
+        """
+        Store data (anything marshal can handle) under key and evict old
+        entries if that takes the cache over its budget.
+
+        The cache only saves time, so if the directory can't be made or
+        written to (or the disk is full) nothing gets stored.
+        """
+
+        path = self._get_path(key)
+        try:
+            if os.path.exists(path):
+                # the same text got lexed the same way before
+                os.utime(path, None)
+                return
+
+            if not os.path.exists(self.directory):
+                os.makedirs(self.directory)
+
+            # readers never see half an entry
+            fd, temp_path = tempfile.mkstemp(dir=self.directory,
+                                             prefix='.ni-')
+            try:
+                fle = os.fdopen(fd, 'wb')
+                try:
+                    marshal.dump(data, fle)
+                finally:
+                    fle.close()
+                os.rename(temp_path, path)
+            except:
+                if os.path.exists(temp_path):
+                    os.unlink(temp_path)
+                raise
+
+            self.evict()
+        except (IOError, OSError):
+            return
+
+    def evict(self):
+        """
+        Delete the entries that were used the longest ago until the rest
+        fit in the budget.
+        """
+
+        try:
+            filenames = os.listdir(self.directory)
+        except OSError:
+            return
+
+        entries = []
+        total_size = 0
+        for filename in filenames:
+            if not filename.endswith('.tokens'):
+                continue
+            path = os.path.join(self.directory, filename)
+            try:
+                stat = os.stat(path)
+            except OSError:
+                continue
+            entries.append((stat.st_mtime, stat.st_size, path))
+            total_size += stat.st_size
+
+        entries.sort()
+        for mtime, size, path in entries:
+            if total_size <= self.budget:
+                break
+            try:
+                os.unlink(path)
+            except OSError:
+                pass
+            total_size -= size
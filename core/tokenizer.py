@@ -1,62 +1,517 @@
 import os
-import bisect
-from pygments.token import Token
-from pygments.lexers import get_lexer_by_name, get_lexer_for_filename, \
-    ClassNotFound
+import re
+import sys
+import fnmatch
+import itertools
+from array import array
+from pygments.token import Token, _TokenType
+from pygments.lexer import RegexLexer
+from pygments.lexers import find_lexer_class_by_name, \
+    find_lexer_class_for_filename, ClassNotFound
+from pygments.lexers._mapping import LEXERS
+from ni.core.tokencache import content_digest
+from ni.core.resync import get_resync_rule, SPLIT_POINT
+from ni.core.brackets import BracketIndex
+from ni.core.offsets import OffsetArray
 
 
-# TODO: these really have to be moved to another file and it should be made
-# to be pluggable
+# number of characters to read from the document at a time while lexing
+LEX_WINDOW = 16*1024
 
-def isbacktracetoken_default(ttype, tvalue):
-    return not ttype in Token.Literal
+# Tokenizer.start_parallel_lex() hands the text to the worker processes in
+# chunks of about this many characters
+PARALLEL_CHUNK_SIZE = 256*1024
 
-def isbackspacetoken_html(ttype, tvalue):
-    if not tvalue:
+# Token types get stored as small integers. (see token_type_id)
+_token_types = []
+_token_type_ids = {}
+
+def token_type_id(tokentype):
+    """Return the number that tokentype gets stored as."""
+
+    try:
+        return _token_type_ids[tokentype]
+    except KeyError:
+        type_id = len(_token_types)
+        _token_types.append(tokentype)
+        _token_type_ids[tokentype] = type_id
+        return type_id
+
+def token_type(type_id):
+    """Return the token type stored as type_id."""
+
+    return _token_types[type_id]
+
+# HACK! overrides should come from settings...
+LEXER_OVERRIDES = {
+    # assume django template
+    '.html': 'html+django',
+    # otherwise we end up with the annoying NumPy lexer..
+    '.py': 'python',
+}
+
+# lexer classes by file extension (or by file name for the names that some
+# lexer has its own pattern for)
+_lexer_classes = {}
+
+# (extension -> (module name, class name) for the extensions that exactly one
+# lexer claims, regex of all the other file name patterns), built from
+# pygments' lexer mapping the first time it is needed
+_lexer_patterns = None
+
+SIMPLE_PATTERN = re.compile(r'^\*(\.[^*?\[\].]+)$')
+
+def _get_lexer_patterns():
+    global _lexer_patterns
+    if _lexer_patterns is None:
+        extensions = {}
+        special = []
+        for class_name, (module_name, name, aliases, filenames, mimetypes) \
+                in LEXERS.iteritems():
+            for pattern in filenames:
+                match = SIMPLE_PATTERN.match(pattern)
+                if match:
+                    extensions.setdefault(match.group(1), set()).add(
+                        (module_name, class_name))
+                else:
+                    special.append(fnmatch.translate(pattern))
+        unambiguous = dict((extension, list(classes)[0])
+                           for extension, classes in extensions.iteritems()
+                           if len(classes) == 1)
+        _lexer_patterns = (unambiguous, re.compile('|'.join(special)))
+    return _lexer_patterns
+
+def find_lexer_class(filename):
+    """
+    Return the lexer class to use for the file at filename or None if there
+    isn't one.
+
+    The answer gets cached by file extension, so only the first file of each
+    kind has to be looked up. Extensions that exactly one lexer claims get
+    looked up in a map of extensions that is made from pygments' lexer
+    mapping without importing any lexer modules; only the module of the
+    lexer that is found gets imported. File names that some lexer has a
+    more specific pattern for (like Makefile or CMakeLists.txt) get cached
+    by their whole name and looked up by pygments.
+    """
+
+    basename = os.path.basename(filename)
+    extension = os.path.splitext(basename)[1]
+    extensions, special = _get_lexer_patterns()
+    if extension in LEXER_OVERRIDES or not special.match(basename):
+        key = extension
+    else:
+        key = basename
+
+    try:
+        return _lexer_classes[key]
+    except KeyError:
+        pass
+
+    lexer_class = None
+    if key in LEXER_OVERRIDES:
+        lexer_class = find_lexer_class_by_name(LEXER_OVERRIDES[key])
+    elif key in extensions:
+        module_name, class_name = extensions[key]
+        module = __import__(module_name, None, None, [class_name])
+        lexer_class = getattr(module, class_name)
+    else:
+        try:
+            lexer_class = find_lexer_class_for_filename(basename)
+        except ClassNotFound:
+            pass
+
+    _lexer_classes[key] = lexer_class
+    return lexer_class
+
+def get_lexer_for_location(filename):
+    """
+    Return the lexer to use for the file at filename or None if there isn't
+    one. (see find_lexer_class)
+    """
+
+    if not filename:
+        return None
+
+    lexer_class = find_lexer_class(filename)
+    if lexer_class is None:
+        return None
+    return lexer_class(stripnl=False, encoding='utf8')
+
+def is_resumable(lexer):
+    """
+    Return True if lexer is a plain RegexLexer, so lex_regex() can start it
+    in the middle of a text with a saved state stack.
+    """
+
+    if not isinstance(lexer, RegexLexer):
         return False
+    method = type(lexer).get_tokens_unprocessed
+    return method.im_func is RegexLexer.get_tokens_unprocessed.im_func
 
-    if ttype in Token.Name.Tag:
-        if tvalue == '>' or tvalue[0] == '<' and rvalue[-1] == '>':
-            return True
+def lex_regex(lexer, text, stack=('root',)):
+    """
+    Lex text with a RegexLexer, starting with the given state stack.
+
+    This does the same as RegexLexer.get_tokens_unprocessed(), but it also
+    yields a (pos, None, stack) checkpoint whenever a match ends at the start
+    of a line. Lexing can be resumed from any of those positions by passing
+    the stack back in.
+    """
+
+    pos = 0
+    tokendefs = lexer._tokens
+    statestack = list(stack)
+    statetokens = tokendefs[statestack[-1]]
+    while 1:
+        for rexmatch, action, new_state in statetokens:
+            m = rexmatch(text, pos)
+            if m:
+                if action is not None:
+                    if type(action) is _TokenType:
+                        yield pos, action, m.group()
+                    else:
+                        for item in action(lexer, m):
+                            yield item
+                pos = m.end()
+                if new_state is not None:
+                    # state transition
+                    if isinstance(new_state, tuple):
+                        for state in new_state:
+                            if state == '#pop':
+                                if len(statestack) > 1:
+                                    statestack.pop()
+                            elif state == '#push':
+                                statestack.append(statestack[-1])
+                            else:
+                                statestack.append(state)
+                    elif isinstance(new_state, int):
+                        # pop, but keep at least one state on the stack
+                        if abs(new_state) >= len(statestack):
+                            del statestack[1:]
+                        else:
+                            del statestack[new_state:]
+                    elif new_state == '#push':
+                        statestack.append(statestack[-1])
+                    else:
+                        assert False, "wrong state def: %r" % new_state
+                    statetokens = tokendefs[statestack[-1]]
+                if pos and text[pos-1] == '\n':
+                    yield pos, None, tuple(statestack)
+                break
+        else:
+            # nothing matched
+            try:
+                if text[pos] == '\n':
+                    # at EOL, reset state to "root"
+                    statestack = ['root']
+                    statetokens = tokendefs['root']
+                    yield pos, Token.Text, u'\n'
+                    pos += 1
+                    yield pos, None, ('root',)
+                    continue
+                yield pos, Token.Error, text[pos]
+                pos += 1
+            except IndexError:
+                break
 
+def is_resume_point(rule, stack, tokentype, value):
+    """
+    Return True if lexing can resume at a checkpoint with the given state
+    stack where the first token on the line after the indentation is
+    (tokentype, value), even after the text further on changed or got cut
+    short (at the end of a window or a chunk).
+
+    A match that spans lines doesn't leave checkpoints inside it, but
+    whether it matches can depend on text far ahead: a docstring is one
+    match once it is closed and a string state with a checkpoint on every
+    line while it isn't, and it can start with the blank lines before it.
+    So a checkpoint is only safe in the root state (lexers fall back to
+    other states when a long match didn't work) and where rule, the lexer's
+    ResyncRule, says lexing can start again.
+    """
+
+    return stack == ('root',) and rule.is_restart(tokentype, value, True)
+
+def is_cut_short(rule, tokentype, text, offset):
+    """
+    Return True if the token at offset in text could be the start of a
+    match that spans lines (see ResyncRule.multiline_starts) that didn't
+    work because text got cut short, so that nothing after it can be
+    trusted.
+    """
+
+    if tokentype in Token.Name:
+        return False
+    for regex, starts_type in rule.multiline_starts:
+        if not tokentype in starts_type and regex.match(text, offset):
+            return True
     return False
 
-def isbacktracetoken_css(ttype, tvalue):
-    return ttype in Token.Punctuation and tvalue == '}'
+def find_split_points(text, chunk_size=PARALLEL_CHUNK_SIZE,
+                      split_point=SPLIT_POINT):
+    """
+    Return the offsets where text can be cut into chunks of roughly
+    chunk_size characters for lex_chunk(), starting with 0 and ending with
+    len(text).
+
+    Chunks start where a match of split_point ends. (see ResyncRule) By
+    default that is an unindented line after a blank line, because that is
+    nearly always top level code where the lexer is in its root state. If
+    it isn't, Tokenizer.finish_parallel_lex() notices and fixes it up.
+    """
+
+    points = [0]
+    while True:
+        match = split_point.search(text, points[-1]+chunk_size)
+        if not match:
+            break
+        points.append(match.end())
+    points.append(len(text))
+    return points
+
+def lex_chunk(args):
+    """
+    Lex one chunk of a text in a worker process. (see
+    Tokenizer.start_parallel_lex)
+
+    args is (lexer class, lexer options, chunk text, offset of the chunk).
+    Token types can't be pickled as themselves, so the tokens come back with
+    local type ids and the list of token types they stand for as tuples of
+    names. The return value is (offset, end, starts, lengths, types, type
+    names, checkpoint offsets, checkpoint stacks, checkpoint indexes, last
+    resume point, cut short offsets) and the first checkpoint is always the
+    start of the chunk in the root state. The last resume point is the
+    index of the last checkpoint that the end of the chunk can't have
+    changed anything before. The cut short offsets are those of the tokens
+    that is_cut_short() is True for. (see is_resume_point)
+    """
+
+    lexer_class, options, text, base = args
+    lexer = lexer_class(**options)
+    rule = get_resync_rule(lexer)
+
+    starts = array('i')
+    lengths = array('i')
+    types = array('H')
+    type_names = []
+    type_ids = {}
+    checkpoint_offsets = [base]
+    checkpoint_stacks = [('root',)]
+    checkpoint_indexes = [0]
+    # the last checkpoint while its line is still indentation
+    checkpoint = None
+    resume = 0
+    cut_offsets = []
+    for offset, tokentype, value in lex_regex(lexer, text):
+        if tokentype is None:
+            if cut_offsets:
+                checkpoint = None
+            else:
+                checkpoint = len(checkpoint_offsets)
+            checkpoint_offsets.append(base+offset)
+            checkpoint_stacks.append(value)
+            checkpoint_indexes.append(len(starts))
+            continue
+
+        if checkpoint is not None:
+            if value.strip():
+                if is_resume_point(rule, checkpoint_stacks[checkpoint],
+                                   tokentype, value):
+                    resume = checkpoint
+                checkpoint = None
+            elif '\n' in value:
+                checkpoint = None
+        if is_cut_short(rule, tokentype, text, offset):
+            cut_offsets.append(base+offset)
+            checkpoint = None
+
+        # hack for python
+        if tokentype is Token.Name.Builtin.Pseudo and value == 'self':
+            tokentype = Token.Name.Builtin.Pseudo.Self
+        type_id = type_ids.get(tokentype)
+        if type_id is None:
+            type_id = type_ids[tokentype] = len(type_names)
+            type_names.append(tuple(tokentype))
+        starts.append(base+offset)
+        lengths.append(len(value))
+        types.append(type_id)
+
+    return (base, base+len(text), starts, lengths, types, type_names,
+            checkpoint_offsets, checkpoint_stacks, checkpoint_indexes, resume,
+            cut_offsets)
+
+def _names_to_token_type(names):
+    tokentype = Token
+    for name in names:
+        tokentype = getattr(tokentype, name)
+    return tokentype
+
+_lex_pool = None
+
+def get_lex_pool():
+    """
+    Return the multiprocessing pool that lexes in parallel or None if there
+    can't be one on this system.
+
+    The pool gets started the first time it is needed with one process per
+    CPU and then stays around.
+    """
+
+    global _lex_pool
+    if _lex_pool is None:
+        try:
+            import multiprocessing
+            _lex_pool = multiprocessing.Pool()
+        except (ImportError, OSError, NotImplementedError):
+            _lex_pool = False
+    return _lex_pool or None
+
+class TokenList(object):
+    """
+    The (tokentype, value) tuples of a Tokenizer as a read-only sequence.
+
+    Nothing gets stored here: the values are sliced out of the document when
+    they are asked for.
+    """
+
+    def __init__(self, tokenizer):
+        self.tokenizer = tokenizer
+
+    def __len__(self):
+        return len(self.tokenizer.starts)
+
+    def __getitem__(self, index):
+        if isinstance(index, slice):
+            return [self[i] for i in xrange(*index.indices(len(self)))]
+
+        tokenizer = self.tokenizer
+        if index < 0:
+            index += len(self)
+        if not 0 <= index < len(self):
+            raise IndexError("token index out of range")
+        start = tokenizer.starts[index]
+        end = start+tokenizer.lengths[index]
+        return (_token_types[tokenizer.types[index]],
+                tokenizer.document.get_text(start, end))
+
+    def __getslice__(self, i, j):
+        return self[max(0, i):max(0, j):]
+
+    def __iter__(self):
+        tokenizer = self.tokenizer
+        if not len(tokenizer.starts):
+            return
+        base = tokenizer.starts[0]
+        text = tokenizer.document.get_text(base, tokenizer.end)
+        for start, length, type_id in itertools.izip(tokenizer.starts,
+                                                     tokenizer.lengths,
+                                                     tokenizer.types):
+            start -= base
+            yield _token_types[type_id], text[start:start+length]
+
+    def __eq__(self, other):
+        if isinstance(other, TokenList):
+            other = list(other)
+        return list(self) == other
+
+    def __ne__(self, other):
+        return not self == other
+
+    def __repr__(self):
+        return list(self).__repr__()
 
 class Tokenizer(object):
     """
     Wraps a lexer and caches tokens and token offsets.
+
+    The tokens get stored as three parallel arrays: starts (the offset of
+    each token, an OffsetArray), lengths and types (token type ids, see
+    token_type_id()). That's about 10 bytes per token instead of a tuple, a
+    string and an int each. tokens is a TokenList that gives the (tokentype,
+    value) tuples and offsets is the same as starts.
+
+    For RegexLexers (see is_resumable()) the lexer's state stack gets saved
+    at the start of every line that doesn't start inside a token. After an
+    edit lexing resumes from the last checkpoint before the edit that a
+    longer match can't swallow (see is_resume_point) and stops as soon as it
+    reaches a checkpoint past the edit with the same state as the old one.
+    It also never resumes after a token that started a match that spans
+    lines but didn't get closed (see is_cut_short), because an edit after it
+    might close it. (So after one of those every edit lexes again from
+    there, but that only happens while a string or comment is open.)
+    From there on the cached tokens are still right and they just get moved
+    along by the number of characters that got inserted or deleted, which
+    the OffsetArrays of token and checkpoint offsets do lazily. Other
+    lexers backtrack a few tokens and lex from there.
+
+    The edits that happened since the last update are read from the
+    document's edit log. (see Document.map_offset)
+
+    Big documents can be lexed for the first time by a pool of worker
+    processes instead. (see start_parallel_lex)
+
+    Tokens can also be saved to a TokenCache and loaded from it the next time
+    the same text gets opened. (see load_from_cache and save_to_cache)
+
+    brackets is a BracketIndex of the brackets in the tokens. It gets told
+    about every range that got lexed again.
     """
     
     def __init__(self, document):        
         self.document = document
-        self.tokens = []
-        self.offsets = []        
+        self.starts = OffsetArray()
+        self.lengths = array('i')
+        self.types = array('H')
+        self.tokens = TokenList(self)
+        self.brackets = BracketIndex(self, token_type_id(Token.Punctuation))
         self.end = 0 # up to where we lexed last
+
+        # the document version that the tokens are for
+        self.version = document.version
+
+        # Checkpoint i says that lexing can resume at
+        # _checkpoint_offsets[i] with the state stack _checkpoint_stacks[i]
+        # and that the first token from there is tokens[_checkpoint_indexes[i]]
+        self._checkpoint_offsets = OffsetArray([0])
+        self._checkpoint_stacks = [('root',)]
+        self._checkpoint_indexes = OffsetArray([0])
+        # offsets of the tokens that is_cut_short() is True for
+        self._cut_offsets = OffsetArray()
+
+        # (snapshot, async result) while the worker processes are lexing
+        self._parallel = None
+
+        # load_from_cache() only looks in the cache once
+        self.checked_cache = False
+        # (document version, content_digest()) of the last text looked up
+        self._digest = None
         
-        if document.location:
-            filename = document.location
-            try:
-                # HACK! overrides should come from settings...
-                if os.path.splitext(filename)[1] == '.html':
-                    # assume django template
-                    self.lexer = get_lexer_by_name('html+django',
-                                                   stripnl=False,
-                                                   encoding='utf8')
-                elif os.path.splitext(filename)[1] == '.py':
-                    # otherwise we end up with the annoying NumPy lexer..
-                    self.lexer = get_lexer_by_name('python',
-                                                   stripnl=False,
-                                                   encoding='utf8')
-                else:
-                    self.lexer = get_lexer_for_filename(filename,
-                                                        stripnl=False,
-                                                        encoding='utf8')
-            except ClassNotFound:
-                self.lexer = None
-        else:
+        # huge documents don't get lexed
+        if document.is_huge:
             self.lexer = None
+        else:
+            self.lexer = get_lexer_for_location(document.location)
+        self.is_resumable = is_resumable(self.lexer)
+
+    def _get_offsets(self):
+        return self.starts
+    offsets = property(_get_offsets)
+
+    def _append(self, offset, tokentype, value):
+        # hack for python
+        if tokentype is Token.Name.Builtin.Pseudo and value == 'self':
+            tokentype = Token.Name.Builtin.Pseudo.Self
+        self.starts.append(offset)
+        self.lengths.append(len(value))
+        self.types.append(token_type_id(tokentype))
+
+    def _truncate(self, index):
+        """Drop the tokens from index onwards."""
+
+        self.starts.truncate(index)
+        del self.lengths[index:]
+        del self.types[index:]
     
     def update(self, from_offset=None, to_offset=None):
         """
@@ -65,86 +520,714 @@ class Tokenizer(object):
         This should only ever get used from inside Document.
         """
         
-        content = self.document.content
-        
         if not self.lexer:
-            self.tokens = [(Token.Text, content)]
-            self.offsets = [0]
+            # get_normalised_tokens() reads straight from the document
+            self.version = self.document.version
             return
-        
+
         # default to_offset to the end of the content
         if not to_offset:
-            to_offset = len(content)
+            to_offset = self.document.num_chars
+
+        if self.is_resumable:
+            self._update_resumable(from_offset, to_offset)
+        else:
+            self._update_backtrack(from_offset, to_offset)
+        self.version = self.document.version
+
+    def _get_damage(self):
+        """
+        Return (start, end, delta) for the part of the document that changed
+        since the tokens were made. (see Document.get_changed_range)
+        """
+
+        return self.document.get_changed_range(self.version)
+
+    def _reset(self):
+        self._truncate(0)
+        self.brackets.clear()
+        self.end = 0
+        self._checkpoint_offsets = OffsetArray([0])
+        self._checkpoint_stacks = [('root',)]
+        self._checkpoint_indexes = OffsetArray([0])
+        self._cut_offsets = OffsetArray()
+
+    def _find_cut_short(self, first_token, last_token, source=None):
+        """
+        Return the offsets of the tokens from first_token up to (but not
+        including) last_token that is_cut_short() is True for. The tokens are
+        in the document or in source, a snapshot of it.
+        """
+
+        rule = get_resync_rule(self.lexer)
+        offsets = []
+        if not rule.multiline_starts or first_token >= last_token:
+            return offsets
+
+        if source is None:
+            source = self.document
+        starts = self.starts
+        types = self.types
+        base = starts[first_token]
+        text = source.get_text(
+            base, starts[last_token-1]+self.lengths[last_token-1])
+        for regex, starts_type in rule.multiline_starts:
+            for match in regex.finditer(text):
+                offset = base+match.start()
+                index = starts.bisect_right(offset)-1
+                if starts[index] == offset and \
+                   is_cut_short(rule, _token_types[types[index]], text,
+                                match.start()):
+                    offsets.append(offset)
+        offsets.sort()
+        return offsets
+
+    def _can_resume_from(self, rule, i, limit):
+        """
+        Return True if lexing can resume from checkpoint i after the text
+        from limit onwards changed. (see is_resume_point)
+        """
+
+        if self._checkpoint_stacks[i] != ('root',):
+            return False
+        starts = self.starts
+        lengths = self.lengths
+        index = self._checkpoint_indexes[i]
+        while index < len(starts):
+            if starts[index]+lengths[index] > limit:
+                # the line changed
+                return False
+            tokentype, value = self.tokens[index]
+            if value.strip():
+                return is_resume_point(rule, self._checkpoint_stacks[i],
+                                       tokentype, value)
+            if '\n' in value:
+                # a blank line
+                return False
+            index += 1
+        return False
+
+    def _iter_lexed(self, pos, stack, source=None):
+        """
+        Lex the document (or source, a snapshot of it) from pos with the
+        given state stack and yield the tokens and checkpoints as lex_regex()
+        does, but with offsets in the document.
+
+        The text gets read LEX_WINDOW characters at a time. The window might
+        have cut a match short (or kept a match that spans lines from
+        matching at all), so only what comes before the last checkpoint in
+        it that lexing can resume at (see is_resume_point) and before
+        anything that could be such a match (see is_cut_short) gets yielded
+        and the rest gets lexed again as part of the next window.
+        """
+
+        doc = source or self.document
+        num_chars = doc.num_chars
+        rule = get_resync_rule(self.lexer)
+        window = LEX_WINDOW
+        while pos < num_chars:
+            end = min(pos+window, num_chars)
+            text = doc.get_text(pos, end)
+            if end == num_chars:
+                # nothing after this window can change how it gets lexed
+                for offset, tokentype, value in \
+                        lex_regex(self.lexer, text, stack):
+                    yield pos+offset, tokentype, value
+                return
+
+            pending = []
+            # the last checkpoint and its index in pending while its line
+            # is still indentation
+            checkpoint = None
+            resume = None
+            for offset, tokentype, value in lex_regex(self.lexer, text, stack):
+                if tokentype is None:
+                    if pos+offset >= end:
+                        break
+                    checkpoint = pos+offset, value, len(pending)
+                elif is_cut_short(rule, tokentype, text, offset):
+                    break
+                elif checkpoint:
+                    if value.strip():
+                        if is_resume_point(rule, checkpoint[1], tokentype,
+                                           value):
+                            # everything up to the checkpoint stays the same
+                            index = checkpoint[2]+1
+                            for item in pending[:index]:
+                                yield item
+                            del pending[:index]
+                            resume = checkpoint[:2]
+                        checkpoint = None
+                    elif '\n' in value:
+                        checkpoint = None
+                pending.append((pos+offset, tokentype, value))
+
+            if resume:
+                pos, stack = resume
+                window = LEX_WINDOW
+            else:
+                # one token (or state) fills the whole window or a match
+                # that spans lines got cut short
+                window *= 2
+
+    def _update_resumable(self, from_offset, to_offset):
+        damage = self._get_damage()
+        if damage is False or from_offset is None or not self.tokens:
+            self._reset()
+            damage = None
+            from_offset = 0
+
+        old_end = self.end
+        start = min(from_offset, old_end)
+        if damage:
+            damage_start, damage_end, delta = damage
+            start = min(start, damage_start)
+            # the tokens after the edits moved
+            old_end = max(old_end+delta, damage_end)
+        else:
+            damage_end, delta = start, 0
+
+        checkpoint_offsets = self._checkpoint_offsets
+        checkpoint_stacks = self._checkpoint_stacks
+        checkpoint_indexes = self._checkpoint_indexes
+
+        # resume from the last checkpoint before the edits that the edits
+        # can't have made part of a longer match
+        i = max(checkpoint_offsets.bisect_left(start)-1, 0)
+        if damage:
+            cut_offsets = self._cut_offsets
+            if len(cut_offsets) and cut_offsets[0] < start:
+                # the edits might close any of them
+                i = min(i, max(checkpoint_offsets.bisect_right(
+                    cut_offsets[0])-1, 0))
+            rule = get_resync_rule(self.lexer)
+            while i and not self._can_resume_from(rule, i, start):
+                i -= 1
+        token_index = checkpoint_indexes[i]
+
+        starts = array('i')
+        lengths = array('i')
+        types = array('H')
+        new_offsets = []
+        new_stacks = []
+        new_indexes = []
+
+        # the old checkpoint that the new tokens caught up with
+        converged = None
+        j = i+1
+        end = None
+        stacks = {}
+        for offset, tokentype, value in \
+                self._iter_lexed(checkpoint_offsets[i], checkpoint_stacks[i]):
+            if tokentype is not None:
+                # hack for python
+                if tokentype is Token.Name.Builtin.Pseudo and value == 'self':
+                    tokentype = Token.Name.Builtin.Pseudo.Self
+                starts.append(offset)
+                lengths.append(len(value))
+                types.append(token_type_id(tokentype))
+                continue
+
+            if offset >= damage_end and offset < old_end:
+                # did we get back to an old checkpoint in the same state?
+                old_offset = offset-delta
+                while j < len(checkpoint_offsets) and \
+                      checkpoint_offsets[j] < old_offset:
+                    j += 1
+                if j < len(checkpoint_offsets) and \
+                   checkpoint_offsets[j] == old_offset and \
+                   checkpoint_stacks[j] == value:
+                    converged = j
+                    break
+
+            new_offsets.append(offset)
+            new_stacks.append(stacks.setdefault(value, value))
+            new_indexes.append(token_index+len(starts))
+
+            if offset > to_offset and offset >= damage_end:
+                # lexed far enough
+                end = offset
+                break
+
+        if converged is None:
+            # nothing after the new tokens is valid
+            if end is None:
+                end = self.document.num_chars
+            self.starts.replace(token_index, len(self.starts), starts)
+            self.lengths[token_index:] = lengths
+            self.types[token_index:] = types
+            self.brackets.update(checkpoint_offsets[i], sys.maxint, 0,
+                                 token_index, len(self.starts))
+            self._cut_offsets.truncate(
+                self._cut_offsets.bisect_left(checkpoint_offsets[i]))
+            self._cut_offsets.extend(self._find_cut_short(token_index,
+                                                          len(self.starts)))
+            checkpoint_offsets.replace(i+1, len(checkpoint_offsets),
+                                       new_offsets)
+            checkpoint_stacks[i+1:] = new_stacks
+            checkpoint_indexes.replace(i+1, len(checkpoint_indexes),
+                                       new_indexes)
+            self.end = end
+            return
+
+        # keep the old tokens from the checkpoint we converged on and move
+        # them along
+        old_index = checkpoint_indexes[converged]
+        index_shift = token_index+len(starts)-old_index
+        self.starts.replace(token_index, old_index, starts)
+        self.lengths[token_index:old_index] = lengths
+        self.types[token_index:old_index] = types
+        self.brackets.update(checkpoint_offsets[i],
+                             checkpoint_offsets[converged], delta,
+                             token_index, token_index+len(starts))
+        cut_offsets = self._cut_offsets
+        first_cut = cut_offsets.bisect_left(checkpoint_offsets[i])
+        last_cut = cut_offsets.bisect_left(checkpoint_offsets[converged])
+        cut_offsets.shift(last_cut, delta)
+        cut_offsets.replace(first_cut, last_cut,
+                            self._find_cut_short(token_index,
+                                                 token_index+len(starts)))
+        self.starts.shift(token_index+len(starts), delta)
+        checkpoint_offsets.shift(converged, delta)
+        checkpoint_indexes.shift(converged, index_shift)
+        checkpoint_offsets.replace(i+1, converged, new_offsets)
+        checkpoint_stacks[i+1:converged] = new_stacks
+        checkpoint_indexes.replace(i+1, converged, new_indexes)
+        self.end += delta
+
+        if self.end <= to_offset and self.end < self.document.num_chars:
+            # the old tokens didn't go as far as to_offset, so carry on from
+            # where they end (the edits are taken care of)
+            self.version = self.document.version
+            self._update_resumable(self.end, to_offset)
+
+    def _get_is_lexing_in_parallel(self):
+        return self._parallel is not None
+    is_lexing_in_parallel = property(_get_is_lexing_in_parallel)
+
+    def start_parallel_lex(self, pool=None, chunk_size=PARALLEL_CHUNK_SIZE):
+        """
+        Start lexing all of the document in a multiprocessing pool (by
+        default the one from get_lex_pool()). Return False if this tokenizer
+        can't do that, in which case it should just be lexed the normal way.
+
+        The text of a snapshot gets cut into chunks at the lexer's split
+        points (see find_split_points and ResyncRule) and every chunk gets
+        lexed on its own as if it started in the root state. finish_parallel_lex()
+        then puts the chunks together.
+        """
+
+        if not self.is_resumable:
+            return False
+        if pool is None:
+            pool = get_lex_pool()
+            if pool is None:
+                return False
+
+        snapshot = self.document.snapshot()
+        text = snapshot.content
+        points = find_split_points(text, chunk_size,
+                                   get_resync_rule(self.lexer).split_point)
+        lexer_class = type(self.lexer)
+        options = self.lexer.options
+        chunks = [(lexer_class, options, text[start:end], start)
+                  for start, end in zip(points, points[1:])]
+        self._parallel = (snapshot, pool.map_async(lex_chunk, chunks))
+        return True
+
+    def finish_parallel_lex(self, timeout=None):
+        """
+        Wait up to timeout seconds (forever if it is None) for the worker
+        processes to finish and take their tokens. Return False if they
+        are still busy.
+
+        The end of a chunk might have cut a match short, so only the tokens
+        up to its last resume point (see lex_chunk) get used. From there the
+        text gets lexed again until the lexer catches up with one of the next
+        chunk's own checkpoints.
+
+        The tokens are for the snapshot that got lexed, so if the document
+        changed in the meantime the next update() fixes up the difference
+        like it would after any other edit.
+        """
+
+        if self._parallel is None:
+            return True
+        snapshot, result = self._parallel
+        result.wait(timeout)
+        if not result.ready():
+            return False
+        self._parallel = None
+
+        try:
+            chunks = result.get()
+        except Exception:
+            # leave it to the normal lexing
+            return True
+
+        self._reset()
+        stacks = {}
+        num_chars = snapshot.num_chars
+        for (base, end, starts, lengths, types, type_names, chunk_offsets,
+             chunk_stacks, chunk_indexes, resume, cut_offsets) in chunks:
+            if self.end >= end:
+                # relexing a boundary already went past this whole chunk
+                continue
+            if base == 0:
+                first = 0
+            else:
+                first = self._lex_boundary(snapshot, chunk_offsets,
+                                           chunk_stacks, end)
+                if first is None:
+                    continue
+
+            if end == num_chars:
+                # nothing got cut off the last chunk
+                last = len(chunk_offsets)
+                token_end = len(starts)
+            elif resume > first:
+                last = resume+1
+                token_end = chunk_indexes[resume]
+                end = chunk_offsets[resume]
+            else:
+                # lex the rest of it along with the next boundary
+                continue
+
+            type_ids = [token_type_id(_names_to_token_type(names))
+                        for names in type_names]
+            token_index = chunk_indexes[first]
+            shift = len(self.starts)-token_index
+            self.starts.extend(starts[token_index:token_end])
+            self.lengths.extend(lengths[token_index:token_end])
+            self.types.extend(array('H', [type_ids[type_id] for type_id in
+                                          types[token_index:token_end]]))
+            self._checkpoint_offsets.extend(chunk_offsets[first+1:last])
+            self._checkpoint_stacks.extend([stacks.setdefault(stack, stack)
+                                            for stack in
+                                            chunk_stacks[first+1:last]])
+            self._checkpoint_indexes.extend([index+shift for index in
+                                             chunk_indexes[first+1:last]])
+            self._cut_offsets.extend([offset for offset in cut_offsets
+                                      if chunk_offsets[first] <= offset < end])
+            self.end = end
+
+        self.version = snapshot.version
+        return True
+
+    def _lex_boundary(self, snapshot, chunk_offsets, chunk_stacks, end):
+        """
+        Lex snapshot from the last checkpoint so far until a checkpoint
+        agrees with one of the next chunk's and return that checkpoint's
+        index in chunk_offsets. Return None if the lexer got to the end of
+        the chunk (which is at end) without that happening.
+        """
+
+        self._truncate(self._checkpoint_indexes[-1])
+        self._cut_offsets.truncate(
+            self._cut_offsets.bisect_left(self._checkpoint_offsets[-1]))
+        first_token = len(self.starts)
+        chunk_checkpoints = dict((offset, i) for i, offset in
+                                 enumerate(chunk_offsets))
+        for offset, tokentype, value in \
+                self._iter_lexed(self._checkpoint_offsets[-1],
+                                 self._checkpoint_stacks[-1], snapshot):
+            if tokentype is not None:
+                self._append(offset, tokentype, value)
+                continue
+
+            self._checkpoint_offsets.append(offset)
+            self._checkpoint_stacks.append(value)
+            self._checkpoint_indexes.append(len(self.starts))
+            i = chunk_checkpoints.get(offset)
+            if i is not None and chunk_stacks[i] == value:
+                break
+            if offset >= end:
+                self.end = offset
+                i = None
+                break
+        else:
+            self.end = snapshot.num_chars
+            i = None
+
+        self._cut_offsets.extend(self._find_cut_short(
+            first_token, len(self.starts), snapshot))
+        return i
+
+    def _get_cache_key(self, cache):
+        doc = self.document
+        if not self._digest or self._digest[0] != doc.version:
+            digest = content_digest(doc.snapshot().iter_chunks())
+            self._digest = (doc.version, digest)
+        return cache.make_key(self._digest[1], self.lexer)
+
+    def load_from_cache(self, cache):
+        """
+        Replace the tokens with the ones that cache has for the document's
+        text and return True, or return False if it doesn't have any.
+        """
+
+        self.checked_cache = True
+        if not self.lexer:
+            return False
+
+        data = cache.load(self._get_cache_key(cache))
+        if not data:
+            return False
+        try:
+            (type_names, starts, lengths, types, checkpoint_offsets,
+             checkpoint_indexes, stacks, checkpoint_stack_ids, end) = data
+            starts = array('i', starts)
+            lengths = array('i', lengths)
+            types = array('H', types)
+            checkpoint_offsets = array('i', checkpoint_offsets)
+            checkpoint_indexes = array('i', checkpoint_indexes)
+            checkpoint_stack_ids = array('i', checkpoint_stack_ids)
+        except (TypeError, ValueError):
+            return False
+        if end != self.document.num_chars or \
+           not len(starts) == len(lengths) == len(types) or \
+           not len(checkpoint_offsets) == len(checkpoint_indexes) == \
+               len(checkpoint_stack_ids):
+            return False
+
+        # the token type ids in this process can be different
+        type_ids = [token_type_id(_names_to_token_type(names))
+                    for names in type_names]
+        if type_ids != range(len(type_ids)):
+            types = array('H', [type_ids[type_id] for type_id in types])
+
+        self.starts = OffsetArray(starts)
+        self.lengths = lengths
+        self.types = types
+        self.brackets.clear()
+        self._checkpoint_offsets = OffsetArray(checkpoint_offsets)
+        self._checkpoint_indexes = OffsetArray(checkpoint_indexes)
+        self._checkpoint_stacks = [stacks[i] for i in checkpoint_stack_ids]
+        self._cut_offsets = OffsetArray(self._find_cut_short(0, len(starts)))
+        self.end = end
+        self.version = self.document.version
+        return True
+
+    def save_to_cache(self, cache):
+        """
+        Store the tokens in cache if all of the document is lexed and they
+        are up to date.
+        """
+
+        doc = self.document
+        if not self.lexer or self.version != doc.version or \
+           self.end < doc.num_chars:
+            return
+
+        stacks = list(set(self._checkpoint_stacks))
+        stack_ids = dict((stack, i) for i, stack in enumerate(stacks))
+        data = ([tuple(tokentype) for tokentype in _token_types],
+                self.starts.tostring(),
+                self.lengths.tostring(),
+                self.types.tostring(),
+                self._checkpoint_offsets.tostring(),
+                self._checkpoint_indexes.tostring(),
+                stacks,
+                array('i', [stack_ids[stack] for stack in
+                            self._checkpoint_stacks]).tostring(),
+                self.end)
+        cache.store(self._get_cache_key(cache), data)
+
+    def _update_backtrack(self, from_offset, to_offset):
+        """
+        Update the tokens by backtracking a few tokens from from_offset and
+        lexing from there to to_offset. Everything after from_offset gets
+        thrown away.
+
+        Lexing starts again at a restart token (see ResyncRule) outside of
+        any brackets, but the lexer doesn't have to be in its root state
+        there: the C lexer is in the middle of a statement until the next ;,
+        so a function after a block that got its { deleted isn't one. A
+        restart token on a line before the edit only gets used if lexing from
+        it gives the same tokens as before up to the edit. Otherwise the
+        lexer starts at an earlier one and that only has to give the same
+        tokens up to the one that didn't work.
+
+        Like _update_resumable() this never starts again after a token that
+        started a match that spans lines but didn't get closed (see
+        is_cut_short): the edit might have closed it or it might only look
+        open because the last update stopped at to_offset.
+        """
+
+        content = self.document.content
         
-        if not self.tokens:
+        if not self.starts:
             # if we haven't lexed before, make sure we take the long path
             from_offset = None
 
         if from_offset == None:
-            # lex everything
-            from_offset = 0
+            # lex everything up to to_offset
             self.end = 0
-            self.tokens = []
-            self.offsets = []
+            self._truncate(0)
+            self.brackets.clear()
+            self._cut_offsets = OffsetArray()
             
-            code = content
+            first_token = 0
+            start = 0
+            tokens = self.lexer.get_tokens_unprocessed(
+                content[:to_offset+1])
         
         else:
             # make sure from_offset is actually inside the bit that we already
             # have cached
-            if self.offsets:
-                last_offset = self.offsets[-1]
+            if self.starts:
+                last_offset = self.starts[-1]
             else:
                 last_offset = 0
             from_offset = min(last_offset, from_offset)
             
-            # HACK!
-            # Try and "snap" to a token (previous non-literal token, at least
-            # two back)
-            if self.lexer.name in ('HTML', 'HTML+Django/Jinja'):
-                isbacktracetoken = isbacktracetoken_html
-            elif self.lexer.name == 'CSS':
-                isbacktracetoken = isbacktracetoken_css
+            # the tokens that end before from_offset are still right (the
+            # one before the first token after it might have been edited)
+            num_valid = max(self.starts.bisect_left(from_offset)-1, 0)
+            if num_valid < len(self.starts):
+                valid_end = self.starts[num_valid]
             else:
-                isbacktracetoken = isbacktracetoken_default
+                valid_end = self.end
+            self.brackets.update(valid_end, sys.maxint, 0, num_valid,
+                                 num_valid)
+            self._truncate(num_valid)
             
-            index = bisect.bisect_left(self.offsets, from_offset)
-            index -= 2
-            if index < 0:
-                index = 0
-            else:
-                while index:
-                    tokentype, value = self.tokens[index]
-                    if isbacktracetoken(tokentype, value):
-                        break
-                    index -= 1
+            # sanity
+            if to_offset < valid_end:
+                to_offset = valid_end
             
-            # set self.end, self.tokens and self.offsets (frop the bits from 
-            # the cache that we are replacing, basically)
-            from_offset = self.offsets[index]
-            self.end = self.offsets[index]
-            self.tokens = self.tokens[:index]
-            self.offsets = self.offsets[:index]
+            # Try and "snap" to a token that the lexer can start again at
+            # (see ResyncRule)
+            rule = get_resync_rule(self.lexer)
+            index = min(num_valid+1-rule.min_backtrack, num_valid-1)
+            # (on an earlier line, so there's at least a line to check)
+            line_offset = content.rfind(u'\n', 0, from_offset)+1
+            index = min(index, self.starts.bisect_left(line_offset)-1)
+            cut_offsets = self._cut_offsets
+            if len(cut_offsets) and cut_offsets[0] < from_offset:
+                index = min(index, self.starts.bisect_left(cut_offsets[0]))
             
-            # sanity
-            if to_offset < from_offset:
-                to_offset = from_offset
+            # the tokens from the restart token up to num_checked have to
+            # come out the same when lexing from there
+            num_checked = num_valid
+            while True:
+                if index <= 0:
+                    index = 0
+                    start = 0
+                else:
+                    while index:
+                        tokentype, value = self.tokens[index]
+                        start = self.starts[index]
+                        line_start = \
+                            self.document.get_text(start-1, start) == u'\n'
+                        # the lexer is only in its root state outside
+                        # brackets (a function body is a state of its own
+                        # in C, say)
+                        if rule.is_restart(tokentype, value, line_start) and \
+                           not self.brackets.depth(start):
+                            break
+                        index -= 1
+                    else:
+                        start = 0
+                tokens = self.lexer.get_tokens_unprocessed(
+                    content[start:to_offset+1])
+                if not index:
+                    # the start of the text is always a good place to start
+                    first_token = 0
+                    break
+                
+                for i in xrange(index, num_checked):
+                    token = next(tokens, None)
+                    if token is None or \
+                       token[0] != self.starts[i]-start or \
+                       (token[1], token[2]) != self.tokens[i]:
+                        break
+                else:
+                    first_token = num_checked
+                    break
+                num_checked = index
+                index -= 1
             
-            # cut the visible portion
-            code = content[from_offset:to_offset+1]
+            # drop the tokens that we are replacing and set self.end
+            if first_token < len(self.starts):
+                self.end = self.starts[first_token]
+            else:
+                self.end = valid_end
+            self._truncate(first_token)
+            cut_offsets.truncate(cut_offsets.bisect_left(self.end))
         
         # lex the code fragment and add the tokens and their corresponding
         # starting offsets (while caching the end position)
         
-        for tokentype, value in self.lexer.get_tokens(code):
-            # hack for python
-            if tokentype is Token.Name.Builtin.Pseudo and value == 'self':
-                tokentype = Token.Name.Builtin.Pseudo.Self
+        from_offset = self.end
+        for offset, tokentype, value in tokens:
+            self._append(start+offset, tokentype, value)
+            self.end += len(value)
+        self.brackets.update(from_offset, sys.maxint, 0, first_token,
+                             len(self.starts))
+        self._cut_offsets.extend(self._find_cut_short(first_token,
+                                                      len(self.starts)))
 
-            self.tokens.append((tokentype, value))
-            self.offsets.append(self.end)
+    def get_line_tokens(self, from_line, to_line, styles=None):
+        """
+        Return a list with the tokens of every line from from_line to
+        to_line as (tokentype, start, end) where start and end are the
+        columns (in characters, not counting tabs specially) of the part of
+        the token that is on that line. The line endings aren't included.
+
+        If styles (a StyleTable) is given, the spans have the names of the
+        styles to draw the tokens in instead of their types.
 
-            self.end += len(value.replace('\t', ' '*self.document.tab_size))
+        Like get_normalised_tokens() this only reads the cached tokens.
+        The first token gets found with one bisect and the rest by walking
+        on from there, so a token that spans lines (like a docstring) just
+        shows up on each of its lines. Nothing gets sliced out of the text.
+        Whatever didn't get lexed yet comes back as Token.Text.
+        """
+
+        doc = self.document
+        to_line = min(to_line, doc.num_lines-1)
+        starts = self.starts
+        lengths = self.lengths
+        types = self.types
+        num_tokens = len(starts)
+        if self.lexer:
+            lexed_end = self.end
+        else:
+            lexed_end = 0
+        if styles is None:
+            lookup = _token_types
+        else:
+            lookup = styles
+        text = lookup[token_type_id(Token.Text)]
+
+        lines = []
+        index = None
+        for y in xrange(from_line, to_line+1):
+            line_start, line_end = doc._get_line_range(y)
+            spans = []
+            covered = line_start
+            if line_start < lexed_end and num_tokens:
+                if index is None:
+                    index = max(starts.bisect_right(line_start)-1, 0)
+                while index < num_tokens and starts[index] < line_end:
+                    token_start = starts[index]
+                    token_end = token_start+lengths[index]
+                    span_start = max(token_start, line_start)
+                    span_end = min(token_end, line_end)
+                    if span_end > span_start:
+                        spans.append((lookup[types[index]],
+                                      span_start-line_start,
+                                      span_end-line_start))
+                        covered = span_end
+                    if token_end > line_end:
+                        # it carries on on the next line
+                        break
+                    index += 1
+            if covered < line_end:
+                spans.append((text, covered-line_start, line_end-line_start))
+            lines.append(spans)
+        return lines
 
     def get_normalised_tokens(self, from_line, to_line):
         """
@@ -154,11 +1237,13 @@ class Tokenizer(object):
         
         It typically gets used in drawing routines and should only be called
         after update(), because it doesn't update the tokens itself - it just
-        reads from the cached tokens and offsets.
+        reads from the cached tokens and offsets. Whatever didn't get lexed
+        yet comes back as one plain text token.
         """
         
-        tokens = self.tokens
-        offsets = self.offsets
+        starts = self.starts
+        lengths = self.lengths
+        types = self.types
         
         sy = from_line
         start_offset = self.document.cursor_pos_to_offset((sy, 0))
@@ -169,35 +1254,39 @@ class Tokenizer(object):
             # it didn't get adjusted, so we're not at the end of the file, 
             # therefore we should go to the start of the previous line
             end_offset -= 1
+
+        # everything gets sliced out of this
+        text = self.document.get_text(start_offset, end_offset+1)
+        
+        if not self.lexer or start_offset >= self.end or not starts:
+            # without a lexer (or before the lexer got this far) everything
+            # is one big text token
+            return [(Token.Text, text)]
+
+        # the part that didn't get lexed yet is plain text
+        unlexed = None
+        if end_offset >= self.end:
+            unlexed = (Token.Text, text[self.end-start_offset:])
+            end_offset = self.end-1
         
         # get the token index that contains the start offset
-        start_index = bisect.bisect_left(offsets, start_offset)
-        if start_index and \
-        start_index >= len(offsets) or offsets[start_index] > start_offset:
-            start_index -= 1
+        start_index = starts.bisect_right(start_offset)-1
+        if start_index < 0:
+            start_index = 0
         
         # get the token index that contains the end offset
-        end_index = bisect.bisect_left(offsets, end_offset)        
-        if end_index and \
-        end_index >= len(offsets) or offsets[end_index] > end_offset:
-            end_index -= 1
-        
-        # chop the tokens to only include the ones we're interested in
-        ntokens = tokens[start_index:end_index+1]
-        
-        # chop the first token if it extends out of the screen        
-        if offsets[start_index] < start_offset:
-            start_skip = start_offset - offsets[start_index]
-            ttype, tvalue = ntokens[0]
-            ntokens[0] = (ttype, tvalue[start_skip:])
-        
-        # chop the last token if it extens out of the screen
-        if offsets[end_index] > end_offset:
-            end_skip = offsets[end_index] - end_offset                
-            ttype, tvalue = ntokens[-1]
-            ntokens[-1] = (ttype, tvalue[:-end_skip])
-        
-        # NOTE: I'm pretty sure there's an edge case here involving very long
-        # tokens, but I can't recreate it right now..
+        end_index = starts.bisect_right(end_offset)-1
+        
+        # slice the tokens out of the text, chopping the first and the last
+        # ones if they extend out of the screen
+        ntokens = []
+        for i in xrange(start_index, end_index+1):
+            token_start = max(starts[i], start_offset)-start_offset
+            token_end = min(starts[i]+lengths[i], end_offset+1)-start_offset
+            ntokens.append((_token_types[types[i]],
+                            text[token_start:token_end]))
+
+        if unlexed:
+            ntokens.append(unlexed)
         
         return ntokens
@@ -0,0 +1,108 @@
+from collections import deque
+
+
+# default number of bytes of history to keep per stack
+UNDO_BUDGET = 16*1024*1024
+
+# rough size of an action object with its attributes dict
+ACTION_SIZE = 600
+
+
+class UndoStack(object):
+    """Undo/redo history that is limited by memory rather than entries.
+
+    UndoStack can be used wherever a Stack is used. Every pushed action gets
+    an estimated size (see action_size()) and once the total goes over the
+    budget the oldest actions fall off the bottom. The actions are kept in a
+    deque, which works as a ring buffer, so dropping the oldest one is O(1).
+
+    Pushing with merge=True first gives the action at the top of the stack a
+    chance to absorb the new one (see EditAction.merge()). That's how
+    a run of typed characters ends up as one action holding one delta
+    instead of one action per keypress.
+
+    Parameters:
+    budget -- Maximum number of bytes (roughly) to keep.
+
+    Methods:
+    push  -- add an action to the stack or merge it into the top one
+    pop   -- remove and return the last action on the stack
+    last  -- get the last action without popping
+    clear -- remove all actions from the stack
+
+    """
+
+    def __init__(self, budget=UNDO_BUDGET):
+        self.budget = budget
+        self.total_size = 0
+        self.__elements = deque()
+        self.__sizes = deque()
+
+    def push(self, element, merge=False):
+        """
+        Add something to the stack, or merge it into the last element if
+        merge is set and the last element can take it.
+        """
+
+        if merge and self.__elements:
+            last = self.__elements[-1]
+            if hasattr(last, 'merge') and last.merge(element):
+                size = action_size(last)
+                self.total_size += size-self.__sizes[-1]
+                self.__sizes[-1] = size
+                self._enforce_budget()
+                return
+
+        size = action_size(element)
+        self.__elements.append(element)
+        self.__sizes.append(size)
+        self.total_size += size
+        self._enforce_budget()
+
+    def _enforce_budget(self):
+        # always keep the newest element, even if it is too big on its own
+        while self.total_size > self.budget and len(self.__elements) > 1:
+            self.__elements.popleft()
+            self.total_size -= self.__sizes.popleft()
+
+    def pop(self):
+        """Remove and return something from the stack."""
+
+        if not self.__elements:
+            return None
+        self.total_size -= self.__sizes.pop()
+        return self.__elements.pop()
+
+    def last(self):
+        """Get the element at the top of the stack without popping."""
+
+        if self.__elements:
+            return self.__elements[-1]
+        else:
+            return None
+
+    def clear(self):
+        """Remove all elements from the stack."""
+
+        self.__elements.clear()
+        self.__sizes.clear()
+        self.total_size = 0
+
+    def __repr__(self):
+        return list(self.__elements).__repr__()
+
+    def __len__(self):
+        return self.__elements.__len__()
+
+def action_size(action):
+    """
+    Return a rough estimate of the number of bytes action takes up.
+
+    Anything with a deltas list gets the size of each of them (see
+    Delta.size) added.
+    """
+
+    size = ACTION_SIZE
+    for delta in getattr(action, 'deltas', ()):
+        size += delta.size
+    return size
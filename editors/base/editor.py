@@ -44,7 +44,10 @@ class Editor(object):
         raise NotImplementedError()
 
     def copy_view(self):
-        """Make a copy of the view and return it."""
+        """
+        Make a copy of the view and return it (or None while the document
+        is still loading).
+        """
 
         raise NotImplementedError()
 
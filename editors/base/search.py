@@ -53,6 +53,17 @@ class InitialSearchThread(Thread):
         self.search = search
         self.interrupted = False
 
+        # Snapshot the open documents now, while we're still on the thread
+        # that edits them. The search thread only ever reads the snapshots.
+        self.snapshots = {}
+        for view in search.editor.views:
+            document = view.document
+            if document.location:
+                self.snapshots[document.location] = document.snapshot()
+            else:
+                # files without locations haven't been saved yet
+                self.snapshots[document] = document.snapshot()
+
         if search.use_regex:
             # compile the regular expression once
             flags = re.U|re.M
@@ -91,22 +102,62 @@ class InitialSearchThread(Thread):
 
         return num_matches
 
-    def search_simple(self, filename, code):
+    def map_match(self, snapshot, current, start, end):
+        """
+        Return (line, linenum, start, end) for the match between the offsets
+        start and end in snapshot where it is in current (a newer snapshot
+        of the same document) or None if it isn't there anymore.
+        """
+
+        new_start = snapshot.map_offset(start)
+        new_end = snapshot.map_offset(end)
+        if new_start is None or new_end is None:
+            return None
+
+        # The match got edited (or an edit came in while current was being
+        # taken). notify_change() gets the edited line searched again.
+        if current.get_text(new_start, new_end) != \
+                snapshot.get_text(start, end):
+            return None
+
+        linenum, start = current.offset_to_cursor_pos(new_start)
+        line = current.get_line(linenum)
+        return line, linenum, start, start+new_end-new_start
+
+    def search_simple(self, filename, code, snapshot=None):
         # TODO: what about multi-line?
 
         num_matches = 0
 
         search = self.search
         pattern = search.search_pattern
-        lines = code.splitlines()
 
+        if snapshot is not None:
+            # The document could have been edited since the snapshot was
+            # taken, so the matches have to be moved to where they are now.
+            # Only newlines end lines in documents.
+            current = snapshot.document.snapshot()
+            lines = code.split(u'\n')
+        else:
+            lines = code.splitlines()
+
+        offset = 0
         for num, line in enumerate(lines):
+            line_offset = offset
+            offset += len(line)+1
+
             # TODO:
             #   could be multiple in one line
             start = line.find(pattern)
             if start != -1:
                 #print "found a match at", str(num)
                 end = start + len(pattern)
+                if snapshot is not None:
+                    match = self.map_match(snapshot, current,
+                                           line_offset+start, line_offset+end)
+                    if match is None:
+                        continue
+                    line, num, start, end = match
                 search.add_match(filename, line, num, start, end)
                 num_matches += 1
 
@@ -197,14 +248,7 @@ class InitialSearchThread(Thread):
 
         print len(search.files), "files."
 
-        # cache open files / views
-        open_files = {}
-        for view in search.editor.views:
-            if view.document.location:
-                open_files[view.document.location] = view
-            else:
-                # files without locations haven't been saved yet
-                open_files[view.document] = view
+        snapshots = self.snapshots
 
         if search_type == SEARCH_SELECTION:
             pass # forget about this one for now
@@ -220,8 +264,9 @@ class InitialSearchThread(Thread):
                     path = document.description
 
                     # this means we're searching an unsaved document
-                    if open_files.has_key(document):
-                        content = document.content
+                    if snapshots.has_key(document):
+                        snapshot = snapshots[document]
+                        content = snapshot.content
 
                     else:
                         continue
@@ -231,12 +276,14 @@ class InitialSearchThread(Thread):
                     path = filename
 
                     # we're searching a document that has a location
-                    if open_files.has_key(filename):
+                    if snapshots.has_key(filename):
                         # read file from memory
-                        doc = open_files[filename].document
-                        content = doc.content
+                        snapshot = snapshots[filename]
+                        content = snapshot.content
 
                     else:
+                        snapshot = None
+
                         # we don't have the file open, so we have to read it
                         # from disk
                         try:
@@ -255,7 +302,8 @@ class InitialSearchThread(Thread):
                 if search.use_regex:
                     found_matches = self.search_regex(path, content)
                 else:
-                    found_matches = self.search_simple(path, content)
+                    found_matches = self.search_simple(path, content,
+                                                       snapshot)
 
                 if found_matches:
                     pass # signal redraw
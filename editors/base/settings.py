@@ -73,6 +73,9 @@ class BaseSettings(object):
     def get_workspaces_dir(self):
         return os.path.join(self.settings_dir, 'workspaces')
 
+    def get_token_cache_dir(self):
+        return os.path.join(self.settings_dir, 'tokens')
+
     #def get_workspace_path(self, slug):
     #    return os.path.join(self.get_workspaces_dir(), slug+'.workspace')
 
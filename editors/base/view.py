@@ -1,7 +1,7 @@
-import bisect
 from hashlib import md5
 from pygments.token import Token
 from ni.actions.base import EditAction
+from ni.core.brackets import OPEN_BRACKETS, CLOSE_BRACKETS
 
 
 # Basically a view wraps a document and remembers stuff like the scrolling
@@ -9,17 +9,6 @@ from ni.actions.base import EditAction
 # editors can do stuff like have multiple views open on the same document.
 # This is just an interface and actual editors should inherit from View.
 
-# TODO: these should probably be pluggable per mode
-OPEN_BRACKETS = {
-    u'{': u'}',
-    u'(': u')',
-    u'[': u']',
-}
-CLOSE_BRACKETS = {
-    u'}': u'{',
-    u')': u'(',
-    u']': u'[',
-}
 
 def find_bracket_in_token(tvalue, token_offset, cursor_offset):
     """
@@ -97,6 +86,9 @@ class View(object):
 
         self.previous_action = None
 
+        # what the screen showed when it was last painted (see mark_painted)
+        self._painted = None
+
     def invalidate(self):
         raise NotImplemented
 
@@ -108,9 +100,37 @@ class View(object):
         raise NotImplemented
     page_size = property(_get_page_size)
 
+    def lex_ahead(self):
+        """
+        Lex some more of the document in the background. (see
+        Document.lex_ahead)
+
+        Returns (more, redraw) where more says if there is still more to lex
+        and redraw says if lines that are on the screen got new tokens.
+        Editors call this when there's nothing else to do and keep calling it
+        while more is True.
+        """
+
+        doc = self.document
+        if doc.is_lexed:
+            return False, False
+
+        y, x = self.scroll_pos
+        width, height = self.textbox_dimensions
+        screen_end = doc.cursor_pos_to_offset((y+height, 0))
+        was_partial = doc.must_relex or doc.tokenizer.end < screen_end
+
+        more = doc.lex_ahead()
+
+        if was_partial:
+            # brackets might match now that there are tokens
+            self.brackets = None
+        return more, was_partial
+
     def calculate_brackets(self):
         """
-        Set self.brackets to the (x, y) position of the matching bracket.
+        Set self.brackets to the offset of the bracket that matches the one
+        before the cursor. (see BracketIndex)
 
         (Actually self.brackets is a sequence of all the positions to hilight,
          but for now it is always zero length)
@@ -124,91 +144,114 @@ class View(object):
         if cx == 0:
             return # start of the line guaranteed not to match
 
-        # cache some lookups
-        cursor_pos = self.cursor_pos
         doc = self.document
-        tokenizer = doc.tokenizer        
-        tokens = tokenizer.tokens
-        offsets = tokenizer.offsets
-
-        def find_offset(offsets, offset):
-            pos = bisect.bisect_left(offsets, offset)        
-            if pos >= len(offsets):
-                # bisect_left might return an index outside of the list 
-                pos = len(offsets)-1
-            elif offsets[pos] > offset:
-                # if the offset of the line index bist_left returns is after the 
-                # offset we're looking for, use the previous line 
-                pos -= 1
-            return pos
-        
-        # find the index in offsets that refers to the token that contains the
-        # character under the cursor
-        cursor_offset = doc.cursor_pos_to_offset(cursor_pos)
-        index = find_offset(offsets, cursor_offset)
-        # we look at the previous token to find the relevant bracket
-        index -= 1
-        ttype, tvalue = tokens[index]
-        if not ttype is Token.Punctuation:
-            return
+        tokenizer = doc.tokenizer
+        cursor_offset = doc.cursor_pos_to_offset(self.cursor_pos)
+        if not tokenizer.tokens or cursor_offset > tokenizer.end:
+            return # not lexed yet
+
+        # Only the tokens that got lexed so far get checked. If the matching
+        # bracket is further down, lex_ahead() clears the brackets again once
+        # it got there.
+        bracket_offset = tokenizer.brackets.find_match(cursor_offset-1)
+        if bracket_offset is not None:
+            self.brackets = (bracket_offset,)
+
+    def _get_selection_positions(self):
+        if not self.selection:
+            return None
+        selection = self.selection.get_normalised()
+        doc = self.document
+        return (doc.offset_to_cursor_pos(selection.start),
+                doc.offset_to_cursor_pos(selection.end))
 
-        # sometimes the tokenizer will return adjacent punctuation tokens 
-        # grouped into one, so we have to find the token inside that
-        token_offset = offsets[index]
-        r = find_bracket_in_token(tvalue, token_offset, cursor_offset)
-        if not r:
-            # shouldn't realistically happen, but you never know
-            # what any of the many lexers out there will do..
-            return
-        bracket, char_offset = r
-
-        if OPEN_BRACKETS.has_key(bracket):
-            matching = OPEN_BRACKETS[bracket]
-
-            # For now we lex to the end so that we know that everything
-            # is there to be checked. 
-            # TODO: This should be easy to optimise..
-            doc.update_tokens(self.scroll_pos,
-                              self.textbox_dimensions,
-                              to_end=True)
-
-            stack = 0
-            for r in fake_punc_tokens(tokens, index, char_offset):
-                ttype, tvalue, index, char_offset = r
-                if ttype is Token.Punctuation:
-                    if tvalue == bracket:
-                        stack += 1
-                    elif tvalue == matching:
-                        if stack > 0:
-                            stack -= 1
-                        else:
-                            token_offset = offsets[index]
-                            if token_offset:
-                                bracket_offset = token_offset+char_offset
-                            self.brackets = (bracket_offset,)
-                            return
-
-        elif CLOSE_BRACKETS.has_key(bracket):
-            matching = CLOSE_BRACKETS[bracket]
-
-            stack = 0
-            for r in fake_punc_tokens_reverse(tokens, index, char_offset):
-                ttype, tvalue, index, char_offset = r
-                if ttype is Token.Punctuation:
-                    if tvalue == bracket:
-                        stack += 1
-                    elif tvalue == matching:
-                        if stack > 0:
-                            stack -= 1
-                        else:
-                            token_offset = offsets[index]
-                            if token_offset:
-                                bracket_offset = token_offset+char_offset
-                            self.brackets = (bracket_offset,)
-                            return
+    def _get_bracket_positions(self):
+        brackets = getattr(self, 'brackets', None)
+        if not brackets:
+            return None
+        doc = self.document
+        return tuple(doc.offset_to_cursor_pos(offset) for offset in brackets)
 
-        else:
-            return
+    def mark_painted(self):
+        """
+        Remember the text, cursor line, selection and brackets that are on
+        the screen now so that get_damaged_lines() can tell what changed.
+        Editors call this after they painted the view.
+        """
+
+        doc = self.document
+        # the number of lines only gets compared after an edit and by then
+        # huge documents know it, so a guess does until then
+        self._painted = (doc.version, doc.estimate_num_lines(),
+                         self.cursor_pos[0],
+                         self._get_selection_positions(),
+                         self._get_bracket_positions())
+
+    def get_damaged_lines(self):
+        """
+        Return a list of (first line, last line) ranges of the lines that
+        have to be painted again since mark_painted() got called or None if
+        all of them do.
+
+        That is the lines that got edited (and all the lines after them if
+        lines got added or removed), the lines the cursor moved between, the
+        lines whose selection changed and the lines that the bracket
+        highlight covered or covers now. Lines that only got new tokens
+        aren't included: the tokens aren't known until the lines get lexed
+        for painting.
+        """
+
+        if self._painted is None:
+            return None
+
+        version, num_lines, cursor_y, selection, brackets = self._painted
+        doc = self.document
+        damage = []
+
+        changed = doc.get_changed_range(version)
+        if changed is False:
+            return None
+        if changed:
+            start, end, delta = changed
+            first = doc.offset_to_cursor_pos(start)[0]
+            last = doc.offset_to_cursor_pos(end)[0]
+            if doc.num_lines != num_lines:
+                # the lines after the edit moved
+                last = max(num_lines, doc.num_lines)-1
+            damage.append((first, last))
+
+        y = self.cursor_pos[0]
+        if y != cursor_y:
+            damage.append((cursor_y, cursor_y))
+            damage.append((y, y))
+
+        new_selection = self._get_selection_positions()
+        if new_selection != selection:
+            if not selection or not new_selection:
+                (sy, sx), (ey, ex) = selection or new_selection
+                damage.append((sy, ey))
+            elif selection[0] == new_selection[0]:
+                # only the end moved
+                old_y, new_y = selection[1][0], new_selection[1][0]
+                damage.append((min(old_y, new_y), max(old_y, new_y)))
+            elif selection[1] == new_selection[1]:
+                # only the start moved
+                old_y, new_y = selection[0][0], new_selection[0][0]
+                damage.append((min(old_y, new_y), max(old_y, new_y)))
+            else:
+                damage.append((selection[0][0], selection[1][0]))
+                damage.append((new_selection[0][0], new_selection[1][0]))
+
+        new_brackets = self._get_bracket_positions()
+        if new_brackets != brackets or (brackets and y != cursor_y):
+            # the highlight goes from the cursor's line to each bracket
+            for positions, line in ((brackets, cursor_y),
+                                    (new_brackets, y)):
+                if positions:
+                    lines = [by for by, bx in positions]+[line]
+                    damage.append((min(lines), max(lines)))
+
+        return damage
 
     def check_cursor(self):
         """
@@ -240,9 +283,12 @@ class View(object):
         if y >= (topy+maxrow-1):
             topy = y - maxrow + 2
         
-        # don't scroll too far:
-        if topy > doc.num_lines-maxrow+2:
-            topy = doc.num_lines-maxrow+2
+        # don't scroll too far: (only the lines up to the bottom of the
+        # screen matter, which keeps huge documents from reading all of
+        # their file)
+        num_lines = doc.count_lines(topy+maxrow-2)
+        if topy > num_lines-maxrow+2:
+            topy = num_lines-maxrow+2
         
         if topx < 0:
             topx = 0
@@ -263,6 +309,11 @@ class View(object):
         certainly do stuff before and after calling this.
         """
 
+        # the document is still being loaded, so it can't be changed, saved
+        # or copied yet
+        if action.needs_loaded_document and self.document.is_loading:
+            return
+
         # group similar actions so that we can undo/redo them together
         # TODO: is hash() safe in this context?
         if isinstance(action, type(self.previous_action)):
@@ -274,7 +325,8 @@ class View(object):
 
         action.execute()
         if isinstance(action, EditAction):
-            self.document.undo_stack.push(action)
+            # let typing and backspacing coalesce into runs
+            self.document.undo_stack.push(action, merge=True)
             self.document.redo_stack.clear()
 
         self.previous_action = action
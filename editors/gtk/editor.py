@@ -1,6 +1,7 @@
 import os
-import gtk, pango
-from ni.core.document import Document, load_document
+import gtk, gobject, pango
+from ni.core.document import Document, DocumentLoader, load_document
+from ni.core.files import HUGE_FILE_SIZE
 from ni.editors.base.editor import Editor
 from ni.editors.gtk.dialogs import *
 from ni.editors.gtk.textarea import GTKTextarea
@@ -450,7 +451,13 @@ class GTKEditor(Editor):
                     # TODO: should we reload?
                     return
 
-            document = load_document(location, self.settings)
+            if os.path.getsize(location) > HUGE_FILE_SIZE:
+                document = load_document(location, self.settings)
+            else:
+                # show the start of the file straight away and load the
+                # rest in the background
+                loader = DocumentLoader(location, self.settings)
+                document = loader.document
         else:
             title = self.get_next_title()
             document = Document(encoding=s.file_encoding,
@@ -460,6 +467,9 @@ class GTKEditor(Editor):
         view = GTKView(self, document)
         self.views.append(view)
 
+        if document.is_loading:
+            gobject.idle_add(self.load_step, view)
+
         # Switch the view. switch_current_view will rebuild the tree to reflect
         # the selected view
         self.switch_current_view(view, True)
@@ -470,14 +480,41 @@ class GTKEditor(Editor):
 
         return view
 
+    def load_step(self, view):
+        """
+        Load the next chunk of view's document. This runs as an idle
+        callback until the document is loaded or the view got closed.
+        """
+
+        loader = view.document.loader
+        if not loader:
+            return False
+
+        if not view in self.views:
+            loader.cancel()
+            return False
+
+        more = loader.step()
+
+        if view == self.textarea.view:
+            self.textarea.adjust_adjustments()
+            self.textarea.layouts = None
+            self.textarea.redraw()
+            self.update_status()
+
+        return more
+
     def copy_view(self):
         doc = self.textarea.view.document
+        if doc.is_loading:
+            # the copy would only get the part that got loaded so far
+            return None
         title = self.get_next_title()
         new_doc = Document(encoding=doc.encoding,
                            linesep=doc.linesep,
                            tab_size=doc.tab_size,
-                           title=title)
-        new_doc.insert(0, doc.content)
+                           title=title,
+                           content=doc.rope)
         new_view = GTKView(self, new_doc)
         self.views.append(new_view)
         self.switch_current_view(new_view, True)
@@ -799,7 +836,10 @@ class GTKEditor(Editor):
         x += 1
         y += 1
 
-        if doc.is_modified:
+        if doc.is_loading:
+            modified = 'LOADING %d%% ' % (doc.loader.progress*100)
+            title = view.document.description+' (loading)'
+        elif doc.is_modified:
             modified = '*MODIFIED* '
             title = view.document.description+' (modified)'
         else:
@@ -0,0 +1,173 @@
+import gtk
+
+
+class GutterRenderer(object):
+    """Draws the line numbers in a GTKTextarea's gutter.
+
+    Every digit gets rendered with pango once for each style (plain lines,
+    every fifth line and the current line) into a strip of ten digits and
+    numbers get drawn by copying their digits out of the strip, so drawing a
+    number doesn't make any pango layouts.
+
+    The renderer also remembers what every row of the gutter shows (the line
+    number, its style and which part of the bracket highlight goes through
+    it) and only draws the rows where that changed. The textarea has to
+    tell it when the pixmap scrolled or got painted over.
+
+    Parameters:
+    textarea -- The GTKTextarea whose gutter gets drawn.
+
+    Methods:
+    clear    -- forget the rendered digits (after the font changed)
+    forget   -- forget what the rows show so that all of them get drawn
+    scroll   -- move what the rows show along with the pixmap
+    draw     -- draw the rows that changed
+
+    """
+
+    def __init__(self, textarea):
+        self.textarea = textarea
+        self.clear()
+
+    def clear(self):
+        """Forget the rendered digits and what the rows show."""
+
+        self._strips = {}
+        self._colours_key = None
+        self.forget()
+
+    def forget(self):
+        """Forget what the rows show, so they all get drawn next time."""
+
+        self._rows = []
+
+    def scroll(self, dy, num_rows):
+        """
+        The pixmap moved up by dy rows (or down if dy is negative) and has
+        num_rows rows.
+        """
+
+        rows = self._rows[:num_rows]
+        rows += [None]*(num_rows-len(rows))
+        if dy > 0:
+            rows = rows[dy:]+[None]*dy
+            # the last row was only partly on the screen
+            if num_rows-dy-1 >= 0:
+                rows[num_rows-dy-1] = None
+        elif dy < 0:
+            rows = [None]*(-dy)+rows[:num_rows+dy]
+        self._rows = rows
+
+    def _get_strip(self, style, colours):
+        """Return the pixmap with the digits 0 to 9 drawn in style."""
+
+        strip = self._strips.get(style)
+        if strip is None:
+            textarea = self.textarea
+            widget = textarea.drawingarea
+            char_width = textarea.char_width
+            char_height = textarea.char_height
+            strip = gtk.gdk.Pixmap(widget.window, 10*char_width, char_height)
+            strip.draw_rectangle(colours['gutter_bg']['gc'], True,
+                                 0, 0, 10*char_width, char_height)
+            for digit in xrange(10):
+                pl = widget.create_pango_layout(str(digit))
+                pl.set_font_description(textarea.font)
+                strip.draw_layout(colours[style]['gc'], digit*char_width, 0,
+                                  pl)
+            self._strips[style] = strip
+        return strip
+
+    def _get_bracket_lines(self):
+        """
+        Return (first line, last line) for the line that the bracket
+        highlight draws in the gutter or None if there isn't one.
+        """
+
+        view = self.textarea.view
+        if not view.brackets:
+            return None
+        doc = view.document
+        cursor_y = view.cursor_pos[0]
+        lines = [doc.offset_to_cursor_pos(offset)[0]
+                 for offset in view.brackets]
+        lines = [y for y in lines if y != cursor_y]
+        if not lines:
+            return None
+        return min(lines+[cursor_y]), max(lines+[cursor_y])
+
+    def draw(self, draw_target, first_row, last_row):
+        """
+        Draw the gutter for the rows from first_row up to (not including)
+        last_row that show something else than last time.
+        """
+
+        textarea = self.textarea
+        view = textarea.view
+        doc = view.document
+        colours = view.colours
+
+        if view.colours_key != self._colours_key:
+            self.clear()
+            self._colours_key = view.colours_key
+
+        width, height = textarea.drawingarea.window.get_size()
+        char_width = textarea.char_width
+        char_height = textarea.char_height
+        yoffset = int(textarea.vadjustment.value)
+        cursor_y = view.cursor_pos[0]
+        num_lines = doc.count_lines(yoffset+last_row)
+
+        gutter_width = textarea.gutter_width
+        gutter_bg_width = gutter_width-textarea.gutter_line_gap/2
+        line_width = textarea.gutter_line_width
+        line_x = gutter_width-line_width-textarea.gutter_line_gap/2
+        format = '%'+str(textarea.gutter_char_width)+'d'
+        bracket_lines = self._get_bracket_lines()
+
+        rows = self._rows
+        if len(rows) < last_row:
+            rows += [None]*(last_row-len(rows))
+
+        for row in xrange(first_row, last_row):
+            y = yoffset+row
+            if y >= num_lines:
+                style = None
+            elif y == cursor_y:
+                style = 'gutter_current'
+            elif (y+1) % 5:
+                style = 'gutter_plain'
+            else:
+                style = 'gutter_fifth'
+            if bracket_lines and bracket_lines[0] <= y <= bracket_lines[1]:
+                bracket_part = (y == bracket_lines[0], y == bracket_lines[1])
+            else:
+                bracket_part = None
+
+            key = (y, style, bracket_part)
+            if rows[row] == key:
+                continue
+            rows[row] = key
+
+            ypos = row*char_height
+            if ypos >= height:
+                break
+            draw_target.draw_rectangle(colours['gutter_bg']['gc'], True,
+                                       0, ypos,
+                                       gutter_bg_width, char_height)
+
+            # draw the gutter line
+            draw_target.draw_rectangle(colours['gutter_line']['gc'], True,
+                                       line_x, ypos,
+                                       line_width,
+                                       min(char_height, height-1-ypos))
+
+            if style is None:
+                continue
+            strip = self._get_strip(style, colours)
+            for i, char in enumerate(format % (y+1,)):
+                if char != ' ':
+                    draw_target.draw_drawable(textarea.gc, strip,
+                                              int(char)*char_width, 0,
+                                              i*char_width, ypos,
+                                              char_width, char_height)
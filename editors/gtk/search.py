@@ -159,7 +159,7 @@ class GtkSearch(Search):
                     return
 
             view.brackets = None
-            view.textarea.pl = None
+            view.textarea.layouts = None
             view.cursor_pos = end_pos
             view.selection = Selection(view.document, start_pos, end_pos)            
             #view.textarea.sync_scroll_pos() # is this necessary?
@@ -23,7 +23,7 @@ class GtkSettings(BaseSettings):
         self.fields += ['font_name', 'font_size', 'right_margin', 'show_gutter',
                         'show_statusbar', 'show_sidebar', 'show_margin',
                         'win_width', 'win_height', 'win_x', 'win_y',
-                        'colourscheme', 'workspace']
+                        'colourscheme', 'workspace', 'layout_cache_size']
 
     def _defaults(self):
         super(GtkSettings, self)._defaults()
@@ -41,7 +41,8 @@ class GtkSettings(BaseSettings):
             'win_x':  0,
             'win_y':  0,
             'colourscheme': 'happy',
-            'workspace': None
+            'workspace': None,
+            'layout_cache_size': 2000
         })
 
     def load_colourschemes(self):
@@ -125,6 +126,12 @@ class GtkSettings(BaseSettings):
     def _val_win_y(self, value):
         return int(value)
 
+    def _val_layout_cache_size(self, value):
+        value = int(value)
+        if value < 1:
+            raise Exception()
+        return value
+
 def load_gtk_settings():
     settings_filepath = os.path.join(SETTINGS_DIR, SETTINGS_FILENAME)
     return load_settings_from_file(settings_filepath, GtkSettings)
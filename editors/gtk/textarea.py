@@ -4,7 +4,9 @@ import gtk, gobject
 import pango
 from pygments.token import Token
 from ni.actions.defaultactions import *
-from ni.editors.gtk.utils import make_pango_layout, add_selection_to_layout
+from ni.editors.gtk.utils import make_line_layouts, get_line_selection
+from ni.editors.gtk.gutter import GutterRenderer
+from ni.core.lru import LRUCache
 from ni.core.text import cap
 
 
@@ -72,7 +74,21 @@ class GTKTextarea(object):
         self.pixmap = None
         self.width = None
         self.height = None
-        self.pl = None
+
+        # the pango layouts of the lines on the screen or None if they have
+        # to be worked out again and the layouts of recently drawn lines
+        self.layouts = None
+        self.layout_cache = LRUCache(editor.settings.layout_cache_size)
+
+        # what self.pixmap shows (see get_damage()) and whether it has to be
+        # painted from scratch regardless
+        self.painted_state = None
+        self.painted_scroll_y = None
+        self.painted_layouts = []
+        self.must_repaint = True
+
+        # draws the line numbers
+        self.gutter = GutterRenderer(self)
 
         # TODO: this should be in config
         self.scroll_inc = 3
@@ -107,6 +123,11 @@ class GTKTextarea(object):
 
         self.hscrollbar_visible = True
 
+        # the idle callback that lexes ahead of the view (see lex_step)
+        self.lex_source = None
+        # the idle callback that indexes huge documents (see index_step)
+        self.index_source = None
+
     def attach(self, method):
         method(self.table)
 
@@ -139,7 +160,8 @@ class GTKTextarea(object):
     ### Properties
 
     def get_gutter_char_width(self):
-        num_lines = self.view.document.num_lines
+        # huge documents might not know how many lines they have yet
+        num_lines = self.view.document.estimate_num_lines()
         return max(5, len(str(num_lines)))
     gutter_char_width = property(get_gutter_char_width)
 
@@ -193,6 +215,12 @@ class GTKTextarea(object):
         pl.set_font_description(self.font)
         self.char_width, self.char_height = pl.get_pixel_size()
 
+        # the cached layouts use the old font
+        self.layout_cache.clear()
+        self.layouts = None
+        self.must_repaint = True
+        self.gutter.clear()
+
         # when the font is set or changes, then the character size changes, 
         # therefore the textbox dimensions (in number of chars) changes, 
         # so the number of chars on screen in each dimension changes, so we
@@ -220,15 +248,24 @@ class GTKTextarea(object):
         view = self.view
         doc = view.document
 
-        # TODO: it must be possible to optimise this so that we don't have to
-        # loop through lines
-        total_chars = 0
-        for i in xrange(doc.num_lines):
-            line_length = len(doc.get_line(i))
-            if line_length > total_chars:
-                total_chars = line_length
+        if doc.is_huge:
+            # only look at the lines on screen, otherwise the whole file
+            # has to be read
+            scrolly, scrollx = view.scroll_pos
+            if self.drawingarea.window:
+                num_chars, num_lines = self.textbox_dimensions
+            else:
+                num_lines = 0
+            total_chars = 0
+            for i in xrange(scrolly, doc.count_lines(scrolly+num_lines)):
+                line_length = doc.get_line_width(i)
+                if line_length > total_chars:
+                    total_chars = line_length
+        else:
+            total_chars = doc.get_max_line_width()
 
-        total_lines = doc.num_lines
+        # a guess until huge documents are indexed (see index_step)
+        total_lines = doc.estimate_num_lines()
 
         # erm... why +2? something to do with two scrollbars?
         last_char = total_chars + 2
@@ -270,8 +307,11 @@ class GTKTextarea(object):
                 self.hscrollbar.show()
                 self.hscrollbar_visible = True
 
-    def draw_background(self):
-        """Draw everything that's not the text or selection.
+    def draw_background(self, first_row=0, last_row=None):
+        """Draw everything that's not the text.
+
+        Only the rows from first_row up to (not including) last_row get
+        drawn. (By default all the rows on the screen.)
         """
 
         widget = self.drawingarea
@@ -288,6 +328,13 @@ class GTKTextarea(object):
         clip_yoff, clip_xoff = clip_off
         clip_width, clip_height = clip_size
 
+        if last_row is None:
+            last_row = rows
+        top = first_row*self.char_height
+        bottom = min(last_row*self.char_height, height)
+        if bottom <= top:
+            return
+
         colours = view.colours
 
         if view.selection:
@@ -295,7 +342,6 @@ class GTKTextarea(object):
         else:
             selection = None
 
-        gutter_char_width = self.gutter_char_width
         gutter_width = self.gutter_width
 
         # clear the background
@@ -307,11 +353,12 @@ class GTKTextarea(object):
             bg_w = width
 
         draw_target.draw_rectangle(colours['bg']['gc'], True,
-                                   bg_x, 0,
-                                   bg_w, height)
+                                   bg_x, top,
+                                   bg_w, bottom-top)
 
-        # is the current line on screen?
-        cline_onscreen = cursor_y >= yoffset and cursor_y < yoffset+rows
+        # is the current line in the rows that get drawn?
+        cline_onscreen = cursor_y >= yoffset+first_row and \
+                         cursor_y < yoffset+last_row
 
         # do we have a selection and is the line inside it?
         line_in_selection = (selection and \
@@ -326,39 +373,33 @@ class GTKTextarea(object):
                                        start_x, start_y,
                                        clip_width, self.char_height)
 
-        if self.editor.settings.show_gutter:
-            gutter_bg_width = gutter_width-self.gutter_line_gap/2
-            draw_target.draw_rectangle(colours['gutter_bg']['gc'], True,
-                                       0, 0,
-                                       gutter_bg_width, height)
-
-            # draw the gutter line
-            line_x = gutter_width-self.gutter_line_width-self.gutter_line_gap/2
-            draw_target.draw_rectangle(colours['gutter_line']['gc'], True,
-                                       line_x, 0,
-                                       self.gutter_line_width, height-1)
-
-            # gutter
-            num_lines = doc.num_lines
-            y = 0
-            for line_num in xrange(yoffset+1, yoffset+rows+1):
-                if line_num > num_lines:
+        if selection:
+            # the selection goes under the text, so the cached layouts get
+            # drawn as they are
+            sel_gc = colours['sel']['gc']
+            num_lines = doc.count_lines(yoffset+last_row)
+            for row in xrange(first_row, last_row):
+                y = yoffset+row
+                if y >= num_lines:
                     break
-                format = '%'+str(gutter_char_width)+'d'
-                pl = widget.create_pango_layout(format % (line_num,))
-                pl.set_font_description(self.font)
-                if line_num-1 == cursor_y:
-                    gc = colours['gutter_current']['gc']
-                else:
-                    if line_num % 5:
-                        gc = colours['gutter_plain']['gc']
-                    else:
-                        gc = colours['gutter_fifth']['gc']
-                draw_target.draw_layout(gc, 0, y, pl)
-                y += self.char_height
+                columns = get_line_selection(doc, selection, y, xoffset,
+                                             chars)
+                if columns:
+                    start, end = columns
+                    draw_target.draw_rectangle(sel_gc, True,
+                        clip_xoff+start*self.char_width,
+                        row*self.char_height,
+                        (end-start)*self.char_width, self.char_height)
 
-    def draw_text(self):
-        """Draw the highlighted pango text."""
+        if self.editor.settings.show_gutter:
+            # only the rows whose number or highlight changed get drawn
+            self.gutter.draw(draw_target, first_row, last_row)
+
+    def draw_text(self, first_row=0, last_row=None):
+        """
+        Draw the highlighted pango text of the rows from first_row up to (not
+        including) last_row. (By default all the rows on the screen.)
+        """
 
         widget = self.drawingarea
         draw_target = self.pixmap
@@ -379,26 +420,20 @@ class GTKTextarea(object):
 
         doc = view.document
 
-        #must_relex = bool(doc.relex_from)
-        if not self.pl or doc.must_relex:
-            #print "recalculating pango layout.."
-
-            doc.update_tokens(view.scroll_pos, view.textbox_dimensions)
-
-            tab_size = self.editor.settings.tab_size
-            self.pl = make_pango_layout(view)
-            self.pl.set_font_description(self.font)
+        self.update_layouts()
 
-        if view.selection:
-            pl = self.pl.copy()
-            selection = view.selection
-            add_selection_to_layout(pl, colours, doc, selection, offset, size)
-
-        else:
-            pl = self.pl
+        chars, rows = size
+        if last_row is None:
+            last_row = rows
+        top = first_row*self.char_height
+        bottom = min(last_row*self.char_height, height)
+        if bottom <= top:
+            return
 
         colour = colours['plain']['gc']
-        draw_target.draw_layout(colour, clip_xoff, 0, pl)
+        for row in xrange(first_row, min(last_row, len(self.layouts))):
+            draw_target.draw_layout(colour, clip_xoff, row*self.char_height,
+                                    self.layouts[row])
 
         if self.editor.settings.show_margin:
             rm = self.editor.settings.right_margin
@@ -410,8 +445,8 @@ class GTKTextarea(object):
 
             # draw the guide line
             draw_target.draw_line(colours['guide']['gc'],
-                                  guide_x, 0,
-                                  guide_x, height-1)
+                                  guide_x, top,
+                                  guide_x, min(bottom, height)-1)
 
 
     def draw_cursor(self):
@@ -462,7 +497,7 @@ class GTKTextarea(object):
                                                xpos, ypos,
                                                2, self.char_height)
 
-    def draw_brackets(self):
+    def draw_brackets(self, first_row=0, last_row=None):
         view = self.view
         doc = view.document
 
@@ -484,6 +519,21 @@ class GTKTextarea(object):
         clip_yoff, clip_xoff = clip_off
         clip_width, clip_height = clip_size
 
+        if last_row is None:
+            last_row = rows
+        top = first_row*self.char_height
+        bottom = last_row*self.char_height
+
+        def draw_rectangle(gc, x, y, w, h):
+            # only the part inside the rows that get drawn
+            if y < top:
+                h -= top-y
+                y = top
+            if y+h > bottom:
+                h = bottom-y
+            if h > 0:
+                draw_target.draw_rectangle(gc, True, x, y, w, h)
+
         cursor_pos = view.cursor_pos
 
         gc = draw_target.new_gc()
@@ -491,7 +541,7 @@ class GTKTextarea(object):
         #gc.set_function(gtk.gdk.INVERT)
 
         screen_start = (xoffset, yoffset)
-        lastline_num = min(doc.num_lines-1, yoffset+rows-1)
+        lastline_num = doc.count_lines(yoffset+rows)-1
         screen_end = (chars, lastline_num)
 
         for bracket_offset in view.brackets:
@@ -504,7 +554,7 @@ class GTKTextarea(object):
                 x -= xoffset
                 y -= yoffset
 
-                if x >= 0 and x < chars and y >= 0 and y < rows:
+                if x >= 0 and x < chars and y >= first_row and y < last_row:
                     xpos = clip_xoff+x*self.char_width
                     ypos = y*self.char_height
                     draw_target.draw_rectangle(gc,
@@ -542,52 +592,289 @@ class GTKTextarea(object):
                 if sy == csy:
                     ly = dsy*self.char_height+self.char_height/2-2
                     # start arrow
-                    draw_target.draw_rectangle(gc, True, lx, ly, 8, 4)
-                    lh = (dey-dsy)*self.char_height
+                    draw_rectangle(gc, lx, ly, 8, 4)
                 else:
                     ly = dsy*self.char_height
-                    if ey == cey:
-                        lh = (dey-dsy)*self.char_height+self.char_height/2-2
-                    else:
-                        lh = (dey-dsy)*self.char_height
+                if ey == cey:
+                    lh = dey*self.char_height+self.char_height/2-2-ly
+                else:
+                    # the line goes on below the screen, so it goes all the
+                    # way through the last row (the gutter draws each row
+                    # the same way whether it's the last one or not)
+                    lh = (dey+1)*self.char_height-ly
 
                 # vertical line
-                draw_target.draw_rectangle(gc, True, lx, ly, 4, lh)
+                draw_rectangle(gc, lx, ly, 4, lh)
 
                 if ey == cey:
                     # end angle
                     y = dey*self.char_height+self.char_height/2-2
-                    draw_target.draw_rectangle(gc, True, lx, y, 8, 4)
+                    draw_rectangle(gc, lx, y, 8, 4)
+
+    def draw(self, area=None):
+        """
+        Bring self.pixmap up to date and copy area (a gtk.gdk.Rectangle or
+        by default all of it) to the window. Only the rows that changed since
+        the last time get painted again. (see get_damage)
+        """
 
-    def draw(self):
         # this is a bit of a hack to stop things from being drawn before we
         # properly set things up
         if not self.pixmap or not self.drawingarea.window:
             return
 
-        # there has got to be a better way..
-        if self.view.just_switched:
-            self.view.calculate_brackets()
-            self.view.just_switched = False
-
-        self.draw_background()
-
-        self.draw_text()
+        view = self.view
 
-        self.draw_brackets()
+        # there has got to be a better way..
+        if view.just_switched:
+            view.calculate_brackets()
+            view.just_switched = False
+        if view.brackets == None:
+            view.calculate_brackets()
 
+        damage = self.get_damage()
+        if damage is None:
+            self.gutter.forget()
+            self.draw_rows(0, int(self.vadjustment.page_size))
+        else:
+            dy, damaged_rows = damage
+            if dy:
+                self.scroll_pixmap(dy)
+            for first_row, last_row in damaged_rows:
+                self.draw_rows(first_row, last_row)
+
+        self.must_repaint = False
+        self.painted_state = self.get_paint_state()
+        self.painted_scroll_y = int(self.vadjustment.value)
+        self.painted_layouts = self.layouts or []
+        view.mark_painted()
+
+        if area:
+            x, y, width, height = area.x, area.y, area.width, area.height
+        else:
+            x, y, width, height = 0, 0, self.width, self.height
         self.drawingarea.window.draw_drawable(self.gc,
                                               self.pixmap,
-                                              0, 0,
-                                              0, 0,
-                                              self.width, self.height)
+                                              x, y,
+                                              x, y,
+                                              width, height)
 
         self.draw_cursor()
 
+    def draw_rows(self, first_row, last_row):
+        """Paint the rows from first_row up to last_row onto self.pixmap."""
+
+        self.draw_background(first_row, last_row)
+
+        self.draw_text(first_row, last_row)
+
+        self.draw_brackets(first_row, last_row)
+
+    def scroll_pixmap(self, dy):
+        """
+        Move what's on self.pixmap up by dy rows (or down if dy is
+        negative). The rows that this exposes still have to be drawn.
+        """
+
+        shift = abs(dy)*self.char_height
+        if dy > 0:
+            src_y, dest_y = shift, 0
+        else:
+            src_y, dest_y = 0, shift
+        self.pixmap.draw_drawable(self.gc, self.pixmap,
+                                  0, src_y,
+                                  0, dest_y,
+                                  self.width, self.height-shift)
+        self.gutter.scroll(dy, int(self.vadjustment.page_size))
+
+    def update_layouts(self):
+        """
+        Lex the lines on the screen if needed and make self.layouts for
+        them if it isn't there.
+        """
+
+        view = self.view
+        doc = view.document
+
+        #must_relex = bool(doc.relex_from)
+        if self.layouts is None or doc.must_relex:
+            #print "recalculating pango layouts.."
+
+            doc.update_tokens(view.scroll_pos, view.textbox_dimensions)
+            if not doc.is_lexed:
+                self.schedule_lexing()
+            if not doc.is_indexed:
+                self.schedule_indexing()
+
+            self.layouts = make_line_layouts(view, self.font,
+                                             self.layout_cache)
+
+    def get_paint_state(self):
+        """
+        Return everything that what is on the pixmap depends on besides the
+        vertical scroll position and what View.get_damaged_lines() and the
+        line layouts keep track of. If any of it changed since the last
+        paint, everything has to be painted again.
+        """
+
+        view = self.view
+        doc = view.document
+        settings = self.editor.settings
+        return (view, doc.tab_size, int(self.hadjustment.value),
+                self.width, self.height, self.gutter_char_width,
+                settings.show_gutter, settings.show_margin,
+                settings.right_margin, view.colours_key)
+
+    def get_damage(self):
+        """
+        Return (dy, rows) where dy is the number of rows the view scrolled
+        down (or up if negative) since the last paint and rows is a list of
+        (first row, last row) ranges (not including last row) of the rows
+        that have to be painted after moving the pixmap by dy rows. Return
+        None if everything has to be painted again.
+
+        The rows are the ones that scrolling exposed, the ones with lines
+        that View.get_damaged_lines() reports and the ones whose layout
+        changed (because the line got new tokens, for example).
+        """
+
+        view = self.view
+        rows = int(self.vadjustment.page_size)
+        scroll_y = int(self.vadjustment.value)
+
+        if self.must_repaint or self.get_paint_state() != self.painted_state:
+            return None
+        dy = scroll_y-self.painted_scroll_y
+        if abs(dy) >= rows:
+            return None
+        damaged_lines = view.get_damaged_lines()
+        if damaged_lines is None:
+            return None
+
+        damaged = [False]*rows
+        if dy > 0:
+            # the last row was only partly on the screen
+            for row in xrange(rows-dy-1, rows):
+                damaged[row] = True
+        elif dy < 0:
+            for row in xrange(-dy):
+                damaged[row] = True
+
+        for first, last in damaged_lines:
+            for row in xrange(max(first-scroll_y, 0),
+                              min(last-scroll_y+1, rows)):
+                damaged[row] = True
+
+        # the layouts come from a cache, so a line that didn't change has
+        # the same layout as before
+        self.update_layouts()
+        layouts = self.layouts
+        painted_layouts = self.painted_layouts
+        for row in xrange(rows):
+            if row < len(layouts):
+                pl = layouts[row]
+            else:
+                pl = None
+            painted_row = row+dy
+            if painted_row >= 0 and painted_row < len(painted_layouts):
+                painted_pl = painted_layouts[painted_row]
+            else:
+                painted_pl = None
+            if pl is not painted_pl:
+                damaged[row] = True
+
+        damaged_rows = []
+        first_row = None
+        for row, is_damaged in enumerate(damaged+[False]):
+            if is_damaged and first_row is None:
+                first_row = row
+            elif not is_damaged and first_row is not None:
+                damaged_rows.append((first_row, row))
+                first_row = None
+
+        return dy, damaged_rows
+
     def redraw(self):
-        self.pl = None
+        """Paint everything again."""
+
+        self.must_repaint = True
+        self.layouts = None
         self.drawingarea.queue_draw()
 
+    def update(self):
+        """
+        Paint whatever changed since the last paint. Only the rows that
+        changed get queued for drawing. (see get_damage)
+        """
+
+        self.layouts = None
+        if not self.pixmap or not self.drawingarea.window:
+            return
+
+        view = self.view
+        if view.brackets == None:
+            view.calculate_brackets()
+
+        damage = self.get_damage()
+        if damage is None or damage[0]:
+            # scrolling moves all of the pixmap
+            self.drawingarea.queue_draw()
+            return
+
+        dy, damaged_rows = damage
+        if not damaged_rows:
+            # the cursor only moved along its line
+            self.draw_cursor()
+            return
+
+        for first_row, last_row in damaged_rows:
+            self.drawingarea.queue_draw_area(0, first_row*self.char_height,
+                self.width, (last_row-first_row)*self.char_height)
+
+    def schedule_lexing(self):
+        """Lex the rest of the document from the idle loop."""
+
+        if not self.lex_source:
+            self.lex_source = gobject.idle_add(self.lex_step,
+                                               priority=gobject.PRIORITY_LOW)
+
+    def lex_step(self):
+        """
+        Lex the current view's document for a short while and repaint if the
+        text on the screen got new tokens. This runs as an idle callback
+        until the document is lexed.
+        """
+
+        more, redraw = self.view.lex_ahead()
+        if redraw:
+            # only the lines that got new tokens get painted
+            self.update()
+        if not more:
+            self.lex_source = None
+        return more
+
+    def schedule_indexing(self):
+        """Index the rest of a huge document from the idle loop."""
+
+        if not self.index_source:
+            self.index_source = gobject.idle_add(self.index_step,
+                priority=gobject.PRIORITY_LOW)
+
+    def index_step(self):
+        """
+        Index the current view's document for a short while and fix the
+        scrollbars and the gutter now that the number of lines is a better
+        guess. This runs as an idle callback until the document is indexed.
+        """
+
+        more = self.view.document.index_ahead()
+        self.adjust_adjustments()
+        # the gutter gets wider if there are more lines than we thought
+        self.update()
+        if not more:
+            self.index_source = None
+        return more
+
     def hscroll(self, direction):
         """Adjust self.hadjustment.
 
@@ -669,7 +956,7 @@ class GTKTextarea(object):
     ### DrawingArea callbacks
 
     def on_drawingarea_expose_event(self, widget, event):
-        self.draw()
+        self.draw(event.area)
 
     def on_drawingarea_size_allocate(self, widget, allocation):
         if self.drawingarea.window:
@@ -678,7 +965,9 @@ class GTKTextarea(object):
             if not self.gc:
                 self.gc = self.drawingarea.window.new_gc()
 
-            self.pl = None # window got resized, so the text layout is invalid
+            # window got resized, so the text layouts are invalid
+            self.layouts = None
+            self.must_repaint = True
 
             self.width = allocation.width
             self.height = allocation.height
@@ -714,9 +1003,8 @@ class GTKTextarea(object):
             return True
         x -= clip_xoff
 
-        last_line = doc.num_lines-1 # why last_line and not num_lines?
         clicked_yoffset = int(y / self.char_height)+yoffset
-        ychar = min(last_line, clicked_yoffset)
+        ychar = doc.count_lines(clicked_yoffset+1)-1
 
         line_width = len(doc.get_line(ychar))
         clicked_xoffset = int(round(x / self.char_width))+xoffset
@@ -761,8 +1049,7 @@ class GTKTextarea(object):
             rows = int(self.vadjustment.page_size)
 
             mouse_yoffset = int(y / self.char_height)+yoffset
-            num_lines = doc.num_lines # why num_lines and not last_line?
-            ychar = min(num_lines, mouse_yoffset)
+            ychar = doc.count_lines(mouse_yoffset)
 
             line_length = len(doc.get_line(ychar))
             mouse_xoffset = int(round((x-clip_xoff) / self.char_width))+xoffset
@@ -800,7 +1087,8 @@ class GTKTextarea(object):
                 self.editor.selection_actiongroup.set_sensitive(True)
                 view.cursor_pos = (ychar, xchar)
                 self.is_cursor_visible = True
-                self.drawingarea.queue_draw()
+                # only the lines whose selection changed get drawn
+                self.update()
 
         return True
 
@@ -900,5 +1188,5 @@ class GTKTextarea(object):
         # to it when we switch back to it later.
         self.view.scroll_pos = (int(self.vadjustment.value), 
                                 int(self.hadjustment.value))
-        self.redraw() # this should clear self.pl
+        self.update() # this should clear self.layouts
 
@@ -2,6 +2,7 @@ import pango
 from pygments.token import Token
 import time
 from ni.core.text import pad, cap, char_pos_to_tab_pos
+from ni.core.styles import StyleTable
 
 
 def get_gtk_colours(widget, colourscheme, mode):
@@ -13,97 +14,50 @@ def get_gtk_colours(widget, colourscheme, mode):
         c['gc'] = widget.window.new_gc(foreground=c['gdk'])
     return colours
 
-class memoized(object):
-   """Decorator that caches a function's return value each time it is called.
-   If called later with the same arguments, the cached value is returned, and
-   not re-evaluated.
-   """
-   def __init__(self, func):
-      self.func = func
-      self.cache = {}
-   def __call__(self, *args):
-      try:
-         return self.cache[args]
-      except KeyError:
-         self.cache[args] = value = self.func(*args)
-         return value
-      except TypeError:
-         # uncachable -- for instance, passing a list as an argument.
-         # Better to not cache than to blow up entirely.
-         return self.func(*args)
-   def __repr__(self):
-      """Return the function's docstring."""
-      return self.func.__doc__
-
-@memoized
-def get_style_for_ttype(ttype):
-    # Not a dictionary because order matters and we use 'in' to test subsets,
-    # we don't check if things match exactly. There are many more possible
-    # tokens and new ones can always be defined, so we have to check subsets.
-    # That makes this function fairly slow.. but we need it to map Tokens to
-    # actual colours in the colourscheme..
-
-    if ttype in Token.Text:
-        return 'plain'
-    if ttype in Token.Punctuation:
-        return 'punctuation'
-    if ttype in Token.Name.Function:
-        return 'function'
-    if ttype in Token.Name.Class:
-        return 'class'
-    if ttype in Token.Name.Builtin.Pseudo.Self:
-        return 'self'
-    if ttype in Token.Name.Builtin.Pseudo:
-        return 'pseudo'
-    if ttype in Token.Name.Builtin:
-        return 'builtin'
-    if ttype in Token.Name.Exception:
-        return 'exception'
-    if ttype in Token.Name.Tag:
-        return 'tag'
-    if ttype in Token.Name.Attribute:
-        return 'attribute'
-    if ttype in Token.Name:
-        return 'name'
-    if ttype in Token.Operator.Word:
-        return 'wordoperator'
-    if ttype in Token.Operator:
-        return 'symboloperator'
-    if ttype in Token.Keyword:
-        return 'keyword'
-    if ttype in Token.Literal.Number:
-        return 'number'
-    if ttype in Token.Literal:
-        return 'literal'
-    if ttype in Token.Comment:
-        return 'comment'
-    if ttype in Token.Error:
-        return 'error'
-    if ttype in Token.Other:
-        return 'other'
-    if ttype in Token.Generic:
-        return 'generic'
-
-    return 'plain'
-
-def line_tokens(tokens, tab_size):
-    tab_spaces = tab_size*' '
-
-    line_tokens = []
-    for ttype, value in tokens:
-        lines = value.split('\n')
-        for n, line in enumerate(lines):
-            if n > 0:
-                yield line_tokens
-                line_tokens = []
-            line_tokens.append((ttype, len(line.replace('\t', tab_spaces))))
-    yield line_tokens
+# Not a dictionary because order matters and we use 'in' to test subsets,
+# we don't check if things match exactly. There are many more possible
+# tokens and new ones can always be defined, so we have to check subsets.
+# StyleTable only does that once per token type.
+GTK_STYLES = StyleTable([
+    (Token.Text, 'plain'),
+    (Token.Punctuation, 'punctuation'),
+    (Token.Name.Function, 'function'),
+    (Token.Name.Class, 'class'),
+    (Token.Name.Builtin.Pseudo.Self, 'self'),
+    (Token.Name.Builtin.Pseudo, 'pseudo'),
+    (Token.Name.Builtin, 'builtin'),
+    (Token.Name.Exception, 'exception'),
+    (Token.Name.Tag, 'tag'),
+    (Token.Name.Attribute, 'attribute'),
+    (Token.Name, 'name'),
+    (Token.Operator.Word, 'wordoperator'),
+    (Token.Operator, 'symboloperator'),
+    (Token.Keyword, 'keyword'),
+    (Token.Literal.Number, 'number'),
+    (Token.Literal, 'literal'),
+    (Token.Comment, 'comment'),
+    (Token.Error, 'error'),
+    (Token.Other, 'other'),
+    (Token.Generic, 'generic'),
+])
+
+def line_tokens(lines, token_lines, tab_size):
+    """
+    Yield a list of (style, length) for each line where length is the
+    number of characters with tabs expanded. token_lines comes from
+    Tokenizer.get_line_tokens() with GTK_STYLES.
+    """
+
+    extra = tab_size-1
+    for line, spans in zip(lines, token_lines):
+        yield [(style, end-start+line.count('\t', start, end)*extra)
+               for style, start, end in spans]
 
 def clipped_tokens(token_lines, xoffset, num_chars):
     for token_line in token_lines:
         line_pos = 0
         line_length = 0
-        for ttype, length in token_line:
+        for style, length in token_line:
             if line_pos >= xoffset:
                 l = length
             elif line_pos+length >= xoffset:
@@ -115,52 +69,35 @@ def clipped_tokens(token_lines, xoffset, num_chars):
                 if line_pos+l > xoffset+num_chars:
                     l = xoffset+num_chars - line_pos
                 if l: # is this nessary?
-                    yield (ttype, l)
+                    yield (style, l)
 
             line_length += l
             line_pos += length
 
         if line_length < num_chars+1:
+            # padding doesn't get a style
             num_whitespace = num_chars+1-line_length
-            yield (Token.Text.Whitespace, num_whitespace)
-
-def make_pango_layout(view, widget=None):
-    doc = view.document
-    yoffset, xoffset = map(int, view.scroll_pos)
-    chars, rows = map(int, view.textbox_dimensions)
-    colours = view.colours
-    tab_size = doc.tab_size
+            yield (None, num_whitespace)
 
-    if not widget:
-        widget = view.textarea.drawingarea
+def make_line_layout(widget, font, colours, line, spans, xoffset, chars,
+                     tab_size):
+    """
+    Return a pango layout for the part of line that is on the screen. spans
+    are the line's (style, start, end) from Tokenizer.get_line_tokens() with
+    GTK_STYLES.
+    """
 
-    # only tokens for the text that's on the screen
-    tokens = doc.tokenizer.get_normalised_tokens(yoffset, yoffset+rows)
-
-    # pango layout
-    #doc_lines = doc.get_lines(yoffset, yoffset+rows)
-    start_index = doc.line_offsets[yoffset]
-    if yoffset+rows < doc.num_lines:
-        end_index = doc.line_offsets[yoffset+rows]
-    else:
-        end_index = len(doc.content)
-    
-    doc_lines = doc.content[start_index:end_index].splitlines()
-    
-    lines = []
-    for line in doc_lines:
-        line = line.replace('\t', ' '*doc.tab_size)
-        lines.append(pad(line[xoffset:xoffset+chars], chars, tab_size))
-    pl = widget.create_pango_layout("\n".join(lines))
+    text = line.replace('\t', ' '*tab_size)
+    pl = widget.create_pango_layout(pad(text[xoffset:xoffset+chars], chars,
+                                        tab_size))
+    pl.set_font_description(font)
 
     # build the list of pango attributes
     attrs = pango.AttrList()
     start_index = 0
-    ltokens = line_tokens(tokens, tab_size)
-    for ttype, length in clipped_tokens(ltokens, xoffset, chars):
-        if not ttype is Token.Text.Whitespace:
-            style = get_style_for_ttype(ttype)
-
+    ltokens = line_tokens([line], [spans], tab_size)
+    for style, length in clipped_tokens(ltokens, xoffset, chars):
+        if style is not None:
             fg = colours[style]['pango']
             fg_attr = pango.AttrForeground(red=fg.red,
                green=fg.green,
@@ -185,72 +122,80 @@ def make_pango_layout(view, widget=None):
 
         start_index += length
 
-
     pl.set_attributes(attrs)
 
     return pl
 
-def add_selection_to_layout(pl, colours, doc, selection, offset, size):
-    yoffset, xoffset = offset
-    chars, rows = size
-    selection = selection.get_normalised()
-    
-    sel_start = doc.offset_to_cursor_pos(selection.start)
-    sel_end = doc.offset_to_cursor_pos(selection.end)
-    
-    #print selection.start, selection.end, sel_start, sel_end
-    
-    scr_start = offset
-    lastline_num = min(yoffset+rows-1, doc.num_lines-1)
-    scr_end = (lastline_num, chars)
-    
-    # we're going to add attributes to this
-    attrs = pl.get_attributes()
-    
-    # if the selection starts before the last position displayed and
-    # it ends after the first position displayed, then the selection is
-    # on screen
-    if not (min(scr_end, sel_start) == sel_start and \
-       min(scr_start, sel_end) == scr_start):
-        # short-circuit so that we don't set all the attrs for nothing
-        return
-        
-    start = max(sel_start, scr_start)
-    end = min(sel_end, scr_end)
+def make_line_layouts(view, font, cache, widget=None):
+    """
+    Return a list with a pango layout for each line on the screen.
 
-    endline_num = end[0]
+    The layouts get reused from cache (an LRUCache) when the same text with
+    the same styles got laid out before at the same horizontal scroll
+    position, width and colours, so only lines that changed get laid out
+    again.
+    """
 
-    # work out the character positions to actual screen positions
-    # by converting characters to spaces
-    sy, sx = start
-    sline = doc.get_line(sy)
-    sx = char_pos_to_tab_pos(sline, sx, doc.tab_size)
-    ey, ex = end
-    eline = doc.get_line(ey)
-    ex = char_pos_to_tab_pos(eline, ex, doc.tab_size)
+    doc = view.document
+    yoffset, xoffset = map(int, view.scroll_pos)
+    chars, rows = map(int, view.textbox_dimensions)
+    colours = view.colours
+    tab_size = doc.tab_size
 
-    # cap the positions so that it is only the bit that's on screen
-    start_pos = (cap(sy-yoffset, 0, rows), cap(sx-xoffset, 0, chars))
-    end_pos = (cap(ey-yoffset, 0, rows), cap(ex-xoffset, 0, chars))
+    if not widget:
+        widget = view.textarea.drawingarea
 
-    sy, sx = start_pos
-    ey, ex = end_pos
-    if endline_num != sel_end[0]:
+    # only tokens for the lines that are on the screen
+    token_lines = doc.tokenizer.get_line_tokens(yoffset, yoffset+rows-1,
+                                                GTK_STYLES)
+
+    # everything but the line's own content that the layout depends on
+    screen_key = (xoffset, chars, tab_size, view.colours_key)
+
+    layouts = []
+    for y, spans in enumerate(token_lines, yoffset):
+        line = doc.get_line(y)
+        key = (line, tuple(spans), screen_key)
+        pl = cache.get(key)
+        if pl is None:
+            pl = make_line_layout(widget, font, colours, line, spans,
+                                  xoffset, chars, tab_size)
+            cache[key] = pl
+        layouts.append(pl)
+
+    return layouts
+
+def get_line_selection(doc, selection, y, xoffset, chars):
+    """
+    Return (start, end) for the columns on the screen that are selected in
+    line y or None if none of them are. selection has to be normalised.
+    """
+
+    sy, sx = doc.offset_to_cursor_pos(selection.start)
+    ey, ex = doc.offset_to_cursor_pos(selection.end)
+    if y < sy or y > ey:
+        return None
+
+    # work out the character positions to actual screen positions
+    # by converting characters to spaces
+    line = doc.get_line(y)
+    if y == sy:
+        start = char_pos_to_tab_pos(line, sx, doc.tab_size)
+    else:
+        start = 0
+    if y == ey:
+        end = char_pos_to_tab_pos(line, ex, doc.tab_size)
+    else:
         # if this isn't the last line of the selection, then the
         # selection has to go to the end of the screen
-        ex = chars
-
-    # convert the (y, x) coordinates to indexes into the layout text
-    start_index = sy*(chars+1)+sx # 1 for line ending
-    end_index = ey*(chars+1)+ex
+        end = xoffset+chars
 
-    # add the selection attribute
-    bg = colours['sel']['pango']
-    attr = pango.AttrBackground(red=bg.red, green=bg.green, \
-        blue=bg.blue, start_index=start_index, end_index=end_index)
-    attrs.insert(attr)
-    
-    pl.set_attributes(attrs)
+    # cap the positions so that it is only the bit that's on screen
+    start = cap(start-xoffset, 0, chars)
+    end = cap(end-xoffset, 0, chars)
+    if start == end:
+        return None
+    return start, end
 
 #def add_selection_to_layout(pl, colours, doc, selection, offset, size):
 #    xoffset, yoffset = offset
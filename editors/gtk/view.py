@@ -19,7 +19,9 @@ class GTKView(View):
             mode = 'plain'
         self._colours = get_gtk_colours(self.textarea.drawingarea,
                                         colourscheme, mode)
-        self.textarea.pl = None
+        # cached layouts with other colours don't get used for this view
+        self._colours_key = (colourscheme.name, mode)
+        self.textarea.layouts = None
 
     def get_colours(self):
         if not hasattr(self, '_colours'):
@@ -27,6 +29,12 @@ class GTKView(View):
         return self._colours
     colours = property(get_colours)
 
+    def get_colours_key(self):
+        if not hasattr(self, '_colours'):
+            self.set_colours()
+        return self._colours_key
+    colours_key = property(get_colours_key)
+
     def _get_textbox_dimensions(self):
         return self.textarea.textbox_dimensions
     textbox_dimensions = property(_get_textbox_dimensions)
@@ -91,9 +99,9 @@ class GTKView(View):
         self.textarea.is_cursor_visible = True
 
         if isinstance(action, EditAction):
-            # edit actions always change the document, so the pango layout
-            # is invalid
-            self.textarea.pl = None
+            # edit actions always change the document, so the pango layouts
+            # are invalid
+            self.textarea.layouts = None
 
             # notify the relevant searches
             for search in self.editor.searches:
@@ -108,15 +116,17 @@ class GTKView(View):
 
         if self.scroll_pos != old_scroll_pos or \
            self.textarea.view != old_view:
-            # the pango layout is invalid because we scrolled or switched
+            # the pango layouts are invalid because we scrolled or switched
             # views
-            self.textarea.pl = None
+            self.textarea.layouts = None
 
         # we might have made a new selection where we didn't have one 
         # before or we might have removed the selection. So the selection
         # controls/actions might have to be enabled or disabled
         self.sync_selection()
         
-        # trigger a redraw because the view got invalidated
-        self.textarea.redraw()
+        # trigger a redraw because the view got invalidated (this only
+        # repaints everything if more than the scroll position and the
+        # cursor's line changed)
+        self.textarea.update()
         
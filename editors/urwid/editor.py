@@ -7,7 +7,8 @@ from ni.editors.base.editor import Editor
 from ni.editors.urwid.dialogs import *
 from ni.actions.defaultactions import *
 from ni.core.stack import Stack
-from ni.editors.urwid.utils import make_statusline, get_urwid_lines_attrs
+from ni.editors.urwid.utils import make_statusline, get_urwid_lines_attrs, \
+  URWID_STYLES
 from ni.editors.urwid.view import UrwidView
 from ni.core.document import Document, load_document
 
@@ -102,9 +103,14 @@ class UrwidTextWidget(urwid.BoxWidget):
         cursory, cursorx = view.cursor_pos
 
         starty, startx = view.scroll_pos
-        tokens = doc.tokenizer.get_normalised_tokens(starty, starty+maxrow-1)
+        token_lines = doc.tokenizer.get_line_tokens(starty, starty+maxrow-1,
+                                                    URWID_STYLES)
+        text_lines = [doc.get_line(y) for y in
+                      xrange(starty, starty+len(token_lines))]
 
-        lines, attrs = get_urwid_lines_attrs((maxcol, maxrow), view.scroll_pos, tokens, view.selection)
+        lines, attrs = get_urwid_lines_attrs((maxcol, maxrow), view.scroll_pos,
+                                             text_lines, token_lines,
+                                             view.selection)
 
         lines = [l.encode(doc.encoding) for l in lines]
 
@@ -249,9 +255,11 @@ class UrwidEditor(Editor):
     def copy_view(self):
         title = self.get_next_title()
         s = self.settings
-        new_doc = Document(encoding=s.file_encoding, linesep=s.linesep, tab_size=s.tab_size, title=title)
         doc = self.view.document
-        new_doc.insert(0, doc.content)
+        if doc.is_loading:
+            # the copy would only get the part that got loaded so far
+            return None
+        new_doc = Document(encoding=s.file_encoding, linesep=s.linesep, tab_size=s.tab_size, title=title, content=doc.rope)
         # erm...
         new_view = GTKView(self, new_doc)
         self.views.append(new_view)
@@ -418,8 +426,22 @@ class UrwidEditor(Editor):
 
             self.draw()
 
+            # Don't block waiting for input while the document still needs
+            # lexing. get_input() returns no events once it times out and
+            # then we lex a bit more.
+            if self.top == self.edit_frame and \
+               not self.view.document.is_lexed:
+                self.ui.set_input_timeouts(max_wait=0)
+            else:
+                self.ui.set_input_timeouts(max_wait=None)
+
             events = self.ui.get_input()
 
+            if not events and self.top == self.edit_frame:
+                more, redraw = self.view.lex_ahead()
+                if redraw:
+                    self.redraw_all = True
+
             for event in events:
                 if event == "window resize":
                     continue
@@ -1,4 +1,5 @@
 from pygments.token import Token
+from ni.core.styles import StyleTable
 
 
 def make_statusline(size, left="", center="", right="", leftstyle='statusbar' ,\
@@ -45,47 +46,34 @@ def make_statusline(size, left="", center="", right="", leftstyle='statusbar' ,\
 
     return markup
 
-def get_urwid_lines_attrs((columns, rows), (scrolly, scrollx), tokens, selection):
-    """return lines, attrs"""
-
-
-    def get_style(ttype):
-        if ttype in Token.Text:
-            return 'plain'
-        #if ttype in Token.Selection:
-        #    return 'selection'
-        if ttype in Token.Error:
-            return 'error'
-        if ttype in Token.Other:
-            return 'other'
-        if ttype in Token.Keyword:
-            return 'keyword'
-        if ttype in Token.Name:
-            return 'name'
-        if ttype in Token.Literal:
-            return 'literal'
-        if ttype in Token.Operator:
-            return 'operator'
-        if ttype in Token.Punctuation:
-            return 'punctuation'
-        if ttype in Token.Comment:
-            return 'comment'
-        if ttype in Token.Generic:
-            return 'generic'
+URWID_STYLES = StyleTable([
+    (Token.Text, 'plain'),
+    (Token.Error, 'error'),
+    (Token.Other, 'other'),
+    (Token.Keyword, 'keyword'),
+    (Token.Name, 'name'),
+    (Token.Literal, 'literal'),
+    (Token.Operator, 'operator'),
+    (Token.Punctuation, 'punctuation'),
+    (Token.Comment, 'comment'),
+    (Token.Generic, 'generic'),
+])
+
+def get_urwid_lines_attrs((columns, rows), (scrolly, scrollx), text_lines,
+                          token_lines, selection):
+    """
+    return lines, attrs
+
+    text_lines are the lines on the screen and token_lines their tokens from
+    Tokenizer.get_line_tokens() with URWID_STYLES.
+    """
 
-    lines = []
-    current_line = []
-
-    for ttype, value in tokens:
-        style = get_style(ttype)
-        for char in value:
-            if char == '\n':
-                lines.append(current_line)
-                current_line = []
-            else:
-                current_line.append((style, char))
 
-    if current_line:
+    lines = []
+    for text, spans in zip(text_lines, token_lines):
+        current_line = []
+        for style, start, end in spans:
+            current_line.extend([(style, char) for char in text[start:end]])
         lines.append(current_line)
 
     # make sure line length is columns max, starting from scrollx
@@ -549,6 +549,96 @@ class TestDefaultActions(unittest.TestCase):
 #        assert self.document.get_content() == TEXT_DATA
 #        assert self.cursor_pos == SECOND_LINE_END
 
+    def test_InsertText_merge(self):
+        self.view.cursor_pos = (0, 0)
+        undo_stack = self.document.undo_stack
+        for char in 'abc':
+            action = InsertText(self.view, char)
+            action.execute()
+            undo_stack.push(action, merge=True)
+        assert len(undo_stack) == 1
+        assert self.document.content == 'abc'+TEXT_DATA
+        assert self.view.cursor_pos == (0, 3)
+
+        undo_stack.last().undo()
+        assert self.document.content == TEXT_DATA
+        assert self.view.cursor_pos == (0, 0)
+
+        undo_stack.last().redo()
+        assert self.document.content == 'abc'+TEXT_DATA
+        assert self.view.cursor_pos == (0, 3)
+
+    def test_InsertText_no_merge(self):
+        self.view.cursor_pos = (0, 0)
+        undo_stack = self.document.undo_stack
+        for text in ['a', 'bc', 'd']:
+            action = InsertText(self.view, text)
+            action.execute()
+            undo_stack.push(action, merge=True)
+        # a multi-character insert doesn't get merged
+        assert len(undo_stack) == 2
+
+    def test_DeleteTextBackward_merge(self):
+        self.view.cursor_pos = (1, 5)
+        undo_stack = self.document.undo_stack
+        for x in xrange(3):
+            action = DeleteTextBackward(self.view)
+            action.execute()
+            undo_stack.push(action, merge=True)
+        assert len(undo_stack) == 1
+        assert self.document.get_line(1) == 'a g leaps in'
+        assert self.view.cursor_pos == (1, 2)
+
+        undo_stack.last().undo()
+        assert self.document.content == TEXT_DATA
+        assert self.view.cursor_pos == (1, 5)
+
+    def test_Indent_selection_batch(self):
+        self.view.selection = Selection(self.document, 0, len(TEXT_DATA)-1)
+        self.view.cursor_pos = (2, 13)
+        action = Indent(self.view)
+        action.execute()
+        lines = TEXT_DATA.split('\n')
+        assert self.document.content == '\n'.join('    '+l for l in lines)
+        # all the lines got indented by one delta
+        assert len(action.deltas) == 1
+
+        action.undo()
+        assert self.document.content == TEXT_DATA
+        action.redo()
+        assert self.document.content == '\n'.join('    '+l for l in lines)
+
+    def test_Unindent_selection_batch(self):
+        lines = TEXT_DATA.split('\n')
+        self.document.insert(0, '  ')
+        self.document.insert(self.document.cursor_pos_to_offset((2, 0)), '    ')
+        indented = self.document.content
+        self.view.selection = Selection(self.document, 0,
+                                        len(indented)-1)
+        self.view.cursor_pos = (2, 17)
+        action = Unindent(self.view)
+        action.execute()
+        assert self.document.content == TEXT_DATA
+        assert len(action.deltas) == 1
+
+        action.undo()
+        assert self.document.content == indented
+
+    def test_ToggleComment_batch(self):
+        self.document.insert(self.document.cursor_pos_to_offset((1, 0)), '#')
+        commented = self.document.content
+        self.view.selection = Selection(self.document, 0,
+                                        len(commented)-1)
+        action = ToggleHashComment(self.view)
+        action.execute()
+        assert self.document.get_line(0) == '#old pond...'
+        assert self.document.get_line(1) == 'a frog leaps in'
+        assert self.document.get_line(2) == "#water's sound"
+        assert len(action.deltas) == 1
+
+        action.undo()
+        assert self.document.content == commented
+
     def test_CopyToClipboard(self):
         action = CopyToClipboard(self.view)
         action.execute()
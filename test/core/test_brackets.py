@@ -0,0 +1,151 @@
+import random
+from nose.tools import *
+from ni.core.document import Document, InsertDelta, DeleteDelta
+from ni.core.brackets import OPEN_BRACKETS, CLOSE_BRACKETS
+
+
+CODE = u'''def foo(x, y):
+    return {'a': [x, (y)], "b(": bar()}
+
+def bar(*args):
+    return ([1, 2], [3, (4, 5)])
+'''
+
+def make_document(code=CODE):
+    doc = Document(location='/tmp/ni-test-brackets.py', content=code)
+    doc.update_tokens((0, 0), (80, 25), to_end=True)
+    return doc
+
+def brute_force_match(doc, offset):
+    """Find the match of the bracket at offset by walking the tokens."""
+
+    brackets = doc.tokenizer.brackets
+    chars = zip(brackets.offsets, brackets.chars)
+    index = [o for o, c in chars].index(offset)
+    char = chars[index][1]
+    if char in OPEN_BRACKETS:
+        matching, step, others = OPEN_BRACKETS[char], 1, chars[index+1:]
+    else:
+        matching, step, others = CLOSE_BRACKETS[char], -1, \
+            list(reversed(chars[:index]))
+    stack = 0
+    for o, c in others:
+        if c == char:
+            stack += 1
+        elif c == matching:
+            if stack:
+                stack -= 1
+            else:
+                return o
+    return None
+
+def check_brackets(doc):
+    doc.update_tokens((0, 0), (80, 25), to_end=True)
+    index = doc.tokenizer.brackets
+    index.find_match(-1)
+    for offset in list(index.offsets):
+        assert index.find_match(offset) == brute_force_match(doc, offset)
+
+    # the incrementally updated brackets are the same as freshly scanned ones
+    offsets, chars = list(index.offsets), list(index.chars)
+    depths = [index.depth(offset) for offset in offsets]
+    index.clear()
+    assert index.find_match(-1) is None
+    assert list(index.offsets) == offsets
+    assert index.chars == chars
+    assert [index.depth(offset) for offset in offsets] == depths
+
+def test_find_match():
+    doc = make_document()
+    brackets = doc.tokenizer.brackets
+    open_offset = CODE.index(u'{')
+    close_offset = CODE.index(u'}')
+    assert brackets.find_match(open_offset) == close_offset
+    assert brackets.find_match(close_offset) == open_offset
+    assert brackets.find_match(CODE.index(u'(y)')) == CODE.index(u'(y)')+2
+
+    # brackets inside strings don't count
+    assert brackets.find_match(CODE.index(u'b(')+1) is None
+    assert brackets.find_match(0) is None
+
+def test_unmatched():
+    doc = make_document(u'x = (1, [2\ny = 3)\n')
+    brackets = doc.tokenizer.brackets
+    assert brackets.find_match(4) == 16
+    assert brackets.find_match(8) is None
+
+def test_find_enclosing():
+    doc = make_document()
+    brackets = doc.tokenizer.brackets
+    offset = CODE.index(u'x, (y)')
+    assert brackets.find_enclosing(offset) == \
+        (CODE.index(u'['), CODE.index(u']'))
+    assert brackets.find_enclosing(CODE.index(u'"b(')) == \
+        (CODE.index(u'{'), CODE.index(u'}'))
+    assert brackets.find_enclosing(CODE.index(u'def bar')) is None
+    assert brackets.find_enclosing(len(CODE)-5) == \
+        (CODE.rindex(u'('), len(CODE)-4)
+
+def test_depth():
+    doc = make_document()
+    brackets = doc.tokenizer.brackets
+    assert brackets.depth(0) == 0
+    assert brackets.depth(CODE.index(u'x,')) == 1
+    assert brackets.depth(CODE.index(u'y)]')) == 3
+    assert brackets.depth(CODE.index(u'def bar')) == 0
+    assert brackets.depth(CODE.index(u'4, 5')) == 3
+
+def test_edits():
+    doc = make_document(CODE*3)
+    check_brackets(doc)
+    InsertDelta(doc, CODE.index(u'{'), u'[(').do()
+    check_brackets(doc)
+    DeleteDelta(doc, len(CODE)+CODE.index(u'return'), 10).do()
+    check_brackets(doc)
+    InsertDelta(doc, 5, u'"""').do()
+    check_brackets(doc)
+
+def test_random_edits():
+    rnd = random.Random(18)
+    doc = make_document(CODE*10)
+    for i in xrange(60):
+        offset = rnd.randint(0, doc.num_chars)
+        if rnd.random() < 0.6:
+            text = u''.join(rnd.choice(u'()[]{}x "\n') for j in xrange(3))
+            InsertDelta(doc, offset, text).do()
+        else:
+            DeleteDelta(doc, offset, min(rnd.randint(1, 5),
+                                         doc.num_chars-offset)).do()
+        if i % 6 == 0:
+            check_brackets(doc)
+    check_brackets(doc)
+
+def test_backtrack_edits():
+    doc = Document(location='/tmp/ni-test-brackets.html',
+                   content=u'<p>{{ f(x[1]) }}</p>\n<script>g({a: [1]});'
+                           u'</script>\n'*5)
+    check_brackets(doc)
+    InsertDelta(doc, 40, u'(').do()
+    check_brackets(doc)
+    DeleteDelta(doc, 7, 2).do()
+    check_brackets(doc)
+
+def test_edit_keeps_depths():
+    doc = make_document(CODE*3)
+    brackets = doc.tokenizer.brackets
+    close_offset = len(CODE)+CODE.index(u'}')
+    assert brackets.find_match(CODE.index(u'{')) == CODE.index(u'}')
+
+    # typing something that isn't a bracket just moves the brackets
+    InsertDelta(doc, CODE.index(u'x, y'), u'zz').do()
+    doc.update_tokens((0, 0), (80, 25), to_end=True)
+    assert brackets._num_depths == len(brackets.offsets)
+    assert brackets.find_match(close_offset+2) == \
+        len(CODE)+CODE.index(u'{')+2
+    check_brackets(doc)
+
+    # typing a bracket changes the depths after it
+    InsertDelta(doc, CODE.index(u'x, y'), u'(').do()
+    doc.update_tokens((0, 0), (80, 25), to_end=True)
+    assert brackets._num_depths < len(brackets.offsets)
+    check_brackets(doc)
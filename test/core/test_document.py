@@ -3,7 +3,8 @@ import unittest
 import tempfile
 from nose.tools import *
 from pygments.token import Token
-from ni.core.document import Document, load_document, InsertDelta, DeleteDelta
+from ni.core.document import Document, load_document, InsertDelta, \
+    DeleteDelta, BatchDelta, DocumentLoader
 
 
 #Hello\nthere\nWhat's up with you?\n\n\n
@@ -85,6 +86,279 @@ def test_line_offsets_insert_end():
     doc.insert(len(doc.content), "another line\n")    
     assert doc.line_offsets == [0, 6, 12, 32, 33, 47]
 
+def make_saved_document():
+    fd, location = tempfile.mkstemp()
+    os.close(fd)
+    doc = Document(title="Untitled", content=OFFSETS_STRING)
+    doc.save(location)
+    return doc
+
+def test_is_modified_new_document():
+    doc = Document(title="Untitled")
+    assert not doc.is_modified
+    doc.insert(0, "Hello")
+    assert doc.is_modified
+
+def test_is_modified_after_save():
+    doc = make_saved_document()
+    assert not doc.is_modified
+    doc.insert(0, "#")
+    assert doc.is_modified
+    os.unlink(doc.location)
+
+def test_is_modified_undo_redo():
+    doc = make_saved_document()
+    insert = InsertDelta(doc, 0, "#")
+    delete = DeleteDelta(doc, 6, 6)
+    insert.do()
+    delete.do()
+    assert doc.is_modified
+    delete.undo()
+    insert.undo()
+    assert not doc.is_modified
+    insert.do()
+    assert doc.is_modified
+    doc.save()
+    insert.undo()
+    assert doc.is_modified
+    insert.do()
+    assert not doc.is_modified
+    os.unlink(doc.location)
+
+def test_save_keeps_tokens():
+    doc = make_saved_document()
+    old_location = doc.location
+    tokenizer = doc.tokenizer
+    doc.save()
+    assert doc.tokenizer is tokenizer
+
+    fd, location = tempfile.mkstemp(suffix='.py')
+    os.close(fd)
+    doc.save(location)
+    assert doc.tokenizer is not tokenizer
+    assert doc.tokenizer.lexer.name == 'Python'
+    assert not doc.is_lexed
+    os.unlink(location)
+    os.unlink(old_location)
+
+def test_apply_edits():
+    doc = Document(title="Untitled", content=OFFSETS_STRING)
+    state = doc.state
+    undo_edits = doc.apply_edits([(0, 0, u'> '), (6, 5, u'here'),
+                                  (12, 4, u'')])
+    assert doc.content == u"> Hello\nhere\n's up with you?\n\n\n"
+    assert doc.state != state
+    assert doc._relex_from == 0
+    doc.apply_edits(undo_edits)
+    assert doc.content == OFFSETS_STRING
+
+def test_batch_delta():
+    doc = make_saved_document()
+    edits = [(doc.cursor_pos_to_offset((y, 0)), 0, u'  ')
+             for y in xrange(doc.num_lines)]
+    delta = BatchDelta(doc, edits)
+    delta.do()
+    assert doc.line_offsets == [0, 8, 16, 38, 41, 44]
+    assert doc.is_modified
+    delta.undo()
+    assert doc.content == OFFSETS_STRING
+    assert not doc.is_modified
+    delta.do()
+    assert doc.get_line(2) == u"  What's up with you?"
+    os.unlink(doc.location)
+
+def test_snapshot():
+    doc = Document(title="Untitled", content=OFFSETS_STRING)
+    snapshot = doc.snapshot()
+    assert snapshot.version == doc.version
+    doc.insert(0, "Well, ")
+    doc.delete(10, 6)
+    assert doc.version == snapshot.version+2
+    assert snapshot.content == OFFSETS_STRING
+    assert snapshot.get_line(1) == u'there'
+    assert snapshot.num_lines == 6
+    assert snapshot.offset_to_cursor_pos(8) == (1, 2)
+
+def test_map_offset():
+    doc = Document(title="Untitled", content=OFFSETS_STRING)
+    snapshot = doc.snapshot()
+    # "there" starts at 6 and "What" at 12
+    doc.insert(0, "Well, ")
+    doc.delete(12, 4)
+    assert doc.content == u"Well, Hello\ne\nWhat's up with you?\n\n\n"
+    assert snapshot.map_offset(0) == 6
+    assert snapshot.map_offset(7) == 12
+    assert snapshot.map_offset(12) == 14
+    assert doc.map_offset(12, doc.version) == 12
+
+    doc.apply_edits([(0, 6, u''), (12, 0, u'>')])
+    assert doc.get_text(0, 10) == u'Hello\n>e\nW'
+    assert snapshot.map_offset(0) == 0
+    assert snapshot.map_offset(12) == 9
+
+def test_map_offset_too_old():
+    import ni.core.document
+    doc = Document(title="Untitled", content=OFFSETS_STRING)
+    old_version = doc.version
+    for i in xrange(ni.core.document.EDIT_LOG_SIZE+1):
+        doc._log_edit(0, 0, 1)
+    assert doc.map_offset(0, old_version) is None
+    assert doc.map_offset(0, old_version+1) == ni.core.document.EDIT_LOG_SIZE
+
+def test_get_changed_range():
+    import ni.core.document
+    doc = Document(title="Untitled", content=OFFSETS_STRING)
+    version = doc.version
+    assert doc.get_changed_range(version) is None
+    doc.insert(6, u"over ")
+    assert doc.get_changed_range(version) == (6, 11, 5)
+    # an edit before the range moves it
+    doc.delete(0, 1)
+    assert doc.get_changed_range(version) == (0, 10, 4)
+    assert doc.get_changed_range(version+1) == (0, 0, -1)
+    for i in xrange(ni.core.document.EDIT_LOG_SIZE):
+        doc._log_edit(0, 0, 1)
+    assert doc.get_changed_range(version) is False
+
+class MockSettings(object):
+    tab_size = 8
+
+    def get_token_cache_dir(self):
+        return None
+
+def test_load_huge_document():
+    import ni.core.document
+    fd, location = tempfile.mkstemp(suffix='.py')
+    os.write(fd, OFFSETS_STRING.replace('\n', '\r\n'))
+    os.close(fd)
+    old_size = ni.core.document.HUGE_FILE_SIZE
+    ni.core.document.HUGE_FILE_SIZE = 0
+    try:
+        doc = load_document(location, MockSettings())
+        assert doc.is_huge
+        assert doc.linesep == '\r\n'
+        assert doc.tokenizer.lexer is None
+        assert doc.line_offsets == [0, 6, 12, 32, 33, 34]
+        assert not doc.is_modified
+
+        doc.insert(0, "#")
+        assert doc.is_modified
+        assert doc.get_line(0) == u'#Hello'
+        doc.delete(0, 1)
+        assert not doc.is_modified
+
+        doc.insert(6, "another line\n")
+        doc.save()
+        assert not doc.is_modified
+        f = open(location)
+        assert f.read() == "Hello\r\nanother line\r\nthere\r\n" \
+                           "What's up with you?\r\n\r\n\r\n"
+        f.close()
+    finally:
+        ni.core.document.HUGE_FILE_SIZE = old_size
+        os.unlink(location)
+
+def test_huge_document_reads_start_only():
+    from ni.core.mappedtext import MappedText
+    fd, location = tempfile.mkstemp()
+    os.write(fd, OFFSETS_STRING*100)
+    os.close(fd)
+    try:
+        mapped = MappedText(location, block_size=16)
+        doc = Document(location=location, content=mapped)
+        assert doc.get_line(0) == u'Hello'
+        assert doc.get_line_width(1) == 5
+        assert doc.cursor_pos_to_offset((1, 100)) == 11
+        assert doc.offset_to_cursor_pos(8) == (1, 2)
+        # none of that needed the whole file
+        assert not mapped._complete
+
+        assert doc.cursor_pos_to_offset((1000, 0)) == len(OFFSETS_STRING*100)
+        assert doc.offset_to_cursor_pos(10**6) == (doc.num_lines-1, 0)
+    finally:
+        os.unlink(location)
+
+def test_huge_document_index_ahead():
+    from ni.core.mappedtext import MappedText
+    fd, location = tempfile.mkstemp()
+    os.write(fd, OFFSETS_STRING*100)
+    os.close(fd)
+    try:
+        mapped = MappedText(location, block_size=16)
+        doc = Document(location=location, content=mapped)
+        assert not doc.is_indexed
+        assert doc.estimate_num_lines() > 1
+        assert doc.count_lines(3) == 3
+        assert not doc.is_indexed
+
+        steps = 0
+        while doc.index_ahead(0):
+            steps += 1
+        assert steps > 1
+        assert doc.is_indexed
+        assert doc.estimate_num_lines() == doc.num_lines == 501
+        assert doc.count_lines(10**6) == 501
+
+        # other documents always know how many lines they have
+        doc = Document(title='Untitled', content=OFFSETS_STRING)
+        assert doc.is_indexed
+        assert not doc.index_ahead()
+        assert doc.estimate_num_lines() == doc.num_lines == 6
+    finally:
+        os.unlink(location)
+
+def test_document_loader():
+    fd, location = tempfile.mkstemp()
+    os.write(fd, OFFSETS_STRING*10)
+    os.close(fd)
+    try:
+        loader = DocumentLoader(location, MockSettings(), 16)
+        doc = loader.document
+        assert doc.is_loading
+        assert doc.get_line(0) == u'Hello'
+        assert doc.num_chars < len(OFFSETS_STRING*10)
+
+        progress = []
+        def callback(loader):
+            progress.append(loader.progress)
+        loader.run(callback)
+
+        assert progress == sorted(progress)
+        assert not doc.is_loading
+        assert doc.content == OFFSETS_STRING*10
+        assert doc.num_lines == 51
+        assert doc.linesep == '\n'
+        assert not doc.is_modified
+    finally:
+        os.unlink(location)
+
+def test_is_modified_same_content():
+    doc = make_saved_document()
+    doc.delete(0, 5)
+    doc.insert(0, "Hello")
+    assert doc.state != doc._modified_info['state']
+    assert not doc.is_modified
+    doc.delete(0, 5)
+    doc.insert(0, "Jello")
+    assert doc.is_modified
+    os.unlink(doc.location)
+
+def test_is_modified_same_checksum():
+    fd, location = tempfile.mkstemp()
+    os.close(fd)
+    doc = Document(title="Untitled", content=u'aca')
+    doc.save(location)
+    # "aca" and "bab" have the same adler32 checksum
+    doc.delete(0, 3)
+    doc.insert(0, u'bab')
+    assert doc._text.checksum() == doc._modified_info['text'].checksum()
+    assert doc.is_modified
+    assert doc.is_modified
+    doc.delete(0, 3)
+    doc.insert(0, u'aca')
+    assert not doc.is_modified
+    os.unlink(location)
+
 
 #def test_blank_document_location():
 #    doc = Document(location='/tmp/test.txt')
@@ -460,3 +734,25 @@ def test_line_offsets_insert_end():
 #        # check content
 #        assert doc.get_content() == self.content
 
+
+def test_save_while_loading():
+    fd, location = tempfile.mkstemp()
+    os.write(fd, OFFSETS_STRING*10)
+    os.close(fd)
+    try:
+        loader = DocumentLoader(location, MockSettings(), 16)
+        doc = loader.document
+        loader.step()
+        assert doc.is_loading
+        # saving loads the rest first instead of truncating the file
+        doc.save()
+        assert not doc.is_loading
+        assert open(location).read() == OFFSETS_STRING*10
+
+        loader = DocumentLoader(location, MockSettings(), 16)
+        loader.step()
+        loader.cancel()
+        assert_raises(Exception, loader.document.save)
+        assert open(location).read() == OFFSETS_STRING*10
+    finally:
+        os.unlink(location)
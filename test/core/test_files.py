@@ -6,7 +6,8 @@ import tempfile
 import shutil
 from nose.tools import *
 from ni.core.files import files_first, glob_match, is_textfile, is_text, \
-    load_textfile, filtered_files, BinaryFile
+    load_textfile, filtered_files, BinaryFile, TextFileLoader, map_textfile, \
+    write_textfile
 
 
 TEXT_DATA = u"""
@@ -138,6 +139,106 @@ class TestFiles(unittest.TestCase):
     def test_load_textfile_fail(self):
         data = load_textfile(self.binaryfilename)
 
+    # TextFileLoader
+
+    def write_file(self, data):
+        handle, name = tempfile.mkstemp(dir=self.rootpath, prefix='load')
+        os.write(handle, data)
+        os.close(handle)
+        return name
+
+    def load_chunks(self, loader):
+        chunks = []
+        while True:
+            chunk = loader.read_chunk()
+            if chunk is None:
+                break
+            chunks.append(chunk)
+        return chunks
+
+    def test_text_file_loader(self):
+        loader = TextFileLoader(self.textfilename, 16)
+        chunks = self.load_chunks(loader)
+        assert len(chunks) > 1
+        assert u''.join(chunks) == TEXT_DATA.decode('utf8')
+        assert loader.encoding == 'utf8'
+        assert loader.linesep == '\n'
+        assert loader.progress == 1.0
+        assert loader.is_done
+
+    def test_text_file_loader_crlf(self):
+        # every chunk boundary falls between a \r and a \n
+        name = self.write_file('abc\r\n'*10)
+        loader = TextFileLoader(name, 4)
+        assert u''.join(self.load_chunks(loader)) == u'abc\n'*10
+        assert loader.linesep == '\r\n'
+
+    def test_text_file_loader_split_character(self):
+        data = u'abcdefgh\u20ac'*10
+        name = self.write_file(data.encode('utf8'))
+        loader = TextFileLoader(name, 10)
+        assert u''.join(self.load_chunks(loader)) == data
+        assert loader.encoding == 'utf8'
+
+    def test_text_file_loader_bad_guess(self):
+        data = 'a'*100+u'caf\xe9\n'.encode('latin-1')
+        name = self.write_file(data)
+        loader = TextFileLoader(name, 50)
+        text = u''.join(self.load_chunks(loader))
+        assert text.startswith(u'a'*100)
+        assert loader.encoding != 'utf8'
+
+    def test_text_file_loader_cancel(self):
+        loader = TextFileLoader(self.textfilename, 16)
+        loader.read_chunk()
+        loader.cancel()
+        assert loader.cancelled
+        assert loader.read_chunk() is None
+        assert loader.progress < 1.0
+
+    @raises(BinaryFile)
+    def test_text_file_loader_fail(self):
+        loader = TextFileLoader(self.binaryfilename)
+        loader.read_chunk()
+
+    # map_textfile
+
+    def test_map_textfile(self):
+        data = map_textfile(self.textfilename)
+        assert data['content'].get_text() == TEXT_DATA.decode('utf8')
+        assert data['encoding'] == 'utf8'
+        assert data['linesep'] == '\n'
+
+    def test_map_textfile_cr(self):
+        name = self.write_file('old\rmac\rfile\r')
+        assert map_textfile(name) is None
+
+    # write_textfile
+
+    def test_write_textfile(self):
+        name = self.write_file('old content')
+        os.chmod(name, 0640)
+        write_textfile(name, [u'abc\n', u'd\u20ac\n'], 'utf8', '\r\n')
+        f = open(name, 'rb')
+        assert f.read() == u'abc\r\nd\u20ac\r\n'.encode('utf8')
+        f.close()
+        assert os.stat(name).st_mode & 07777 == 0640
+        # the temporary file got renamed, not left behind
+        assert not [n for n in os.listdir(self.rootpath)
+                    if n.startswith('.ni-')]
+
+    def test_write_textfile_fail(self):
+        name = self.write_file('old content')
+        def chunks():
+            yield u'new'
+            raise IOError()
+        assert_raises(IOError, write_textfile, name, chunks(), 'utf8')
+        f = open(name, 'rb')
+        assert f.read() == 'old content'
+        f.close()
+        assert not [n for n in os.listdir(self.rootpath)
+                    if n.startswith('.ni-')]
+
     # filtered_files
 
     def test_filtered_files_all(self):
@@ -0,0 +1,40 @@
+from nose.tools import *
+from ni.core.lru import LRUCache
+
+
+def test_get():
+    cache = LRUCache(2)
+    cache['a'] = 1
+    assert cache.get('a') == 1
+    assert cache.get('b') is None
+    assert cache.get('b', 2) == 2
+    assert 'a' in cache
+    assert not 'b' in cache
+
+def test_eviction():
+    cache = LRUCache(2)
+    cache['a'] = 1
+    cache['b'] = 2
+    # using a makes b the least recently used entry
+    cache.get('a')
+    cache['c'] = 3
+    assert len(cache) == 2
+    assert not 'b' in cache
+    assert cache.get('a') == 1
+    assert cache.get('c') == 3
+
+def test_set_existing():
+    cache = LRUCache(2)
+    cache['a'] = 1
+    cache['b'] = 2
+    cache['a'] = 3
+    cache['c'] = 4
+    assert cache.get('a') == 3
+    assert not 'b' in cache
+
+def test_clear():
+    cache = LRUCache(2)
+    cache['a'] = 1
+    cache.clear()
+    assert len(cache) == 0
+    assert cache.get('a') is None
@@ -0,0 +1,129 @@
+import os
+import zlib
+import tempfile
+from nose.tools import *
+from ni.core.mappedtext import MappedText
+from ni.core.rope import Rope
+
+
+TEXT = u"first line\n\tsecond line \u20ac\n\nfourth line\n"*200
+
+def make_file(data):
+    fd, filename = tempfile.mkstemp()
+    os.write(fd, data)
+    os.close(fd)
+    return filename
+
+def line_starts(text):
+    starts = [0]
+    for i, char in enumerate(text):
+        if char == '\n':
+            starts.append(i+1)
+    return starts
+
+def test_get_text():
+    filename = make_file(TEXT.encode('utf8'))
+    try:
+        mapped = MappedText(filename, block_size=100)
+        assert mapped.get_text(0, 10) == TEXT[:10]
+        # only the start of the file got indexed so far
+        assert mapped._byte_starts[-1] < len(TEXT)
+        assert mapped.get_text(95, 130) == TEXT[95:130]
+        assert mapped.get_text() == TEXT
+        assert len(mapped) == len(TEXT)
+        assert mapped.num_blocks > 1
+    finally:
+        os.unlink(filename)
+
+def test_lines():
+    filename = make_file(TEXT.encode('utf8'))
+    try:
+        mapped = MappedText(filename, block_size=100)
+        starts = line_starts(TEXT)
+        assert mapped.line_start(5) == starts[5]
+        assert mapped.num_lines == len(starts)
+        for y, start in enumerate(starts):
+            assert mapped.line_start(y) == start
+            assert mapped.count_newlines(start) == y
+        assert mapped.count_tabs() == TEXT.count('\t')
+    finally:
+        os.unlink(filename)
+
+@raises(IndexError)
+def test_line_start_out_of_range():
+    filename = make_file(TEXT.encode('utf8'))
+    try:
+        mapped = MappedText(filename)
+        mapped.line_start(len(line_starts(TEXT)))
+    finally:
+        os.unlink(filename)
+
+def test_crlf():
+    filename = make_file(TEXT.replace('\n', '\r\n').encode('utf8'))
+    try:
+        mapped = MappedText(filename, block_size=100)
+        assert mapped.get_text() == TEXT
+        assert mapped.line_start(2) == line_starts(TEXT)[2]
+    finally:
+        os.unlink(filename)
+
+def test_empty_file():
+    filename = make_file('')
+    try:
+        mapped = MappedText(filename)
+        assert len(mapped) == 0
+        assert mapped.num_lines == 1
+        assert mapped.get_text() == u''
+    finally:
+        os.unlink(filename)
+
+def test_checksum():
+    filename = make_file(TEXT.encode('utf8'))
+    try:
+        mapped = MappedText(filename, block_size=100)
+        expected = zlib.adler32(TEXT.encode('utf8')) & 0xffffffff
+        assert mapped.checksum() == expected
+        assert mapped.to_rope().checksum() == expected
+    finally:
+        os.unlink(filename)
+
+def test_to_rope():
+    filename = make_file(TEXT.encode('utf8'))
+    try:
+        mapped = MappedText(filename, block_size=100)
+        rope = mapped.to_rope()
+        assert isinstance(rope, Rope)
+        assert len(rope) == len(TEXT)
+        assert rope.num_lines == mapped.num_lines
+        assert rope.count_tabs() == TEXT.count('\t')
+
+        rope.insert(150, u'inserted\n')
+        rope.delete(10, 300)
+        text = TEXT[:150]+u'inserted\n'+TEXT[150:]
+        text = text[:10]+text[310:]
+        assert rope.get_text() == text
+        assert rope.line_start(3) == line_starts(text)[3]
+    finally:
+        os.unlink(filename)
+
+def test_estimate_num_lines():
+    filename = make_file(TEXT.encode('utf8'))
+    try:
+        mapped = MappedText(filename, block_size=100)
+        num_lines = len(line_starts(TEXT))
+        estimate = mapped.estimate_num_lines()
+        assert not mapped.is_indexed
+        assert abs(estimate-num_lines) < num_lines/10
+        # counting up to a line only indexes that far
+        assert mapped.count_lines(10) == 10
+        assert not mapped.is_indexed
+
+        steps = 0
+        while mapped.extend_index():
+            steps += 1
+        assert steps > 1
+        assert mapped.is_indexed
+        assert mapped.estimate_num_lines() == num_lines
+        assert mapped.count_lines(10**6) == num_lines
+    finally:
+        os.unlink(filename)
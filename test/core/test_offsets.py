@@ -0,0 +1,88 @@
+import bisect
+import random
+from nose.tools import *
+from ni.core.offsets import OffsetArray
+
+
+def test_shift():
+    offsets = OffsetArray([1, 5, 9, 12])
+    offsets.shift(2, 3)
+    assert offsets == [1, 5, 12, 15]
+    assert offsets[2] == 12
+    assert offsets[-1] == 15
+    assert list(offsets[1:3]) == [5, 12]
+    # moving the gap back keeps the values
+    offsets.shift(1, -2)
+    assert offsets.tolist() == [1, 3, 10, 13]
+    offsets.shift(4, 100)
+    assert offsets == [1, 3, 10, 13]
+
+def test_bisect():
+    offsets = OffsetArray([0, 10, 20, 30, 40])
+    offsets.shift(2, 5)
+    assert offsets.bisect_left(25) == 2
+    assert offsets.bisect_right(25) == 3
+    assert offsets.bisect_left(20) == 2
+    assert offsets.bisect_right(10) == 2
+    assert offsets.bisect_left(100) == 5
+    assert offsets.bisect_right(-1) == 0
+
+def test_append_after_shift():
+    offsets = OffsetArray([0, 10])
+    offsets.shift(1, 5)
+    offsets.append(20)
+    offsets.extend([30, 40])
+    assert offsets == [0, 15, 20, 30, 40]
+    offsets.truncate(1)
+    offsets.append(7)
+    assert offsets == [0, 7]
+
+def test_replace():
+    offsets = OffsetArray([0, 10, 20, 30])
+    offsets.shift(2, 1)
+    # across the gap
+    offsets.replace(1, 3, [11, 12, 13])
+    assert offsets == [0, 11, 12, 13, 31]
+    offsets.shift(4, 1)
+    # after the gap
+    offsets.replace(4, 5, [40, 50])
+    assert offsets == [0, 11, 12, 13, 40, 50]
+
+def test_random():
+    rnd = random.Random(3)
+    values = range(0, 1000, 10)
+    offsets = OffsetArray(values)
+    for x in xrange(1000):
+        choice = rnd.random()
+        index = rnd.randint(0, len(values))
+        # keep the values in order
+        if index:
+            low = values[index-1]
+        else:
+            low = -50
+        if choice < 0.4 and index < len(values):
+            delta = rnd.randint(low-values[index], 5)
+            values[index:] = [value+delta for value in values[index:]]
+            offsets.shift(index, delta)
+        elif choice < 0.7:
+            j = rnd.randint(index, len(values))
+            if j < len(values):
+                high = values[j]
+            else:
+                high = low+50
+            new = sorted(rnd.randint(low, high)
+                         for i in xrange(rnd.randint(0, 3)))
+            values[index:j] = new
+            offsets.replace(index, j, new)
+        elif choice < 0.8:
+            values.append(values and values[-1]+rnd.randint(0, 5) or 0)
+            offsets.append(values[-1])
+        elif choice < 0.85:
+            del values[index:]
+            offsets.truncate(index)
+        x = rnd.randint(-50, 1050)
+        assert offsets.bisect_left(x) == bisect.bisect_left(values, x)
+        assert offsets.bisect_right(x) == bisect.bisect_right(values, x)
+        assert [offsets[i] for i in xrange(len(values))] == values
+        assert list(offsets[index:]) == values[index:]
+    assert offsets == values
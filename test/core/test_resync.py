@@ -0,0 +1,64 @@
+from nose.tools import *
+from pygments.token import Token
+from pygments.lexers import get_lexer_by_name
+from ni.core.resync import ResyncRule, register_resync_rule, \
+    get_resync_rule, DEFAULT_RULE, SPLIT_POINT, PYTHON_SPLIT_POINT
+from ni.core.tokenizer import find_split_points
+
+
+def test_get_resync_rule():
+    assert get_resync_rule(get_lexer_by_name('python')).split_point is \
+        PYTHON_SPLIT_POINT
+    assert get_resync_rule(get_lexer_by_name('html+django')) is \
+        get_resync_rule(get_lexer_by_name('html'))
+    assert get_resync_rule(get_lexer_by_name('ruby')) is DEFAULT_RULE
+    assert get_resync_rule(None) is DEFAULT_RULE
+
+def test_register_resync_rule():
+    lexer = get_lexer_by_name('ruby')
+    rule = ResyncRule(lambda tokentype, value, line_start: line_start,
+                      min_backtrack=5)
+    register_resync_rule([lexer.name], rule)
+    try:
+        assert get_resync_rule(lexer) is rule
+    finally:
+        register_resync_rule([lexer.name], DEFAULT_RULE)
+
+def test_restart_tokens():
+    python = get_resync_rule(get_lexer_by_name('python'))
+    assert python.is_restart(Token.Keyword, u'def', True)
+    assert python.is_restart(Token.Name, u'x', True)
+    # a docstring could carry on past this line
+    assert not python.is_restart(Token.Literal.String.Doc, u'"""', True)
+
+    html = get_resync_rule(get_lexer_by_name('html'))
+    assert html.is_restart(Token.Punctuation, u'<', False)
+    assert html.is_restart(Token.Name.Tag, u'<div>', False)
+    assert not html.is_restart(Token.Name.Tag, u'div', False)
+    assert not html.is_restart(Token.Text, u'hi', False)
+
+    css = get_resync_rule(get_lexer_by_name('css'))
+    assert css.is_restart(Token.Punctuation, u'}', False)
+    assert not css.is_restart(Token.Punctuation, u'{', False)
+
+    assert DEFAULT_RULE.is_restart(Token.Name, u'x', True)
+    assert not DEFAULT_RULE.is_restart(Token.Name, u'x', False)
+    assert not DEFAULT_RULE.is_restart(Token.Literal.String, u'"x"', True)
+    # the lexer could still be in the middle of a block comment or a block
+    assert not DEFAULT_RULE.is_restart(Token.Comment.Multiline, u'/* x',
+                                       True)
+    assert not DEFAULT_RULE.is_restart(Token.Operator, u'/*', True)
+    assert not DEFAULT_RULE.is_restart(Token.Punctuation, u'}', True)
+    assert not DEFAULT_RULE.is_restart(Token.Text, u'  ', True)
+
+def test_split_points():
+    code = u'import os\n\n@decorate\ndef foo():\n    pass\n\nclass Bar:\n' \
+           u'    def baz(self):\n        pass\n'
+    points = find_split_points(code, 1, PYTHON_SPLIT_POINT)
+    assert [code[point:point+4] for point in points[1:-1]] == \
+        [u'@dec', u'def ', u'clas']
+
+    css = u'a {\n  b: c;\n}\np { }\n'
+    points = find_split_points(css, 1,
+        get_resync_rule(get_lexer_by_name('css')).split_point)
+    assert points == [0, css.index(u'p {'), len(css)]
@@ -0,0 +1,148 @@
+import random
+import zlib
+from nose.tools import *
+from ni.core.rope import Rope, CHUNK_SIZE
+
+
+TEXT = u"Hello\nthere\nWhat's up\twith you?\n\n\n"
+
+def line_starts(text):
+    starts = [0]
+    for i, char in enumerate(text):
+        if char == '\n':
+            starts.append(i+1)
+    return starts
+
+def check_rope(rope, text):
+    assert len(rope) == len(text)
+    assert rope.get_text() == text
+    starts = line_starts(text)
+    assert rope.num_lines == len(starts)
+    for y, start in enumerate(starts):
+        assert rope.line_start(y) == start
+    for offset in xrange(0, len(text)+1, 7):
+        assert rope.count_newlines(offset) == text.count('\n', 0, offset)
+
+def test_new_rope():
+    rope = Rope(TEXT)
+    check_rope(rope, TEXT)
+
+def test_new_rope_blank():
+    rope = Rope()
+    assert len(rope) == 0
+    assert rope.get_text() == u''
+    assert rope.num_lines == 1
+    assert rope.line_start(0) == 0
+
+def test_get_text_range():
+    rope = Rope(TEXT)
+    assert rope.get_text(6, 11) == u'there'
+    assert rope.get_text(6) == TEXT[6:]
+    assert rope.get_text(10, 5) == u''
+
+def test_line_start():
+    rope = Rope(TEXT)
+    assert [rope.line_start(y) for y in xrange(6)] == [0, 6, 12, 32, 33, 34]
+
+@raises(IndexError)
+def test_line_start_out_of_range():
+    rope = Rope(TEXT)
+    rope.line_start(6)
+
+def test_count_tabs():
+    rope = Rope(TEXT)
+    assert rope.count_tabs() == 1
+    assert rope.count_tabs(0, 20) == 0
+    assert rope.count_tabs(12, 32) == 1
+
+def test_insert():
+    rope = Rope(TEXT)
+    rope.insert(6, u'another line\n')
+    check_rope(rope, TEXT[:6]+u'another line\n'+TEXT[6:])
+
+def test_insert_str():
+    rope = Rope()
+    rope.insert(0, 'ascii')
+    assert rope.get_text() == u'ascii'
+
+def test_delete():
+    rope = Rope(TEXT)
+    rope.delete(3, 10)
+    check_rope(rope, TEXT[:3]+TEXT[13:])
+
+def test_delete_everything():
+    rope = Rope(TEXT)
+    rope.delete(0, len(TEXT))
+    check_rope(rope, u'')
+
+def test_delete_past_end():
+    rope = Rope(TEXT)
+    rope.delete(len(TEXT)-1, 10)
+    assert rope.get_text() == TEXT[:-1]
+
+def test_many_chunks():
+    text = u"some line\n\tof text\n"*CHUNK_SIZE
+    rope = Rope(text)
+    check_rope(rope, text)
+    chunks = list(rope.iter_chunks())
+    assert len(chunks) > 1
+    assert u''.join(chunks) == text
+    assert rope.get_text(CHUNK_SIZE-5, CHUNK_SIZE+5) == \
+        text[CHUNK_SIZE-5:CHUNK_SIZE+5]
+    assert rope.count_tabs() == CHUNK_SIZE
+
+def test_checksum():
+    text = u"some line\n\tof text \u20ac\n"*CHUNK_SIZE
+    rope = Rope(text)
+    assert rope.checksum() == zlib.adler32(text.encode('utf8')) & 0xffffffff
+    rope.insert(100, u'more text')
+    rope.delete(5000, 3)
+    text = text[:100]+u'more text'+text[100:]
+    text = text[:5000]+text[5003:]
+    assert rope.checksum() == zlib.adler32(text.encode('utf8')) & 0xffffffff
+    assert Rope().checksum() == zlib.adler32('')
+
+def max_width(text, tab_size):
+    return max(len(line)+line.count('\t')*(tab_size-1)
+               for line in text.split('\n'))
+
+def test_max_line_width():
+    text = (u"short\n\tindented line\n"+u"x"*3000+u"\n")*64
+    rope = Rope(text)
+    assert rope.max_line_width(8) == max_width(text, 8)
+    assert rope.max_line_width(4) == max_width(text, 4)
+    # a line that grows across chunks
+    rope.insert(100, u"y"*5000)
+    text = text[:100]+u"y"*5000+text[100:]
+    assert rope.max_line_width(8) == max_width(text, 8)
+    rope.delete(50, 6000)
+    text = text[:50]+text[6050:]
+    assert rope.max_line_width(8) == max_width(text, 8)
+    assert Rope().max_line_width(8) == 0
+    assert Rope(u"\t").max_line_width(8) == 8
+
+def test_copy_is_independent():
+    rope = Rope(TEXT)
+    copy = rope.copy()
+    assert copy.root is rope.root
+    rope.insert(0, u'changed')
+    rope.delete(20, 5)
+    assert copy.get_text() == TEXT
+
+def test_random_edits():
+    rnd = random.Random(42)
+    text = u"some\ntext\n"*CHUNK_SIZE
+    rope = Rope(text)
+    for x in xrange(500):
+        offset = rnd.randint(0, len(text))
+        if rnd.random() < 0.6:
+            insert = rnd.choice([u'a', u'\n', u'x\ty', u'\n\n', u'abc'*1000])
+            rope.insert(offset, insert)
+            text = text[:offset]+insert+text[offset:]
+        else:
+            length = rnd.choice([0, 1, 5, 3000])
+            rope.delete(offset, length)
+            text = text[:offset]+text[offset+length:]
+        assert len(rope) == len(text)
+    check_rope(rope, text)
+    assert rope.count_tabs() == text.count('\t')
@@ -0,0 +1,45 @@
+from nose.tools import *
+from pygments.token import Token
+from ni.core.document import Document
+from ni.core.styles import StyleTable
+from ni.core.tokenizer import token_type_id
+
+
+RULES = [
+    (Token.Text, 'plain'),
+    (Token.Name.Function, 'function'),
+    (Token.Name, 'name'),
+    (Token.Keyword, 'keyword'),
+]
+
+def test_get_style():
+    styles = StyleTable(RULES)
+    assert styles.get_style(Token.Text.Whitespace) == 'plain'
+    # the first rule that matches wins
+    assert styles.get_style(Token.Name.Function) == 'function'
+    assert styles.get_style(Token.Name.Class) == 'name'
+    assert styles.get_style(Token.Keyword.Constant) == 'keyword'
+    assert styles.get_style(Token.Comment) == 'plain'
+    assert StyleTable(RULES, default=None).get_style(Token.Comment) is None
+
+def test_new_token_types():
+    styles = StyleTable(RULES)
+    styles.get_style(Token.Text)
+    # a token type that didn't have an id when the table was filled in
+    new_type = Token.Name.Function.NiTestStyles
+    assert styles[token_type_id(new_type)] == 'function'
+
+def test_line_tokens_with_styles():
+    doc = Document(location='/tmp/ni-test-styles.py',
+                   content=u'def foo():\n    pass\n')
+    doc.update_tokens((0, 0), (80, 25), to_end=True)
+    styles = StyleTable(RULES)
+    token_lines = doc.tokenizer.get_line_tokens(0, 1, styles)
+    plain_lines = doc.tokenizer.get_line_tokens(0, 1)
+    assert token_lines[0][:3] == \
+        [('keyword', 0, 3), ('plain', 3, 4), ('function', 4, 7)]
+    for line, plain_line in zip(token_lines, plain_lines):
+        assert [span[1:] for span in line] == \
+            [span[1:] for span in plain_line]
+        assert [span[0] for span in line] == \
+            [styles.get_style(span[0]) for span in plain_line]
@@ -0,0 +1,142 @@
+import os
+import time
+import shutil
+import tempfile
+from nose.tools import *
+from pygments.lexers import get_lexer_by_name
+from ni.core.document import Document, InsertDelta
+from ni.core.tokenizer import Tokenizer
+from ni.core.tokencache import TokenCache, content_digest, get_token_cache
+
+
+CODE = u'''class Foo(object):
+    """
+    A docstring
+    that spans lines.
+    """
+
+    def bar(self, x):
+        return x+1 # a comment
+'''*50
+
+def make_document(cache, code=CODE):
+    return Document(location='/tmp/ni-test-tokencache.py', content=code,
+                    token_cache=cache)
+
+def lex(doc):
+    while doc.lex_ahead():
+        pass
+
+def test_store_load():
+    directory = tempfile.mkdtemp()
+    try:
+        cache = TokenCache(os.path.join(directory, 'tokens'))
+        assert cache.load('missing') is None
+        cache.store('key', (u'data', [1, 2, 3]))
+        assert cache.load('key') == (u'data', [1, 2, 3])
+        assert os.listdir(cache.directory) == ['key.tokens']
+    finally:
+        shutil.rmtree(directory)
+
+def test_make_key():
+    cache = TokenCache('/tmp')
+    python = get_lexer_by_name('python', stripnl=False)
+    digest = content_digest([u'x = 1\n'])
+    assert digest == content_digest([u'x = ', u'1\n'])
+    assert cache.make_key(digest, python) == cache.make_key(digest, python)
+    assert cache.make_key(digest, python) != \
+        cache.make_key(content_digest([u'x = 2\n']), python)
+    assert cache.make_key(digest, python) != \
+        cache.make_key(digest, get_lexer_by_name('python'))
+    assert cache.make_key(digest, python) != \
+        cache.make_key(digest, get_lexer_by_name('ruby', stripnl=False))
+
+def test_evict():
+    directory = tempfile.mkdtemp()
+    try:
+        cache = TokenCache(directory, budget=250)
+        for i, key in enumerate(['a', 'b', 'c']):
+            cache.store(key, 'x'*100)
+            # pretend that they got used a second apart
+            os.utime(os.path.join(directory, key+'.tokens'),
+                     (time.time()-10+i, time.time()-10+i))
+        assert sorted(os.listdir(directory)) == ['b.tokens', 'c.tokens']
+
+        # loading b makes it the most recently used one
+        assert cache.load('b')
+        cache.store('d', 'x'*100)
+        assert sorted(os.listdir(directory)) == ['b.tokens', 'd.tokens']
+    finally:
+        shutil.rmtree(directory)
+
+def test_get_token_cache():
+    assert get_token_cache(None) is None
+    assert get_token_cache('/tmp/ni-tokens') is get_token_cache('/tmp/ni-tokens')
+
+def test_tokenizer_cache():
+    directory = tempfile.mkdtemp()
+    try:
+        cache = TokenCache(directory)
+        doc = make_document(cache)
+        lex(doc)
+        assert len(os.listdir(directory)) == 1
+
+        # the same text gets its tokens without lexing
+        doc = make_document(cache)
+        assert not doc.lex_ahead()
+        assert doc.is_lexed
+        expected = Tokenizer(doc)
+        expected.update()
+        assert doc.tokenizer.tokens == expected.tokens
+        assert doc.tokenizer.offsets == expected.offsets
+        assert doc.tokenizer._checkpoint_offsets == \
+            expected._checkpoint_offsets
+        assert doc.tokenizer._checkpoint_stacks == expected._checkpoint_stacks
+
+        # and they still get updated after edits
+        InsertDelta(doc, doc.cursor_pos_to_offset((5, 0)), u'"""\n').do()
+        doc.update_tokens((0, 0), (80, 25), to_end=True)
+        expected = Tokenizer(doc)
+        expected.update()
+        assert doc.tokenizer.tokens == expected.tokens
+
+        # modified documents don't get cached
+        lex(doc)
+        assert len(os.listdir(directory)) == 1
+    finally:
+        shutil.rmtree(directory)
+
+def test_tokenizer_cache_other_text():
+    directory = tempfile.mkdtemp()
+    try:
+        cache = TokenCache(directory)
+        lex(make_document(cache))
+        doc = make_document(cache, CODE+u'x = 1\n')
+        assert not doc.tokenizer.load_from_cache(cache)
+        assert doc.tokenizer.checked_cache
+        lex(doc)
+        assert len(os.listdir(directory)) == 2
+    finally:
+        shutil.rmtree(directory)
+
+def test_unwritable_cache():
+    # a cache directory that can't be made doesn't stop anything working
+    directory = tempfile.mkdtemp()
+    try:
+        blocker = os.path.join(directory, 'file')
+        open(blocker, 'w').close()
+        cache = TokenCache(os.path.join(blocker, 'tokens'))
+        cache.store('key', (u'data', [1, 2, 3]))
+        assert cache.load('key') is None
+        cache.evict()
+
+        doc = make_document(cache)
+        doc.location = os.path.join(directory, 'a.py')
+        doc.save()
+        lex(doc)
+        assert doc.is_lexed
+        doc.save(os.path.join(directory, 'b.py'))
+        assert doc.location == os.path.join(directory, 'b.py')
+        assert os.path.exists(doc.location)
+    finally:
+        shutil.rmtree(directory)
@@ -0,0 +1,528 @@
+import random
+import multiprocessing
+from nose.tools import *
+from pygments.token import Token
+from ni.core.document import Document, InsertDelta, DeleteDelta
+from array import array
+from ni.core.offsets import OffsetArray
+from ni.core.tokenizer import Tokenizer, token_type_id, token_type, \
+    find_split_points, find_lexer_class, get_lexer_for_location
+
+
+CODE = u'''class Foo(object):
+    """
+    A docstring
+    that spans lines.
+    """
+
+    def bar(self, x):
+        # a comment
+        return x+1 # (another one)
+'''
+
+JAVA = u'''class Foo {
+    /* a comment
+       over lines */
+    String s = "abc";
+
+    int bar(int x) {
+        return x / 2; // half
+    }
+}
+'''
+
+def make_java_document(code=JAVA):
+    doc = Document(location='/tmp/ni-test-tokenizer.java', content=code)
+    doc.update_tokens((0, 0), (80, 25), to_end=True)
+    return doc
+
+C = u'''int f(int x) {
+  /* a
+   comment */
+  char *s = "abc";
+  return x / 2; // c
+}
+'''
+
+def make_document(code=CODE):
+    doc = Document(location='/tmp/ni-test-tokenizer.py', content=code)
+    doc.update_tokens((0, 0), (80, 25), to_end=True)
+    return doc
+
+def full_lex(doc):
+    tokenizer = Tokenizer(doc)
+    tokenizer.update()
+    return tokenizer
+
+def check_tokens(doc):
+    doc.update_tokens((0, 0), (80, 25), to_end=True)
+    tokenizer = doc.tokenizer
+    expected = full_lex(doc)
+    assert tokenizer.tokens == expected.tokens
+    assert tokenizer.offsets == expected.offsets
+    assert tokenizer.end == doc.num_chars
+    assert u''.join(value for ttype, value in tokenizer.tokens) == doc.content
+
+def check_lexer_tokens(doc):
+    # the same as the lexer gives for the whole text in one go (Python
+    # tokens get special types for some names, so this is for other modes)
+    check_tokens(doc)
+    assert list(doc.tokenizer.tokens) == \
+        [(tokentype, value) for offset, tokentype, value in
+         doc.tokenizer.lexer.get_tokens_unprocessed(doc.content)]
+
+def test_find_lexer_class():
+    from pygments.lexers import get_lexer_for_filename
+    import ni.core.tokenizer
+    assert find_lexer_class('/some/where/foo.py').name == 'Python'
+    assert find_lexer_class('/some/where/foo.html').name == \
+        'HTML+Django/Jinja'
+    assert find_lexer_class('foo.c') is type(get_lexer_for_filename('foo.c'))
+    assert find_lexer_class('/x/Makefile') is \
+        type(get_lexer_for_filename('Makefile'))
+    assert find_lexer_class('/x/CMakeLists.txt') is not \
+        find_lexer_class('/x/notes.txt')
+    assert find_lexer_class('foo.unknownextension') is None
+
+    # the answers are cached by extension
+    assert ni.core.tokenizer._lexer_classes['.c'] is find_lexer_class('x.c')
+
+    lexer = get_lexer_for_location('foo.py')
+    assert lexer.options == {'stripnl': False, 'encoding': 'utf8'}
+    assert get_lexer_for_location(None) is None
+
+def test_offsets():
+    doc = make_document(u'\tx = 1\n\ty = "\t"\n')
+    tokenizer = doc.tokenizer
+    assert tokenizer.is_resumable
+    for offset, (ttype, value) in zip(tokenizer.offsets, tokenizer.tokens):
+        assert doc.get_text(offset, offset+len(value)) == value
+
+def test_token_arrays():
+    doc = make_document()
+    tokenizer = doc.tokenizer
+    assert isinstance(tokenizer.starts, OffsetArray)
+    assert isinstance(tokenizer.lengths, array)
+    assert isinstance(tokenizer.types, array)
+    assert tokenizer.offsets is tokenizer.starts
+    assert tokenizer.tokens[0] == (Token.Keyword, u'class')
+    assert tokenizer.tokens[-1] == (Token.Text, u'\n')
+    assert tokenizer.tokens[:2] == [(Token.Keyword, u'class'),
+                                    (Token.Text, u' ')]
+    assert len(tokenizer.tokens) == len(tokenizer.starts)
+    assert token_type(token_type_id(Token.Keyword)) is Token.Keyword
+
+def test_insert():
+    doc = make_document()
+    InsertDelta(doc, doc.cursor_pos_to_offset((7, 8)), u'x = 2\n        ').do()
+    check_tokens(doc)
+
+def test_open_docstring():
+    # opening a string changes the state of all the lines after it
+    doc = make_document()
+    delta = InsertDelta(doc, doc.cursor_pos_to_offset((5, 0)), u'"""\n')
+    delta.do()
+    check_tokens(doc)
+    assert doc.tokenizer.tokens[-2][0] in Token.Literal.String
+    delta.undo()
+    check_tokens(doc)
+
+def test_close_docstring():
+    # the lines after the open string all have checkpoints inside it, but
+    # once it is closed they have to be lexed from before the string again
+    doc = make_document(u'x = 1\n\n    """\n    still open\n\n' +
+                        u'    y = 2\n'*5)
+    InsertDelta(doc, doc.cursor_pos_to_offset((3, 14)), u'"""').do()
+    check_tokens(doc)
+
+def test_docstring_after_blank_line():
+    # the docstring rule matches from the start of the blank line before it
+    doc = make_document(u'x = 1\n    \n    y = 2\n    """\n' +
+                        u'z = 3\n'*5)
+    InsertDelta(doc, doc.cursor_pos_to_offset((2, 4)), u'"""').do()
+    check_tokens(doc)
+
+def test_delete():
+    doc = make_document()
+    DeleteDelta(doc, doc.cursor_pos_to_offset((1, 4)), 4).do()
+    check_tokens(doc)
+
+def test_converges():
+    lines = [u'def f%d(x):' % i + u'\n    return x*%d\n' % i
+             for i in xrange(2000)]
+    doc = make_document(u''.join(lines))
+    tokenizer = doc.tokenizer
+
+    lexed = []
+    iter_lexed = tokenizer._iter_lexed
+    def counting_iter_lexed(pos, stack):
+        for item in iter_lexed(pos, stack):
+            lexed.append(item)
+            yield item
+    tokenizer._iter_lexed = counting_iter_lexed
+
+    InsertDelta(doc, doc.cursor_pos_to_offset((20, 4)), u'y = 1\n    ').do()
+    check_tokens(doc)
+    # only the lines around the edit got lexed again
+    assert 0 < len(lexed) < 50
+
+def test_resume_point_follows_resync_rule():
+    from pygments.lexers import get_lexer_by_name
+    from ni.core.resync import ResyncRule, register_resync_rule, \
+        get_resync_rule
+    lines = [u'x%d = %d\n' % (i, i) for i in xrange(200)]
+    lexer = get_lexer_by_name('python')
+    python = get_resync_rule(lexer)
+
+    def first_lexed(rule):
+        doc = make_document(u''.join(lines))
+        tokenizer = doc.tokenizer
+        positions = []
+        iter_lexed = tokenizer._iter_lexed
+        def recording_iter_lexed(pos, stack):
+            positions.append(pos)
+            return iter_lexed(pos, stack)
+        tokenizer._iter_lexed = recording_iter_lexed
+
+        register_resync_rule([lexer.name], rule)
+        try:
+            InsertDelta(doc, doc.cursor_pos_to_offset((100, 2)), u'1').do()
+            check_tokens(doc)
+        finally:
+            register_resync_rule([lexer.name], python)
+        return positions[0]
+
+    assert first_lexed(python) == sum(len(line) for line in lines[:99])
+    # the edited line itself doesn't count, so this goes back to x19
+    only_x1 = ResyncRule(lambda tokentype, value, line_start:
+                         value.startswith(u'x1'))
+    assert first_lexed(only_x1) == sum(len(line) for line in lines[:19])
+    never = ResyncRule(lambda tokentype, value, line_start: False)
+    assert first_lexed(never) == 0
+
+def test_lex_to_screen():
+    lines = [u'x = %d\n' % i for i in xrange(1000)]
+    doc = Document(location='/tmp/ni-test-tokenizer.py',
+                   content=u''.join(lines))
+    doc.tokenizer = Tokenizer(doc)
+    doc.update_tokens((0, 0), (80, 25))
+    assert doc.tokenizer.end < doc.num_chars
+    doc.update_tokens((500, 0), (80, 25))
+    assert doc.tokenizer.end >= doc.cursor_pos_to_offset((525, 0))
+    check_tokens(doc)
+
+def test_converges_before_to_offset():
+    # the new tokens catch up with the old ones, but those only went as far
+    # as the first screen
+    lines = [u'x = %d\n' % i for i in xrange(1000)]
+    doc = Document(location='/tmp/ni-test-tokenizer.py',
+                   content=u''.join(lines))
+    doc.update_tokens((0, 0), (80, 25))
+    assert doc.tokenizer.end < doc.num_chars
+    InsertDelta(doc, doc.cursor_pos_to_offset((3, 0)), u'y = 1\n').do()
+    check_tokens(doc)
+
+def test_random_edits():
+    rnd = random.Random(7)
+    doc = make_document(CODE*20)
+    for x in xrange(100):
+        offset = rnd.randint(0, doc.num_chars)
+        if rnd.random() < 0.5:
+            text = rnd.choice([u'"', u'"""', u'\n', u'#', u'(', u'x', u"'"])
+            InsertDelta(doc, offset, text).do()
+        else:
+            DeleteDelta(doc, offset, rnd.randint(1, 10)).do()
+        if rnd.random() < 0.5:
+            check_tokens(doc)
+    check_tokens(doc)
+
+def test_random_edits_c_like():
+    # Java is resumable, but its block comments and strings can run over
+    # lines without the lexer's state knowing
+    rnd = random.Random(5)
+    doc = make_java_document(JAVA*20)
+    for x in xrange(100):
+        offset = rnd.randint(0, doc.num_chars)
+        if rnd.random() < 0.6:
+            text = rnd.choice([u'/*', u'*/', u'"', u"'", u'\n', u'{', u'}',
+                               u'x'])
+            InsertDelta(doc, offset, text).do()
+        else:
+            DeleteDelta(doc, offset, rnd.randint(1, 6)).do()
+        if rnd.random() < 0.5:
+            check_lexer_tokens(doc)
+    check_lexer_tokens(doc)
+
+def test_close_string_before_edit():
+    # the string opened on the first line runs to the end of the text, so
+    # the lines after it look like code that a later edit can resume from
+    doc = make_java_document(u'String s = "open;\n' + u'int x = 1;\n'*20)
+    InsertDelta(doc, doc.cursor_pos_to_offset((10, 0)), u'y').do()
+    check_lexer_tokens(doc)
+    InsertDelta(doc, doc.cursor_pos_to_offset((0, 16)), u'"').do()
+    check_lexer_tokens(doc)
+
+def test_backtrack():
+    # HTML+Django is a DelegatingLexer, so it can't be resumed
+    doc = Document(location='/tmp/ni-test-tokenizer.html',
+                   content=u'<p>{% if x %}\n<b>hi</b>\n{% endif %}</p>\n'*20)
+    doc.update_tokens((0, 0), (80, 25), to_end=True)
+    assert not doc.tokenizer.is_resumable
+    InsertDelta(doc, doc.cursor_pos_to_offset((31, 3)), u'<i>x</i>').do()
+    check_tokens(doc)
+    DeleteDelta(doc, doc.cursor_pos_to_offset((10, 0)), 5).do()
+    check_tokens(doc)
+
+def test_small_window():
+    import ni.core.tokenizer
+    old_window = ni.core.tokenizer.LEX_WINDOW
+    ni.core.tokenizer.LEX_WINDOW = 16
+    try:
+        doc = make_document(CODE*5)
+        check_tokens(doc)
+        InsertDelta(doc, 30, u'"""').do()
+        check_tokens(doc)
+    finally:
+        ni.core.tokenizer.LEX_WINDOW = old_window
+
+def test_backtrack_random_edits():
+    for location, code in [('/tmp/ni-test-tokenizer.c', C),
+                           ('/tmp/ni-test-tokenizer.rb',
+                            u'def f(x)\n  # c\n  s = "a\nb"\n  x / 2\nend\n'),
+                           ('/tmp/ni-test-tokenizer.html',
+                            u'<p>{% if x %}\n<b>hi</b><!-- c\n -->\n'
+                            u'{% endif %}</p>\n')]:
+        rnd = random.Random(3)
+        doc = Document(location=location, content=code*20)
+        doc.update_tokens((0, 0), (80, 25), to_end=True)
+        assert not doc.tokenizer.is_resumable
+        for x in xrange(40):
+            offset = rnd.randint(0, doc.num_chars)
+            if rnd.random() < 0.6:
+                text = rnd.choice([u'/*', u'*/', u'"', u"'", u'\n', u'{',
+                                   u'}', u'<!--', u'-->', u'{%', u'x'])
+                InsertDelta(doc, offset, text).do()
+            else:
+                DeleteDelta(doc, offset, rnd.randint(1, 6)).do()
+            check_lexer_tokens(doc)
+
+def test_backtrack_unclosed_block():
+    # without the { the C lexer is in the middle of a statement until the
+    # next ;, so the function after the block isn't one
+    doc = Document(location='/tmp/ni-test-tokenizer.c', content=C*10)
+    doc.update_tokens((0, 0), (80, 25), to_end=True)
+    DeleteDelta(doc, doc.cursor_pos_to_offset((18, 13)), 1).do()
+    check_lexer_tokens(doc)
+    InsertDelta(doc, doc.cursor_pos_to_offset((24, 5)), u'x').do()
+    check_lexer_tokens(doc)
+
+def test_window_block_comment():
+    # a block comment that goes past the end of the first window
+    comment = u'/*\n' + u''.join(u' comment line %d\n' % i
+                                 for i in xrange(20)) + u'*/\n'
+    doc = make_java_document(u'int x = 1;\n'*1488 + comment +
+                             u'int y = 2;\n'*10)
+    check_lexer_tokens(doc)
+    assert (Token.Comment.Multiline, comment[:-1]) in doc.tokenizer.tokens
+
+def test_small_window_block_comment():
+    import ni.core.tokenizer
+    old_window = ni.core.tokenizer.LEX_WINDOW
+    ni.core.tokenizer.LEX_WINDOW = 16
+    try:
+        doc = make_java_document(JAVA*5)
+        check_lexer_tokens(doc)
+        InsertDelta(doc, doc.cursor_pos_to_offset((12, 4)), u'/*').do()
+        check_lexer_tokens(doc)
+    finally:
+        ni.core.tokenizer.LEX_WINDOW = old_window
+
+def test_small_window_docstring():
+    # a window that ends inside a docstring has to be lexed again
+    import ni.core.tokenizer
+    old_window = ni.core.tokenizer.LEX_WINDOW
+    ni.core.tokenizer.LEX_WINDOW = 16
+    try:
+        doc = make_document(u'x = 1\n\n    """\n    a long docstring\n'
+                            u'    over lines\n    """\n'*5)
+    finally:
+        ni.core.tokenizer.LEX_WINDOW = old_window
+    check_tokens(doc)
+
+def test_lex_ahead():
+    lines = [u'x = %d\n' % i for i in xrange(8000)]
+    doc = Document(location='/tmp/ni-test-tokenizer.py',
+                   content=u''.join(lines))
+    assert not doc.is_lexed
+
+    # the screen only needs the start of the file
+    doc.update_tokens((0, 0), (80, 25))
+    assert doc.tokenizer.end < doc.num_chars
+
+    # screens far past what got lexed are drawn as plain text
+    doc.update_tokens((6000, 0), (80, 25))
+    assert doc.tokenizer.end < doc.cursor_pos_to_offset((6000, 0))
+    tokens = doc.tokenizer.get_normalised_tokens(6000, 6025)
+    assert tokens == [(Token.Text, doc.get_text(
+        doc.cursor_pos_to_offset((6000, 0)),
+        doc.cursor_pos_to_offset((6026, 0))))]
+
+    steps = 0
+    while doc.lex_ahead(0):
+        steps += 1
+    assert steps > 1
+    assert doc.is_lexed
+    check_tokens(doc)
+
+    InsertDelta(doc, 0, u'"""').do()
+    assert not doc.is_lexed
+    while doc.lex_ahead():
+        pass
+    check_tokens(doc)
+
+def test_lex_ahead_backtrack():
+    # lexers that can't be resumed still only lex a bit at a time
+    doc = Document(location='/tmp/ni-test-tokenizer.c', content=C*1000)
+    assert not doc.tokenizer.is_resumable
+    assert doc.lex_ahead(0)
+    assert 0 < doc.tokenizer.end < doc.num_chars
+    steps = 1
+    while doc.lex_ahead(0):
+        steps += 1
+    assert steps > 1
+    assert doc.is_lexed
+    check_lexer_tokens(doc)
+
+def test_normalised_tokens_partly_lexed():
+    doc = Document(location='/tmp/ni-test-tokenizer.py', content=CODE)
+    doc.tokenizer.update(0, 20)
+    assert 20 <= doc.tokenizer.end < doc.num_chars
+    tokens = doc.tokenizer.get_normalised_tokens(0, 6)
+    assert tokens[-1] == (Token.Text, doc.get_text(doc.tokenizer.end,
+        doc.cursor_pos_to_offset((7, 0))))
+    assert u''.join(value for ttype, value in tokens) == \
+        doc.get_text(0, doc.cursor_pos_to_offset((7, 0)))
+
+def parallel_lex(code, chunk_size, location='/tmp/ni-test-tokenizer.py'):
+    doc = Document(location=location, content=code)
+    pool = multiprocessing.Pool(2)
+    try:
+        assert doc.tokenizer.start_parallel_lex(pool, chunk_size)
+        assert doc.tokenizer.is_lexing_in_parallel
+        assert doc.tokenizer.finish_parallel_lex()
+        assert not doc.tokenizer.is_lexing_in_parallel
+    finally:
+        pool.terminate()
+    return doc
+
+def check_parallel_tokens(doc):
+    tokenizer = doc.tokenizer
+    expected = full_lex(doc)
+    assert tokenizer.tokens == expected.tokens
+    assert tokenizer.offsets == expected.offsets
+    assert tokenizer.end == doc.num_chars
+    assert tokenizer._checkpoint_offsets == expected._checkpoint_offsets
+    assert tokenizer._checkpoint_stacks == expected._checkpoint_stacks
+    assert tokenizer._checkpoint_indexes == expected._checkpoint_indexes
+
+def test_split_points():
+    code = (CODE+u'\n')*10
+    points = find_split_points(code, 100)
+    assert points[0] == 0
+    assert points[-1] == len(code)
+    assert len(points) > 3
+    for point in points[1:-1]:
+        assert code[point-2:point+5] == u'\n\nclass'
+
+def test_parallel_lex():
+    doc = parallel_lex((CODE+u'\n')*200, 500)
+    check_parallel_tokens(doc)
+    assert doc.is_lexed
+
+def test_parallel_lex_bad_boundary():
+    # the blank lines inside the strings look like safe places to split
+    code = (CODE+u'\nx = """\n\nclass not code\n""" # """\n\n'
+            u'y = """\n\nclass not code\n\nstill a string\n"""\n\n')*50
+    for chunk_size in (5, 15, 100):
+        doc = parallel_lex(code, chunk_size)
+        check_parallel_tokens(doc)
+
+def test_parallel_lex_cut_docstring():
+    # a chunk that ends inside a docstring lexes its end as code
+    code = (CODE+u'\n    """\n\nclass not code\n\n    """\n\n')*50
+    for chunk_size in (5, 15, 100):
+        doc = parallel_lex(code, chunk_size)
+        check_parallel_tokens(doc)
+
+def test_parallel_lex_block_comments():
+    # chunks that end inside block comments and strings
+    code = (JAVA+u'\n/*\n\nclass NotCode {\n\n}\n\n*/\n\n'
+            u'String s = "\\\n\nclass NotCode {\n";\n\n')*50
+    for chunk_size in (5, 30, 120):
+        doc = parallel_lex(code, chunk_size, '/tmp/ni-test-tokenizer.java')
+        check_parallel_tokens(doc)
+        assert list(doc.tokenizer.tokens) == \
+            [(tokentype, value) for offset, tokentype, value in
+             doc.tokenizer.lexer.get_tokens_unprocessed(code)]
+
+def test_lex_ahead_parallel():
+    import ni.core.document
+    old_size = ni.core.document.PARALLEL_LEX_SIZE
+    ni.core.document.PARALLEL_LEX_SIZE = 1000
+    try:
+        doc = Document(location='/tmp/ni-test-tokenizer.py',
+                       content=(CODE+u'\n')*100)
+        assert doc.lex_ahead()
+        assert doc.tokenizer.is_lexing_in_parallel
+
+        # edit while the workers are busy
+        InsertDelta(doc, doc.cursor_pos_to_offset((20, 0)), u'"""').do()
+        while doc.lex_ahead():
+            pass
+        assert not doc.tokenizer.is_lexing_in_parallel
+        check_tokens(doc)
+    finally:
+        ni.core.document.PARALLEL_LEX_SIZE = old_size
+
+def split_lines(tokens):
+    """Split (tokentype, value) tokens into lines the slow way."""
+
+    lines = [[]]
+    for tokentype, value in tokens:
+        for n, part in enumerate(value.split(u'\n')):
+            if n:
+                lines.append([])
+            if part:
+                lines[-1].append((tokentype, part))
+    return lines
+
+def check_line_tokens(doc, from_line, to_line):
+    token_lines = doc.tokenizer.get_line_tokens(from_line, to_line)
+    expected = split_lines(doc.tokenizer.get_normalised_tokens(from_line,
+                                                               to_line))
+    assert len(token_lines) == min(to_line, doc.num_lines-1)-from_line+1
+    for y, spans in enumerate(token_lines):
+        line = doc.get_line(from_line+y)
+        assert [(tokentype, line[start:end])
+                for tokentype, start, end in spans] == expected[y]
+        assert u''.join(line[start:end] for t, start, end in spans) == line
+
+def test_line_tokens():
+    doc = make_document()
+    token_lines = doc.tokenizer.get_line_tokens(1, 3)
+    # the docstring is one token, but it shows up on each of its lines
+    assert token_lines[1] == [(Token.Literal.String.Doc, 0, 15)]
+    for from_line in xrange(doc.num_lines):
+        check_line_tokens(doc, from_line, doc.num_lines+5)
+
+def test_line_tokens_partly_lexed():
+    doc = Document(location='/tmp/ni-test-tokenizer.py', content=CODE)
+    doc.tokenizer.update(0, 20)
+    check_line_tokens(doc, 0, 10)
+    token_lines = doc.tokenizer.get_line_tokens(6, 6)
+    assert token_lines == [[(Token.Text, 0, len(doc.get_line(6)))]]
+
+def test_line_tokens_without_lexer():
+    doc = Document(title='Untitled', content=CODE)
+    assert doc.tokenizer.get_line_tokens(0, 1) == \
+        [[(Token.Text, 0, 18)], [(Token.Text, 0, 7)]]
@@ -0,0 +1,81 @@
+from nose.tools import *
+from ni.core.undo import UndoStack, action_size, ACTION_SIZE
+
+
+class MockDelta(object):
+    def __init__(self, size):
+        self.size = size
+
+class MockAction(object):
+    def __init__(self, size=0, mergeable=False):
+        self.deltas = [MockDelta(size)]
+        self.mergeable = mergeable
+        self.merged = []
+
+    def merge(self, action):
+        if self.mergeable and action.mergeable:
+            self.merged.append(action)
+            self.deltas[0].size += action.deltas[0].size
+            return True
+        return False
+
+
+def test_new_stack():
+    s = UndoStack()
+    assert len(s) == 0
+    assert not s
+    assert s.last() is None
+    assert s.pop() is None
+    assert s.total_size == 0
+
+def test_push_pop():
+    s = UndoStack()
+    a = MockAction(10)
+    s.push(a)
+    assert len(s) == 1
+    assert s.last() is a
+    assert s.total_size == action_size(a) == ACTION_SIZE+10
+    assert s.pop() is a
+    assert s.total_size == 0
+
+def test_budget():
+    s = UndoStack(budget=(ACTION_SIZE+100)*3)
+    actions = [MockAction(100) for x in xrange(5)]
+    for a in actions:
+        s.push(a)
+    assert len(s) == 3
+    assert s.pop() is actions[-1]
+    assert s.pop() is actions[-2]
+    assert s.pop() is actions[-3]
+    assert s.pop() is None
+
+def test_keeps_newest_when_too_big():
+    s = UndoStack(budget=10)
+    s.push(MockAction(100))
+    big = MockAction(1000)
+    s.push(big)
+    assert len(s) == 1
+    assert s.last() is big
+
+def test_merge():
+    s = UndoStack()
+    a = MockAction(10, True)
+    b = MockAction(5, True)
+    s.push(a)
+    s.push(b, merge=True)
+    assert len(s) == 1
+    assert a.merged == [b]
+    assert s.total_size == ACTION_SIZE+15
+
+def test_no_merge_without_flag():
+    s = UndoStack()
+    s.push(MockAction(10, True))
+    s.push(MockAction(5, True))
+    assert len(s) == 2
+
+def test_clear():
+    s = UndoStack()
+    s.push(MockAction(10))
+    s.clear()
+    assert len(s) == 0
+    assert s.total_size == 0
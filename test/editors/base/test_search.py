@@ -0,0 +1,59 @@
+from nose.tools import *
+from ni.core.document import Document
+from ni.editors.base.search import Search, InitialSearchThread, \
+                                   SEARCH_DOCUMENTS
+from ni.test.mocks import MockView
+
+
+class MockEditor(object):
+    def __init__(self, documents):
+        self.views = [MockView(self, document) for document in documents]
+
+class LoggingSearch(Search):
+    def __init__(self, editor, pattern):
+        super(LoggingSearch, self).__init__(editor,
+                                            search_type=SEARCH_DOCUMENTS,
+                                            search=pattern,
+                                            replace=None,
+                                            ignore_case=False,
+                                            use_regex=False,
+                                            skip_hidden=True)
+        self.matches = []
+
+    def add_match(self, filename, match, linenum, start, end):
+        self.matches.append((filename, match, linenum, start, end))
+
+def make_search_thread(document, pattern):
+    search = LoggingSearch(MockEditor([document]), pattern)
+    thread = InitialSearchThread()
+    # set up what start() would without running the thread
+    thread.search = search
+    thread.interrupted = False
+    thread.snapshots = {document: document.snapshot()}
+    return thread
+
+def test_search_snapshot():
+    doc = Document(title="Untitled",
+                   content=u"one needle\ntwo\nthree needle\nfour needle\n")
+    thread = make_search_thread(doc, u"needle")
+    snapshot = thread.snapshots[doc]
+
+    # edit the document after the snapshot got taken
+    doc.insert(0, u"zero\n")
+    doc.insert(5, u"!")
+    doc.delete(doc.cursor_pos_to_offset((4, 8)), 2)
+
+    assert thread.search_simple('Untitled', snapshot.content, snapshot) == 2
+    # the matches are where they are in the document now and the one that
+    # got edited is gone
+    assert thread.search.matches == [
+        ('Untitled', u"!one needle", 1, 5, 11),
+        ('Untitled', u"three needle", 3, 6, 12)]
+
+def test_search_file():
+    doc = Document(title="Untitled", content=u"needle\r\nhay needle")
+    thread = make_search_thread(doc, u"needle")
+    assert thread.search_simple('Untitled', doc.content) == 2
+    assert thread.search.matches == [
+        ('Untitled', u"needle", 0, 0, 6),
+        ('Untitled', u"hay needle", 1, 4, 10)]
@@ -90,6 +90,10 @@ class TestBaseSettings(unittest.TestCase):
         expected_path = os.path.join(self.settings_dir, 'workspaces')
         assert self.settings.get_workspaces_dir() == expected_path
 
+    def test_get_token_cache_dir(self):
+        expected_path = os.path.join(self.settings_dir, 'tokens')
+        assert self.settings.get_token_cache_dir() == expected_path
+
     def test_load_workspaces(self):
         workspaces = self.settings.load_workspaces()
         assert len(workspaces) == 1
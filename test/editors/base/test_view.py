@@ -2,6 +2,8 @@ import unittest
 from nose.tools import *
 from pygments.lexers import get_lexer_by_name
 from pygments.token import Token
+from ni.core.document import Document
+from ni.core.selection import Selection
 from ni.editors.base.view import find_bracket_in_token, fake_punc_tokens, \
     fake_punc_tokens_reverse, View
 
@@ -159,3 +161,76 @@ var settings = jQuery.extend({
 
 #View.calculate_brackets
 #View.execute_action
+
+
+DAMAGE_TEXT = u"one\ntwo\nthree\nfour\nfive\nsix\n"
+
+def make_painted_view():
+    view = View(None, Document(title='Untitled', content=DAMAGE_TEXT))
+    view.mark_painted()
+    return view
+
+def test_damaged_lines_before_painting():
+    view = View(None, Document(title='Untitled', content=DAMAGE_TEXT))
+    assert view.get_damaged_lines() is None
+
+def test_damaged_lines_nothing_changed():
+    view = make_painted_view()
+    assert view.get_damaged_lines() == []
+
+def test_damaged_lines_edit_in_line():
+    view = make_painted_view()
+    view.document.insert(9, u"and ")
+    assert view.get_damaged_lines() == [(2, 2)]
+
+def test_damaged_lines_new_line():
+    view = make_painted_view()
+    view.document.insert(9, u"\n")
+    # all the lines after it moved down
+    assert view.get_damaged_lines() == [(2, 7)]
+
+def test_damaged_lines_huge_document():
+    import os
+    import tempfile
+    from ni.core.mappedtext import MappedText
+    fd, location = tempfile.mkstemp()
+    os.write(fd, DAMAGE_TEXT.encode('utf8')*100)
+    os.close(fd)
+    try:
+        mapped = MappedText(location, block_size=16)
+        view = View(None, Document(location=location, content=mapped))
+        view.mark_painted()
+        # painting doesn't read all of the file
+        assert not mapped.is_indexed
+        assert view.get_damaged_lines() == []
+    finally:
+        os.unlink(location)
+
+def test_damaged_lines_cursor():
+    view = make_painted_view()
+    view.cursor_pos = (0, 2)
+    assert view.get_damaged_lines() == []
+    view.cursor_pos = (3, 0)
+    assert view.get_damaged_lines() == [(0, 0), (3, 3)]
+
+def test_damaged_lines_selection():
+    view = make_painted_view()
+    doc = view.document
+    view.selection = Selection(doc, 4, 10)
+    assert view.get_damaged_lines() == [(1, 2)]
+    view.mark_painted()
+
+    # dragging the end of the selection down
+    view.selection = Selection(doc, 4, 16)
+    assert view.get_damaged_lines() == [(2, 3)]
+
+    view.selection = None
+    assert view.get_damaged_lines() == [(1, 2)]
+
+def test_damaged_lines_brackets():
+    view = make_painted_view()
+    view.cursor_pos = (1, 0)
+    view.brackets = (14,)
+    view.mark_painted()
+    view.brackets = None
+    assert view.get_damaged_lines() == [(1, 3)]